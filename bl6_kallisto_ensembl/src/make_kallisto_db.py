@@ -5,125 +5,115 @@ cell-type/sex expression averages for both transcripts and genes
 
 import sys
 import os
-import re
 import sqlite3
 from numpy import mean
 
-def scrub(s):
-    return re.sub("[\";]", "", s)
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from gtf_tables import load_gtf
+from sqlite_bulk_load import BulkLoader
 
 def get_gene_transcript_dict(annotation_fname):
     print("Getting transcript to gene dictionary ... "),
     sys.stdout.flush()
 
-    gene_transcript_dict = {}
-    with open(annotation_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
-
-            line_list = line.strip().split()
-            if line_list[2] != "transcript":
-                continue
-
-            gene_id = scrub(line_list[9])
-            gene_name = scrub(line_list[17])
-            transcript_id = scrub(line_list[13])
-            gene_transcript_dict[transcript_id] \
-                = {"gene_id":gene_id, "gene_name":gene_name}
+    gtf = load_gtf(annotation_fname)
+    gene_transcript_dict = {
+        transcript_id:{"gene_id":gene_id, "gene_name":gene_name} \
+            for transcript_id, gene_id, gene_name in zip(
+                gtf.get_column("transcript_id"),
+                gtf.get_column("gene_id"),
+                gtf.get_column("gene_name")
+            )
+    }
     print("Done")
     return gene_transcript_dict
 
-def make_samples_table(db_fname, sample_dir, quant_fname, gene_transcript_dict):
-    print("Making samples table ... ")
-    sys.stdout.flush()
-
-    conn = sqlite3.connect(db_fname)
-    cur = conn.cursor()
-
-    transcript_data = {}
-    gene_data = {}
-    tdata = []
-
-    for sample in os.listdir(sample_dir):
-        print("Making table for sample {}".format(sample))
-        sys.stdout.flush()
-
-        code = "_".join(sample.split("_")[0:2])
-
-        filepath = os.path.join(sample_dir, sample, quant_fname)
-        with open(filepath, 'r') as f:
-            headers = f.readline().strip().split()
-            for line in f:
-                line_list = line.strip().split()
-                transcript_id = line_list[0]
-                length = int(line_list[1])
-                eff_length, est_counts, tpm = map(float, line_list[2:])
-                tdata.append((code, transcript_id, length, eff_length, est_counts, tpm))
-                try:
-                    transcript_data[transcript_id][code] = tpm
-                except KeyError:
-                    transcript_data[transcript_id] = {code:tpm}
-
-                try:
-                    gene_info = gene_transcript_dict[transcript_id]
-                except KeyError:
-                    tmp_id = transcript_id.split("_")[0]
-                    try:
-                        gene_info = gene_transcript_dict[tmp_id]
-                    except KeyError:
-                        print("No matching gene for transcript {}".format(transcript_id))
-                        continue
-                gene_id = gene_info['gene_id']
-                gene_name = gene_info['gene_name']
-                try:
-                    gene_data[gene_info["gene_id"]]["tpms"][code] += tpm
-                except KeyError:
-                    if gene_id not in gene_data:
-                        gene_data[gene_info["gene_id"]] \
-                            = {"gene_name":gene_info["gene_name"], "tpms":{code:tpm}}
-                    else:
-                        gene_data[gene_id]["tpms"][code] = tpm
-
-    cur.execute(
+SAMPLE_TABLES = [
+    (
+        "transcripts",
         '''
-        CREATE TABLE IF NOT EXISTS transcripts (
         sample TEXT NOT NULL,
         transcript_id TEXT NOT NULL,
         length INT NOT NULL,
         eff_length REAL NOT NULL,
         est_counts REAL NOT NULL,
         tpm REAL NOT NULL
-        )
-        '''
-    )
-    seq = ",".join(["?"]*len(tdata[0]))
-    cur.executemany("INSERT INTO transcripts VALUES ({})".format(seq), tdata)
-
-    cur.execute(
+        ''',
+        []
+    ),
+    (
+        "genes",
         '''
-        CREATE TABLE IF NOT EXISTS genes (
         sample TEXT NOT NULL,
         gene_id TEXT NOT NULL,
         gene_name TEXT NOT NULL,
         tpm REAL NOT NULL
-        )
-        '''
+        ''',
+        []
     )
+]
 
-    gdata = []
-    for gene_id, gene_info in gene_data.iteritems():
-        gene_name = gene_info["gene_name"]
-        tpms = gene_info["tpms"]
-        for code,tpm in tpms.iteritems():
-            gdata.append((code, gene_id, gene_name, tpm))
+def make_samples_table(
+        db_fname, sample_dir, quant_fname, gene_transcript_dict, parallel=False):
+    print("Making samples table ... ")
+    sys.stdout.flush()
 
-    cur.executemany(
-        "INSERT INTO genes VALUES ({})".format(",".join(["?"]*len(gdata[0]))),
-        gdata
-    )
+    with BulkLoader(db_fname, SAMPLE_TABLES, parallel=parallel, append=True) as loader:
+        transcript_data = {}
+        gene_data = {}
+
+        for sample in os.listdir(sample_dir):
+            print("Making table for sample {}".format(sample))
+            sys.stdout.flush()
+
+            code = "_".join(sample.split("_")[0:2])
+
+            filepath = os.path.join(sample_dir, sample, quant_fname)
+            with open(filepath, 'r') as f:
+                headers = f.readline().strip().split()
+                for line in f:
+                    line_list = line.strip().split()
+                    transcript_id = line_list[0]
+                    length = int(line_list[1])
+                    eff_length, est_counts, tpm = map(float, line_list[2:])
+                    loader.add(
+                        "transcripts",
+                        (code, transcript_id, length, eff_length, est_counts, tpm)
+                    )
+                    try:
+                        transcript_data[transcript_id][code] = tpm
+                    except KeyError:
+                        transcript_data[transcript_id] = {code:tpm}
 
-    conn.commit()
+                    try:
+                        gene_info = gene_transcript_dict[transcript_id]
+                    except KeyError:
+                        tmp_id = transcript_id.split("_")[0]
+                        try:
+                            gene_info = gene_transcript_dict[tmp_id]
+                        except KeyError:
+                            print("No matching gene for transcript {}".format(transcript_id))
+                            continue
+                    gene_id = gene_info['gene_id']
+                    gene_name = gene_info['gene_name']
+                    try:
+                        gene_data[gene_info["gene_id"]]["tpms"][code] += tpm
+                    except KeyError:
+                        if gene_id not in gene_data:
+                            gene_data[gene_info["gene_id"]] \
+                                = {"gene_name":gene_info["gene_name"], "tpms":{code:tpm}}
+                        else:
+                            gene_data[gene_id]["tpms"][code] = tpm
+
+        for gene_id, gene_info in gene_data.iteritems():
+            gene_name = gene_info["gene_name"]
+            tpms = gene_info["tpms"]
+            for code,tpm in tpms.iteritems():
+                loader.add("genes", (code, gene_id, gene_name, tpm))
+
+        loader.finish()
 
     print("Finished samples table")
     return transcript_data, gene_data
@@ -289,12 +279,15 @@ if __name__ == "__main__":
     parser.add_argument("db_fname")
     parser.add_argument("sample_dir")
     parser.add_argument("quant_fname")
+    parser.add_argument("-p", "--parallel", action="store_true",
+        help="Write the transcripts table from a separate process while parsing")
     args = parser.parse_args()
 
     gene_transcript_dict = get_gene_transcript_dict(args.annotation_fname)
 
     transcript_data, gene_data = make_samples_table(
-        args.db_fname, args.sample_dir, args.quant_fname, gene_transcript_dict
+        args.db_fname, args.sample_dir, args.quant_fname, gene_transcript_dict,
+        parallel=args.parallel
     )
 
     make_avgs_tables(
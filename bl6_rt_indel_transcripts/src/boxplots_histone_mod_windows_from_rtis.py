@@ -4,121 +4,103 @@ expressed RTIs compared to randomly chosen RTIs. For each histone modification,
 create a subplot. Each subplot is as follows. For each distance from the RTI,
 draw a boxplot of the distribution from the random data, and a cross for the
 data from the expressed RTIs.
+
+Counts match `bedtools window -u -w <distance>`, but are computed in memory:
+the distance from each RTI to its nearest peak is found once per histone
+modification, and each sample's count at each distance is a threshold on
+those distances. Random samples are drawn with src/permutation_null.py.
 '''
 
-import matplotlib.pyplot as plt
-import multiprocessing as mp
-from Queue import Empty
-import subprocess
-import tempfile as tf
+import sys
+import os
 import logging
+from functools import partial
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from interval_index import read_bed_intervals, window_distances
+from permutation_null import get_null_distn, get_file_info
 
 logging.basicConfig(level=logging.INFO)
 
-class IntersectProcess(mp.Process):
-    def __init__(self, job_queue, results_queue, close_queue=None):
-        mp.Process.__init__(self)
-        self.job_queue = job_queue
-        self.results_queue = results_queue
-        self.close_queue = close_queue
-        self.intersect_cmd = "bedtools window -u -w {} -a {} -b {} | wc -l"
-
-    def run(self):
-        while True:
-            try:
-                distance, rti_fn, hmod_fn, hmod_label = self.job_queue.get(timeout=10)
-            except Empty:
-                return 0
-            else:
-                self.intersect(distance, rti_fn, hmod_fn, hmod_label)
-
-    def intersect(self, distance, rti_fn, hmod_fn, hmod_label):
-
-        logging.debug(self.intersect_cmd.format(distance, rti_fn, hmod_fn))
-        num_intersects = int(
-            subprocess.check_output(
-                self.intersect_cmd.format(distance, rti_fn, hmod_fn),
-                shell=True
-            )
-        )
-
-        if self.close_queue is not None:
-            self.close_queue.put(rti_fn)
-
-        self.results_queue.put((hmod_label, distance, num_intersects))
+def get_hmod_distances(rti_bed, hmod_bed_list, hmod_label_list):
+    '''
+    For each histone modification, get the distance from each RTI to the
+    nearest peak, in the form returned by window_distances (an RTI is within
+    window d of a peak when 0 <= distance <= d).
+    '''
+    rtis = read_bed_intervals(rti_bed)
+
+    hmod_distances = {}
+    for h, hfn in zip(hmod_label_list, hmod_bed_list):
+        logging.info("Getting distances from RTIs to {} peaks".format(h))
+        hmod_distances[h] = window_distances(rtis, read_bed_intervals(hfn))
+
+    return hmod_distances
+
+def count_within(distances, distance_list):
+    '''
+    Number of RTIs within each window size, for one or many samples (rows)
+    of nearest-peak distances, with window sizes along the last axis.
+    '''
+    has_peak = distances >= 0
+    return np.stack(
+        [np.sum(has_peak & (distances <= d), axis=-1) for d in distance_list],
+        axis=-1
+    )
+
+def count_sample_windows(hmod_distances, distance_list, rng, samples):
+    '''
+    Statistic for permutation_null: for each sample of RTIs, the counts from
+    count_within for each histone modification in turn, as one row.
+    '''
+    return np.hstack(
+        [count_within(distances[samples], distance_list) for distances in hmod_distances]
+    )
 
 def get_random_data(
         all_rti_bed, sample_size, num_samples, hmod_bed_list,
-        hmod_label_list, distance_list, num_procs):
+        hmod_label_list, distance_list, num_procs, batch_size=100, seed=None,
+        expr_data=None, precision=None, cache_dir=None):
     '''
-    Get intersection data for randomly chosen subsets of all of the RTIs
+    Get intersection data for randomly chosen subsets of all of the RTIs. If
+    the expressed RTI data and a precision are given, sampling stops once
+    every p-value is known to within that precision.
     '''
     logging.info("Getting random data")
 
-    hmod_dict = {h:fn for h,fn in zip(hmod_label_list, hmod_bed_list)}
-
-    random_data = {h:{d:[] for d in distance_list} for h in hmod_label_list}
-
-    job_queue = mp.Queue()
-    results_queue = mp.Queue()
-    # Used so IntersectProcess can tell main to close tmpfiles, otherwise
-    # program crashes because too many files are open
-    close_queue = mp.Queue()
-
-    logging.info("Spawning intersection processes")
-
-    procs = [
-        IntersectProcess(job_queue, results_queue, close_queue=close_queue)
-        for _ in range(num_procs)
-    ]
-    
-    for p in procs:
-        p.start()
-
-    logging.info("All intersection processes running")
-
-    tmpfiles = []
-    tmpdict = {}
-
-    for i in range(num_samples):
-        if (i)%100 == 0:
-            logging.info("Processed {} random samples".format(i))
-        for h,hfn in hmod_dict.iteritems():
-            for d in distance_list:
-                tmpfiles.append(tf.NamedTemporaryFile())
-                tmpdict[tmpfiles[-1].name] = tmpfiles[-1]
-
-                subprocess.call(
-                    "shuf -n {} {} | sort -k1,1 -k2,2n > {}"
-                        .format(sample_size, all_rti_bed, tmpfiles[-1].name),
-                    shell=True
-                )
-                tmpfiles[-1].flush()
-                job_queue.put((d, tmpfiles[-1].name, hfn, h))
-                try:
-                    tmpname = close_queue.get(timeout=0.05)
-                except Empty:
-                    pass
-                else:
-                    tmpdict[tmpname].close()
-
-    logging.info("All random samples on job queue")
-
-    expected_results = len(distance_list)*len(hmod_label_list)*num_samples
-
-    logging.info("Waiting for {} results".format(expected_results))
-
-    results_count = 0
-    while results_count < expected_results:
-        h,d,n = results_queue.get()
-        random_data[h][d].append(n)
-        results_count += 1
-        if results_count%100 == 0:
-            logging.info(
-                "Retrieved {} results from random samples".format(results_count)
-            )
-
-    logging.info("Retrieved all results")
+    hmod_distances = get_hmod_distances(all_rti_bed, hmod_bed_list, hmod_label_list)
+    num_rtis = len(hmod_distances.values()[0])
+
+    observed = None
+    if expr_data is not None:
+        observed = [expr_data[h][d] for h in hmod_label_list for d in distance_list]
+
+    null = get_null_distn(
+        partial(
+            count_sample_windows,
+            [hmod_distances[h] for h in hmod_label_list],
+            distance_list
+        ),
+        [(0, num_rtis, sample_size)],
+        num_samples, num_procs=num_procs, batch_size=batch_size, seed=seed,
+        observed=observed, precision=precision, cache_dir=cache_dir,
+        cache_key=[
+            get_file_info(all_rti_bed),
+            [get_file_info(hfn) for hfn in hmod_bed_list],
+            distance_list
+        ]
+    )
+
+    random_data = {}
+    for i, h in enumerate(hmod_label_list):
+        for j, d in enumerate(distance_list):
+            column = null[:, i*len(distance_list) + j]
+            random_data.setdefault(h, {})[d] = column.tolist()
 
     logging.info("Returning random data")
     return random_data
@@ -129,38 +111,13 @@ def get_expr_data(
     Get intersection data for expressed RTIs
     '''
     logging.info("Getting data from expressed RTIs")
-    hmod_dict = {h:fn for h,fn in zip(hmod_label_list, hmod_bed_list)}
-
-    expr_data = {h:{d:0 for d in distance_list} for h in hmod_label_list}
-
-    job_queue = mp.Queue()
-    results_queue = mp.Queue()
 
-    logging.info("Spawning intersection processes")
+    hmod_distances = get_hmod_distances(expr_rti_bed, hmod_bed_list, hmod_label_list)
 
-    procs = [IntersectProcess(job_queue, results_queue) for _ in range(num_procs)]
-    for p in procs:
-        p.start()
-
-    logging.info("All intersection processes running")
-
-    for h,hfn in hmod_dict.iteritems():
-        for d in distance_list:
-            job_queue.put((d, expr_rti_bed, hfn, h))
-
-    logging.info("All combinations on job queue")
-
-    expected_results = len(hmod_label_list)*len(distance_list)
-
-    logging.info("Waiting for {} results".format(expected_results))
-
-    results_count = 0
-    while results_count < expected_results:
-        h,d,n = results_queue.get()
-        expr_data[h][d] = n
-        results_count += 1
-
-    logging.info("Retrieved all results")
+    expr_data = {}
+    for h in hmod_label_list:
+        counts = count_within(hmod_distances[h], distance_list)
+        expr_data[h] = {d:int(c) for d,c in zip(distance_list, counts)}
 
     logging.info("Returning expressed RTI data")
     return expr_data
@@ -220,24 +177,37 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--distance", action="append", type=int)
     parser.add_argument("plot_title")
     parser.add_argument("img_fname")
+    parser.add_argument("--batchSize", type=int, default=100,
+        help="Number of random samples per job")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Random seed, for reproducible random samples")
+    parser.add_argument("--precision", type=float, default=None,
+        help="Stop sampling once every p-value's standard error is below this")
+    parser.add_argument("--nullCache", default=None,
+        help="Directory in which to cache random samples (requires --seed)")
     args = parser.parse_args()
 
-    random_data = get_random_data(
-        args.all_rti_bed,
-        args.sample_size,
-        args.num_samples,
+    expr_data = get_expr_data(
+        args.expr_rti_bed,
         args.hmod_bed,
         args.hmod_label,
         args.distance,
         args.num_procs
     )
 
-    expr_data = get_expr_data(
-        args.expr_rti_bed,
+    random_data = get_random_data(
+        args.all_rti_bed,
+        args.sample_size,
+        args.num_samples,
         args.hmod_bed,
         args.hmod_label,
         args.distance,
-        args.num_procs
+        args.num_procs,
+        batch_size=args.batchSize,
+        seed=args.seed,
+        expr_data=expr_data,
+        precision=args.precision,
+        cache_dir=args.nullCache
     )
 
     plot_intersects(
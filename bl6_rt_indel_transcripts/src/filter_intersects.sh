@@ -2,12 +2,14 @@
 
 
 SRCDIR=data/strg_merge_int_rt_indels
+EXONDIR=$HOME/projects/stringtie_merge/data/all_exons
 DBDIR=/home/jg600/projects/stringtie_merge/data/stringtie_merge
 RTIBED=/home/jg600/projects/mm10_ref/repeatmasker/retrotransposon_indels/rt_indels.numbered.bed
 
-for d in $(find $SRCDIR -type d | sed '1d');
+for d in $(find $EXONDIR -type d | sed '1d');
 do
-  MRG=$(echo $d | cut -d/ -f3)
+  MRG=$(basename $d)
   echo $MRG
-  /usr/bin/python src/filter_rti_intersect.py $SRCDIR/$MRG/exons.rti.intersect $DBDIR/$MRG"_merge.db" $RTIBED 0.3 $SRCDIR/$MRG/transcripts.rt_indels.intersect
+  mkdir -p $SRCDIR/$MRG
+  /usr/bin/python src/filter_rti_intersect.py --exonBed $d/exons.bed $DBDIR/$MRG"_merge.db" $RTIBED 0.3 $SRCDIR/$MRG/transcripts.rt_indels.intersect
 done
@@ -1,15 +1,24 @@
 '''
 Filter the results from bedtools intersect -wao between a set of exons and
 retorcopy indels based on reciprocal overlap as a proportion of total
-length. Output a file in the bedtools intersect output format.
+length. Output a file in the bedtools intersect output format. With
+--exonBed, the overlaps are instead computed in memory from the exon and RTI
+BEDs.
 '''
 
 import sqlite3
 import sys
-import tempfile as tf
-import subprocess
+import os
+from functools import partial
 
-def get_intersect_dict(intersect_fname):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from db_lookup import fetch_by_key
+from chrom_parallel import run_by_chrom
+from interval_index import IntervalIndex, overlap_sums
+
+def lines_to_intersect_dict(lines):
     column_names = [
         "exon_chromosome", "exon_start", "exon_end",
         "exon_name", "exon_score", "exon_strand",
@@ -18,29 +27,32 @@ def get_intersect_dict(intersect_fname):
         "overlap"
     ]
     intersect_dict = {}
-    with open(intersect_fname, 'r') as f:
-        for line in f:
-            line_dict = {k:v for k,v in zip(column_names, line.strip().split())}
-
-            if line_dict["rti_start"] == "-1":
-                continue
-
-            transcript_name = ".".join(line_dict["exon_name"].split(".")[0:-1])
-            rti_name = line_dict["rti_name"]
-
-            if transcript_name in intersect_dict:
-                try:
-                    intersect_dict[transcript_name][rti_name] \
-                        += int(line_dict["overlap"])
-                except KeyError:
-                    intersect_dict[transcript_name][rti_name] \
-                        = int(line_dict["overlap"])
-            else:
-                intersect_dict[transcript_name] \
-                    = {rti_name:int(line_dict["overlap"])}
+    for line in lines:
+        line_dict = {k:v for k,v in zip(column_names, line.strip().split())}
+
+        if line_dict["rti_start"] == "-1":
+            continue
+
+        transcript_name = ".".join(line_dict["exon_name"].split(".")[0:-1])
+        rti_name = line_dict["rti_name"]
+
+        if transcript_name in intersect_dict:
+            try:
+                intersect_dict[transcript_name][rti_name] \
+                    += int(line_dict["overlap"])
+            except KeyError:
+                intersect_dict[transcript_name][rti_name] \
+                    = int(line_dict["overlap"])
+        else:
+            intersect_dict[transcript_name] \
+                = {rti_name:int(line_dict["overlap"])}
 
     return intersect_dict
 
+def get_intersect_dict(intersect_fname):
+    with open(intersect_fname, 'r') as f:
+        return lines_to_intersect_dict(f)
+
 def get_bed_dict(bed_fname):
     bed_dict = {}
     with open(bed_fname, 'r') as f:
@@ -52,15 +64,77 @@ def get_bed_dict(bed_fname):
 
     return bed_dict
 
-def get_output_line(transcript, rti_name, exon_cur, rti_dict):
-    transcript_list = list(
-        exon_cur.execute(
-            '''
-            SELECT chromosome, start_coord, end_coord, transcript_id, strand
-            FROM transcript WHERE transcript_id=?
-            ''',
-            (transcript, )).fetchone()
-    )
+# The RTI BED and exon database of each process, opened on first use so that
+# per-chromosome jobs run by the same worker share them
+rti_dicts = {}
+exon_conns = {}
+
+def get_rti_dict(rti_bed):
+    try:
+        return rti_dicts[rti_bed]
+    except KeyError:
+        rti_dicts[rti_bed] = get_bed_dict(rti_bed)
+        return rti_dicts[rti_bed]
+
+def get_exon_conn(exon_db):
+    # Connections can't be shared with forked processes, so key by PID
+    conn_key = (os.getpid(), exon_db)
+    try:
+        return exon_conns[conn_key]
+    except KeyError:
+        exon_conns[conn_key] = sqlite3.connect(exon_db)
+        return exon_conns[conn_key]
+
+def read_exon_bed(exon_bed):
+    '''
+    Read the exons in a BED file named <transcript>.<exon number>. Returns
+    (chroms, starts, ends) arrays, each exon's transcript code and the
+    transcript names the codes index.
+    '''
+    chroms = []
+    starts = []
+    ends = []
+    codes = []
+    transcripts = []
+    transcript_idx = {}
+    with open(exon_bed, 'r') as f:
+        for line in f:
+            line_list = line.split()
+            transcript_name = ".".join(line_list[3].split(".")[0:-1])
+            try:
+                code = transcript_idx[transcript_name]
+            except KeyError:
+                code = len(transcripts)
+                transcript_idx[transcript_name] = code
+                transcripts.append(transcript_name)
+
+            chroms.append(line_list[0])
+            starts.append(int(line_list[1]))
+            ends.append(int(line_list[2]))
+            codes.append(code)
+
+    return (chroms, starts, ends), codes, transcripts
+
+def get_intersect_dict_from_beds(exon_bed, rti_bed):
+    '''
+    Build the same dict as get_intersect_dict straight from the exon and
+    RTI BEDs, summing the overlaps in memory rather than going through
+    bedtools intersect output.
+    '''
+    index = IntervalIndex.from_bed(rti_bed, None)
+    intervals, exon_codes, transcripts = read_exon_bed(exon_bed)
+
+    intersect_dict = {}
+    for transcript_code, label_code, overlap in zip(
+            *[a.tolist() for a in overlap_sums(index, intervals, exon_codes)]):
+        intersect_dict.setdefault(
+            transcripts[transcript_code], {}
+        )[index.labels[label_code]] = overlap
+
+    return intersect_dict
+
+def get_output_line(transcript, rti_name, transcript_rows, rti_dict):
+    transcript_list = list(transcript_rows[transcript][0:5])
     transcript_list.insert(-1,0)
     transcript_line = "\t".join(map(str, transcript_list))
 
@@ -74,28 +148,28 @@ def filter_intersects(intersect_dict, exon_db, rti_bed, overlap_cutoff):
     greater than the overlap cutoff. If it is, check the same for the
     RTI it overlaps with. If this also exceeds the overlap_cutoff,
     put the pair in the output list.
+
+    The rows for all transcripts involved are fetched up front, in batches,
+    rather than queried once per transcript.
     '''
 
     out_intersects = []
 
-    exon_conn = sqlite3.connect(exon_db)
-    exon_cur = exon_conn.cursor()
+    exon_cur = get_exon_conn(exon_db).cursor()
+
+    transcript_rows = fetch_by_key(
+        exon_cur, "transcript", "transcript_id",
+        ["chromosome", "start_coord", "end_coord", "transcript_id", "strand", "exon_length"],
+        intersect_dict.keys()
+    )
 
-    rti_dict = get_bed_dict(rti_bed)
+    rti_dict = get_rti_dict(rti_bed)
 
     for transcript, intersects in intersect_dict.iteritems():
         try:
-            total_exon_length = exon_cur.execute(
-                "SELECT exon_length FROM transcript WHERE transcript_id=?",
-                (transcript, )
-            ).fetchone()[0]
-        except:
-            print(transcript)
-            print(exon_cur.execute(
-                "SELECT * FROM transcript WHERE transcript_id=?",
-                (transcript, )
-            ).fetchone())
-            sys.exit()
+            total_exon_length = transcript_rows[transcript][5]
+        except KeyError:
+            raise ValueError("Transcript {} is not in {}".format(transcript, exon_db))
 
         for rti_name, overlap in intersects.iteritems():
             rti_length = rti_dict[rti_name]["length"]
@@ -105,21 +179,32 @@ def filter_intersects(intersect_dict, exon_db, rti_bed, overlap_cutoff):
 
             if exon_prop >= overlap_cutoff and rti_prop >= overlap_cutoff:
                 transcript_line, rti_line \
-                    = get_output_line(transcript, rti_name, exon_cur, rti_dict)
+                    = get_output_line(transcript, rti_name, transcript_rows, rti_dict)
                 out_intersects.append([transcript_line, rti_line, str(overlap)])
 
     return out_intersects
 
+def get_output_lines(out_intersects):
+    out_lines = ["\t".join(intersect) for intersect in out_intersects]
+    out_lines.sort(key=lambda l: (l.split("\t", 1)[0], int(l.split("\t", 2)[1]), l))
+    return out_lines
+
+def filter_chrom(lines, exon_db, rti_bed, overlap_cutoff):
+    '''
+    Filter the intersect lines of one chromosome, returning sorted output
+    lines.
+    '''
+    return get_output_lines(filter_intersects(
+        lines_to_intersect_dict(lines), exon_db, rti_bed, overlap_cutoff
+    ))
+
 def write_output_file(out_intersects, output_fname):
-    with tf.NamedTemporaryFile() as tmp:
-        for intersect in out_intersects:
-            tmp.write("\t".join(intersect) + "\n")
-        tmp.flush()
-
-        subprocess.check_output(
-            "sort -k1,1 -k2,2n {} > {}".format(tmp.name, output_fname),
-            shell=True
-        )
+    '''
+    Write the intersects sorted by chromosome then start, as sort -k1,1 -k2,2n.
+    '''
+    with open(output_fname, 'w') as out:
+        for line in get_output_lines(out_intersects):
+            out.write(line + "\n")
 
 if __name__ == "__main__":
     import argparse
@@ -129,11 +214,33 @@ if __name__ == "__main__":
     parser.add_argument("rti_bed")
     parser.add_argument("overlap_cutoff", type=float)
     parser.add_argument("output_fname")
+    parser.add_argument("--exonBed", action="store_true",
+        help="Read intersect_fname as a BED of exons and join it to rti_bed "
+             "in memory, rather than reading bedtools intersect -wao output")
+    parser.add_argument("--threads", type=int, default=1,
+        help="Filter chromosomes in parallel with this many processes "
+             "(the intersect must be grouped by chromosome)")
     args = parser.parse_args()
 
-    intersect_dict = get_intersect_dict(args.intersect_fname)
+    if args.threads > 1:
+        if args.exonBed:
+            parser.error("--threads needs bedtools intersect input, not --exonBed")
+        run_by_chrom(
+            args.intersect_fname, args.output_fname,
+            partial(
+                filter_chrom, exon_db=args.exon_db, rti_bed=args.rti_bed,
+                overlap_cutoff=args.overlap_cutoff
+            ),
+            threads=args.threads, sort_chroms=True
+        )
+    else:
+        if args.exonBed:
+            intersect_dict = get_intersect_dict_from_beds(
+                args.intersect_fname, args.rti_bed)
+        else:
+            intersect_dict = get_intersect_dict(args.intersect_fname)
 
-    out_intersects = filter_intersects(
-        intersect_dict, args.exon_db, args.rti_bed, args.overlap_cutoff)
+        out_intersects = filter_intersects(
+            intersect_dict, args.exon_db, args.rti_bed, args.overlap_cutoff)
 
-    write_output_file(out_intersects, args.output_fname)
+        write_output_file(out_intersects, args.output_fname)
@@ -4,7 +4,6 @@
 import sys
 import re
 import os
-import subprocess
 from math import *
 import json
 
@@ -12,6 +11,11 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
 
+sys.path.append(
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from progress import Progress
+
 def get_proportions_dict(fnames, labels, classes):
 	'''
 	For each file of classified indels, get proportions of each classification
@@ -24,20 +28,10 @@ def get_proportions_dict(fnames, labels, classes):
 	for fn,label in zip(fnames, labels):
 
 		print("Getting data from classification file {}".format(fn))
-		print('[' + ' '*50 + ']'),
-		print('\r'),
-		num_lines = int(
-			subprocess.check_output(
-				"wc -l %s | awk '{print $1}'" % fn,
-				shell=True
-			)
-		)
-		percent = 0.0
-
-		totals[label] = num_lines
+		progress = Progress.for_file("Reading " + fn, fn)
 
 		with open(fn, 'r') as f:
-			for i,line in enumerate(f):
+			for line in f:
 				line_list = re.split("\s+", line.strip())
 				classification = line_list[6]
 				try:
@@ -51,16 +45,13 @@ def get_proportions_dict(fnames, labels, classes):
 					else:
 						counts_dict[label]["Other"] += 1
 
-				percent = 100.0*(float(i)/num_lines)
-				num_bars = int(floor(percent/2))
-				print('\r'),
-				print('[' + '|'*num_bars + ' '*(50-num_bars) + ']'),
-				sys.stdout.flush()
+				progress.update(len(line))
+
+			progress.finish()
+			print("Done")
 
-			print('\r'),
-			print('[' + '|'*50 + ']'),
-			sys.stdout.flush()
-			print("\nDone")
+		num_lines = progress.items
+		totals[label] = num_lines
 
 		proportions_dict[label] = {
 			c:100*float(counts_dict[label][c])/num_lines for c in classes
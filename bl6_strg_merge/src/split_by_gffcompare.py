@@ -6,9 +6,13 @@ import sys
 import os
 import re
 import argparse
-import subprocess
 from math import *
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from progress import Progress
+
 def get_gtf_line_dict(query_gtf):
     '''
     Create a dictionary linking transcript IDs to ordered lists of GTF lines
@@ -16,20 +20,13 @@ def get_gtf_line_dict(query_gtf):
     print("Creating dictionary of query GTF lines")
     sys.stdout.flush()
 
-    num_lines = int(subprocess.check_output("wc -l %s | awk '{print $1}'" % query_gtf, shell = True))
-    percent = 0.0
-    print('['+' '*50+']'),
-    print('\r'),
+    progress = Progress.for_file("Reading query GTF", query_gtf)
 
     gtf_line_dict = {}
     with open(query_gtf, 'r') as gtf:
         for i,line in enumerate(gtf):
 
-            percent = 100.0*(float(i)/num_lines)
-            num_bars = int(floor(percent/2))
-            print('\r'),
-            print('['+'|'*num_bars+' '*(50 - num_bars) + ']'),
-            sys.stdout.flush()
+            progress.update(len(line))
 
             if line[0] == "#":
                 continue
@@ -40,10 +37,9 @@ def get_gtf_line_dict(query_gtf):
             except KeyError:
                 gtf_line_dict[transcript_id] = [line]
 
-    print('\r'),
-    print('['+'|'*50 + ']'),
+    progress.finish()
 
-    print("\nDone")
+    print("Done")
     sys.stdout.flush()
     return gtf_line_dict
 
@@ -74,29 +70,23 @@ def split_gtf(gffcompare_tmap, query_gtf, out_dir):
     print("Reading through tmap file")
     sys.stdout.flush()
 
-    num_lines = int(subprocess.check_output("wc -l %s | awk '{print $1}'" % gffcompare_tmap, shell = True)) - 1
-    percent = 0.0
+    progress = Progress.for_file("Splitting by tmap", gffcompare_tmap)
 
     with open(gffcompare_tmap, 'r') as tmap:
         # Skip the header line
-        tmap.readline()
+        progress.update(len(tmap.readline()), 0)
         for i,line in enumerate(tmap):
 
-            percent = 100.0*(float(i)/num_lines)
-            num_bars = int(floor(percent/2))
-            print('\r'),
-            print('['+'|'*num_bars+' '*(50 - num_bars) + ']'),
-            sys.stdout.flush()
+            progress.update(len(line))
 
             line_list = re.split("\s+", line.strip())
             class_code = line_list[2]
             transcript_id = line_list[4]
             outfile_dict[class_to_file[class_code]].write("".join(gtf_line_dict[transcript_id]))
 
-    print('\r'),
-    print('['+'|'*50 + ']'),
+    progress.finish()
 
-    print("\nDone")
+    print("Done")
     sys.stdout.flush()
 
 if __name__ == "__main__":
@@ -1,14 +1,23 @@
 '''
 Plot barcharts showing the relative proportions of each chromosome for expressed
-vs all retrocopies, and same for retrocopy parents
+vs all retrocopies, and same for retrocopy parents. Proportions for all
+retrocopies/parents are from random samples drawn with src/permutation_null.py.
 '''
 
+import sys
+import os
 import subprocess
-import tempfile as tf
+from functools import partial
 import matplotlib.pyplot as plt
 import numpy as np
 import logging
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from interval_index import read_bed_intervals
+from permutation_null import get_null_distn, get_file_info
+
 logging.basicConfig(level=logging.DEBUG)
 
 def get_chrom_props(bed_fname):
@@ -20,40 +29,66 @@ def get_chrom_props(bed_fname):
 def get_stats(data):
     return {"mean":np.mean(data), "std":np.std(data)}
 
-def get_random_data(bed_fname, sample_size, num_samples):
-    chroms = subprocess.check_output(
-        "cat %s | awk '{print $1}' | sort | uniq" % bed_fname,
-        shell=True
-    ).strip().split("\n")
-
-    data = {c:[] for c in chroms}
-
-    for i in range(num_samples):
-        if i%100 == 0:
-            logging.info("Sample {}/{}".format(i, num_samples))
-
-        with tf.NamedTemporaryFile() as tmp:
-            subprocess.call("shuf -n %d %s > %s" % (sample_size, bed_fname, tmp.name), shell=True)
-            cp = get_chrom_props(tmp.name)
-            for c,p in cp.iteritems():
-                data[c].append(p)
+def count_sample_chroms(chrom_codes, num_chroms, rng, samples):
+    '''
+    Statistic for permutation_null: the proportion of each sample's lines on
+    each chromosome.
+    '''
+    num_samples, sample_size = samples.shape
+    rows = np.repeat(np.arange(num_samples), sample_size)
+    counts = np.bincount(
+        rows*num_chroms + chrom_codes[samples].ravel(),
+        minlength=num_samples*num_chroms
+    )
+    return counts.reshape((num_samples, num_chroms)).astype(float)/sample_size
+
+def get_random_data(
+        bed_fname, sample_size, num_samples, num_procs=1, batch_size=100,
+        seed=None, expr_props=None, precision=None, cache_dir=None):
+    chroms, chrom_codes = np.unique(read_bed_intervals(bed_fname)[0], return_inverse=True)
+
+    observed = None
+    if expr_props is not None:
+        observed = [expr_props.get(c, 0.0) for c in chroms]
+
+    props = get_null_distn(
+        partial(count_sample_chroms, chrom_codes, len(chroms)),
+        [(0, len(chrom_codes), sample_size)],
+        num_samples, num_procs=num_procs, batch_size=batch_size, seed=seed,
+        observed=observed, precision=precision, cache_dir=cache_dir,
+        cache_key=get_file_info(bed_fname)
+    )
 
     logging.info("Got all random samples")
 
-    random_data = {c:get_stats(data[c]) for c in chroms}
+    # Stats for each chromosome are over the samples that include it
+    random_data = {
+        c:get_stats(props[props[:,i] > 0, i]) for i,c in enumerate(chroms)
+    }
 
     return random_data
 
-def get_plot_data(expr_retrocopies_bed, all_retrocopies_bed, expr_rc_parents_bed, all_rc_parents_bed, sample_size, num_samples):
+def get_plot_data(
+        expr_retrocopies_bed, all_retrocopies_bed, expr_rc_parents_bed,
+        all_rc_parents_bed, sample_size, num_samples, **random_args):
+
+    expr_retrocopy_props = get_chrom_props(expr_retrocopies_bed)
+    expr_parent_props = get_chrom_props(expr_rc_parents_bed)
 
     plot_data = {
         "retrocopies":{
-            "expressed":get_chrom_props(expr_retrocopies_bed),
-            "all":get_random_data(all_retrocopies_bed, sample_size, num_samples)
+            "expressed":expr_retrocopy_props,
+            "all":get_random_data(
+                all_retrocopies_bed, sample_size, num_samples,
+                expr_props=expr_retrocopy_props, **random_args
+            )
         },
         "parents":{
-            "expressed":get_chrom_props(expr_rc_parents_bed),
-            "all":get_random_data(all_rc_parents_bed, sample_size, num_samples)
+            "expressed":expr_parent_props,
+            "all":get_random_data(
+                all_rc_parents_bed, sample_size, num_samples,
+                expr_props=expr_parent_props, **random_args
+            )
         }
     }
 
@@ -164,6 +199,15 @@ if __name__ == "__main__":
     parser.add_argument("num_samples", type=int)
     parser.add_argument("plot_title")
     parser.add_argument("img_fname")
+    parser.add_argument("-p", "--numProcs", type=int, default=1)
+    parser.add_argument("--batchSize", type=int, default=100,
+        help="Number of random samples per job")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Random seed, for reproducible random samples")
+    parser.add_argument("--precision", type=float, default=None,
+        help="Stop sampling once every p-value's standard error is below this")
+    parser.add_argument("--nullCache", default=None,
+        help="Directory in which to cache random samples (requires --seed)")
     args = parser.parse_args()
 
     plot_data = get_plot_data(
@@ -172,7 +216,12 @@ if __name__ == "__main__":
         args.expr_rc_parents_bed,
         args.all_rc_parents_bed,
         args.sample_size,
-        args.num_samples
+        args.num_samples,
+        num_procs=args.numProcs,
+        batch_size=args.batchSize,
+        seed=args.seed,
+        precision=args.precision,
+        cache_dir=args.nullCache
     )
 
     chroms = get_chroms(args.all_retrocopies_bed, args.all_rc_parents_bed)
@@ -0,0 +1,492 @@
+'''
+Convert methylation bedgraphs into sorted, per-chromosome columnar binary
+stores, and query them.
+
+A bedgraph with lines of the form
+    chrom  position  end  level  methylated_reads  unmethylated_reads
+plus its .idx file (chrom,first_line,last_line, rebuilt if missing or older
+than the bedgraph) is converted into a directory
+<bedgraph>.store containing, for each chromosome, the .npy arrays:
+    <chrom>.pos.npy     int32    CpG positions, sorted
+    <chrom>.level.npy   float32  methylation level (NaN if no data)
+    <chrom>.meth.npy    int32    methylated reads
+    <chrom>.unmeth.npy  int32    unmethylated reads
+    <chrom>.cumsum.npy  float64  (n+1 x 5) prefix sums, see PREFIX_SUMS
+and a store.json recording the chromosomes and the size and modification time
+of the source bedgraph, so that stale stores are rebuilt.
+
+Stores are opened memory-mapped, so any number of bedgraphs and worker
+processes can be queried without reading the bedgraphs into memory. Region
+lookups are np.searchsorted calls on the position array, and the summary
+statistics for a region come from differences of the prefix sums, so a whole
+BED file is answered with one vectorised lookup per chromosome.
+
+The region_stats and region_sites functions query a bedgraph by filename,
+opening (and if necessary building) its store on first use, and keep their
+results in an SQLite cache inside the store directory, keyed by query type,
+region and flank sizes. New results are written in chunks of
+QUERY_CACHE_CHUNK_SIZE, so call flush_query_caches once a batch of queries is
+done. The cache is discarded whenever the store is rebuilt.
+
+Usage: python bedgraph_store.py <bedgraph> [<bedgraph> ...]
+'''
+
+import os
+import json
+import sqlite3
+import logging
+
+import numpy as np
+
+COLUMNS = [
+    ("pos", np.int32),
+    ("level", np.float32),
+    ("meth", np.int32),
+    ("unmeth", np.int32)
+]
+
+# Columns of the prefix sum array; CpGs with no data contribute zero to each
+PREFIX_SUMS = ["num_cpgs", "level", "level_sq", "meth", "cvg"]
+
+STORE_VERSION = 3
+
+# Part of the query cache key, bumped when query results change so that
+# results cached by earlier versions are not reused
+QUERY_VERSION = 2
+
+# Query results written to the cache per commit, and seconds to wait for
+# another process's write to finish
+QUERY_CACHE_CHUNK_SIZE = 1000
+QUERY_CACHE_TIMEOUT = 60
+
+def get_store_dir(bedgraph_fname):
+    return bedgraph_fname + ".store"
+
+def get_query_cache_fname(bedgraph_fname):
+    return os.path.join(get_store_dir(bedgraph_fname), "query_cache.sqlite")
+
+def get_source_info(bedgraph_fname):
+    stat = os.stat(bedgraph_fname)
+    return {"size":stat.st_size, "mtime":int(stat.st_mtime)}
+
+def store_is_current(bedgraph_fname):
+    info_fname = os.path.join(get_store_dir(bedgraph_fname), "store.json")
+    if not os.path.isfile(info_fname):
+        return False
+    with open(info_fname, 'r') as f:
+        info = json.load(f)
+    return info.get("version") == STORE_VERSION \
+        and info["source"] == get_source_info(bedgraph_fname)
+
+def make_bedgraph_idx(bedgraph_fname, idx_fname):
+    '''
+    Write a bedgraph index file (chrom,first_line,last_line, with 1-based
+    line numbers) by reading through the bedgraph once.
+    '''
+    logging.info("Creating index file {}".format(idx_fname))
+
+    chrom_lines = []
+    with open(bedgraph_fname, 'r') as f:
+        for i, line in enumerate(f, 1):
+            if line.startswith("track") or line.startswith("#"):
+                continue
+            chrom = line.split("\t", 1)[0].split()[0]
+            if chrom_lines == [] or chrom_lines[-1][0] != chrom:
+                chrom_lines.append([chrom, i, i])
+            else:
+                chrom_lines[-1][2] = i
+
+    with open(idx_fname, 'w') as out:
+        for chrom, first, last in chrom_lines:
+            out.write("{},{},{}\n".format(chrom, first, last))
+
+    logging.info("Finished index file")
+
+def parse_idx(idx_fname):
+    index_dict = {}
+    with open(idx_fname, 'r') as f:
+        for line in f:
+            line_list = line.strip().split(",")
+            index_dict[line_list[0]] = {
+                "first":int(line_list[1]),
+                "last":int(line_list[2])
+            }
+    return index_dict
+
+def convert_bedgraph(bedgraph_fname, idx_fname=None):
+    '''
+    Convert a bedgraph into a binary store, in a single streaming pass. The
+    .idx file gives the number of CpGs on each chromosome, so every column is
+    written straight into a preallocated memory-mapped .npy file.
+    '''
+    logging.info("Converting {} to binary store".format(bedgraph_fname))
+
+    if idx_fname is None:
+        idx_fname = bedgraph_fname + ".idx"
+    if not os.path.isfile(idx_fname) or \
+            os.path.getmtime(idx_fname) < os.path.getmtime(bedgraph_fname):
+        make_bedgraph_idx(bedgraph_fname, idx_fname)
+
+    idx_dict = parse_idx(idx_fname)
+
+    store_dir = get_store_dir(bedgraph_fname)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    # Remove any previous store.json first, so an interrupted conversion is
+    # never mistaken for a complete one, and discard cached query results
+    info_fname = os.path.join(store_dir, "store.json")
+    for fname in [info_fname, get_query_cache_fname(bedgraph_fname)]:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+    source_info = get_source_info(bedgraph_fname)
+
+    # Line number ranges of each chromosome, in file order
+    chrom_ranges = sorted(
+        [(info["first"], info["last"], chrom) for chrom, info in idx_dict.iteritems()]
+    )
+
+    with open(bedgraph_fname, 'r') as f:
+        line_num = 0
+        for first, last, chrom in chrom_ranges:
+            num_cpgs = last - first + 1
+            arrays = {
+                name:np.lib.format.open_memmap(
+                    os.path.join(store_dir, "{}.{}.npy".format(chrom, name)),
+                    mode='w+', dtype=dtype, shape=(num_cpgs,)
+                ) for name, dtype in COLUMNS
+            }
+
+            while line_num < first - 1:
+                f.readline()
+                line_num += 1
+
+            for i in range(num_cpgs):
+                line_list = f.readline().split()
+                line_num += 1
+                arrays["pos"][i] = int(line_list[1])
+                try:
+                    level = float(line_list[3])
+                except (ValueError, IndexError):
+                    # No data for this CpG
+                    level = np.nan
+                try:
+                    meth = int(line_list[4])
+                    unmeth = int(line_list[5])
+                except (ValueError, IndexError):
+                    # No read counts, e.g. in smoothed bedgraphs
+                    meth, unmeth = 0, 0
+                arrays["level"][i] = level
+                arrays["meth"][i] = meth
+                arrays["unmeth"][i] = unmeth
+
+            if np.any(np.diff(arrays["pos"]) < 0):
+                logging.info("{} is unsorted in {}, sorting".format(chrom, bedgraph_fname))
+                order = np.argsort(arrays["pos"], kind="mergesort")
+                for name, _ in COLUMNS:
+                    arrays[name][:] = arrays[name][order]
+
+            np.save(
+                os.path.join(store_dir, "{}.cumsum.npy".format(chrom)),
+                get_prefix_sums(arrays)
+            )
+
+            for array in arrays.values():
+                array.flush()
+            del arrays
+
+            logging.info("Converted {} ({} CpGs)".format(chrom, num_cpgs))
+
+    with open(info_fname, 'w') as out:
+        json.dump(
+            {
+                "version":STORE_VERSION,
+                "source":source_info,
+                "chroms":[c for _,_,c in chrom_ranges]
+            },
+            out
+        )
+
+    logging.info("Finished converting {}".format(bedgraph_fname))
+
+def get_prefix_sums(arrays):
+    has_data = ~np.isnan(arrays["level"])
+    levels = np.where(has_data, arrays["level"], 0).astype(np.float64)
+
+    prefix_sums = np.zeros((len(levels) + 1, len(PREFIX_SUMS)), dtype=np.float64)
+    prefix_sums[1:,0] = np.cumsum(has_data)
+    prefix_sums[1:,1] = np.cumsum(levels)
+    prefix_sums[1:,2] = np.cumsum(levels**2)
+    prefix_sums[1:,3] = np.cumsum(arrays["meth"], dtype=np.float64)
+    prefix_sums[1:,4] = np.cumsum(arrays["meth"], dtype=np.float64) \
+                            + np.cumsum(arrays["unmeth"], dtype=np.float64)
+
+    return prefix_sums
+
+def open_store(bedgraph_fname):
+    '''
+    Open the binary store for a bedgraph, converting the bedgraph first if the
+    store is missing or older than the bedgraph.
+    '''
+    if not store_is_current(bedgraph_fname):
+        convert_bedgraph(bedgraph_fname)
+    return BedgraphStore(get_store_dir(bedgraph_fname))
+
+class BedgraphStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "store.json"), 'r') as f:
+            self.chroms = set(json.load(f)["chroms"])
+        self.columns = {}
+
+    def get_columns(self, chrom):
+        '''
+        Memory-map the columns and prefix sums for a chromosome. Returns None
+        if the chromosome has no CpGs in the store.
+        '''
+        if chrom not in self.chroms:
+            return None
+        try:
+            return self.columns[chrom]
+        except KeyError:
+            self.columns[chrom] = {
+                name:np.load(
+                    os.path.join(self.store_dir, "{}.{}.npy".format(chrom, name)),
+                    mmap_mode='r'
+                ) for name in [c for c,_ in COLUMNS] + ["cumsum"]
+            }
+            return self.columns[chrom]
+
+    def region_sites(self, chrom, region_start, region_end):
+        '''
+        Positions and methylation levels of the CpGs with data in a region.
+        '''
+        columns = self.get_columns(chrom)
+        if columns is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+        first = np.searchsorted(columns["pos"], region_start, 'left')
+        last = np.searchsorted(columns["pos"], region_end, 'right')
+
+        positions = np.asarray(columns["pos"][first:last])
+        levels = np.asarray(columns["level"][first:last])
+        has_data = ~np.isnan(levels)
+
+        return positions[has_data], levels[has_data]
+
+    def region_stats(self, chrom, region_start, region_end):
+        '''
+        Mean and variance of the CpG methylation levels in a region, and the
+        pooled methylation level (methylated reads / coverage). Returns
+        (None, None, None) if the region contains no CpGs with data; the
+        level alone is None if they have no coverage (e.g. a bedgraph with
+        levels but no read counts).
+        '''
+        means, variances, levels = self.region_stats_batch(
+            [chrom], [region_start], [region_end]
+        )
+        if np.isnan(means[0]):
+            return None, None, None
+
+        level = None if np.isnan(levels[0]) else float(levels[0])
+        return float(means[0]), float(variances[0]), level
+
+    def region_stats_batch(self, chroms, region_starts, region_ends):
+        '''
+        region_stats for many regions at once, covering the CpGs with
+        start <= position <= end. Returns arrays of means, variances and
+        pooled levels, which are NaN where a region has no CpGs with data (or,
+        for the level, no coverage).
+        '''
+        chroms = np.asarray(chroms)
+        region_starts = np.asarray(region_starts, dtype=np.int64)
+        region_ends = np.asarray(region_ends, dtype=np.int64)
+
+        sums = np.zeros((len(chroms), len(PREFIX_SUMS)), dtype=np.float64)
+
+        for chrom in np.unique(chroms):
+            columns = self.get_columns(str(chrom))
+            if columns is None:
+                continue
+
+            on_chrom = np.flatnonzero(chroms == chrom)
+            first = np.searchsorted(columns["pos"], region_starts[on_chrom], 'left')
+            last = np.searchsorted(columns["pos"], region_ends[on_chrom], 'right')
+            sums[on_chrom] = columns["cumsum"][last] - columns["cumsum"][first]
+
+        num_cpgs = sums[:,0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(num_cpgs > 0, sums[:,1]/num_cpgs, np.nan)
+            variances = np.maximum(sums[:,2]/num_cpgs - means**2, 0)
+            levels = np.where(sums[:,4] > 0, sums[:,3]/sums[:,4], np.nan)
+        levels[num_cpgs == 0] = np.nan
+
+        return means, variances, levels
+
+class QueryCache(object):
+    '''
+    On-disk cache of query results for one bedgraph. Results are stored as
+    JSON, keyed by query type, region and flank sizes. New results are held
+    until chunk_size have accumulated (or flush is called) and then written
+    in one transaction, so several processes can share the cache.
+    '''
+
+    def __init__(self, bedgraph_fname, chunk_size=QUERY_CACHE_CHUNK_SIZE):
+        self.conn = sqlite3.connect(
+            get_query_cache_fname(bedgraph_fname), timeout=QUERY_CACHE_TIMEOUT
+        )
+        self.chunk_size = chunk_size
+        self.pending = {}
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS results (
+                query TEXT,
+                chrom TEXT,
+                start INTEGER,
+                end INTEGER,
+                add_left INTEGER,
+                add_right INTEGER,
+                result TEXT,
+                PRIMARY KEY (query, chrom, start, end, add_left, add_right)
+            )
+            '''
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        '''
+        Returns (True, result) for a cached key, or (False, None).
+        '''
+        if key in self.pending:
+            return True, json.loads(self.pending[key])
+
+        row = self.conn.execute(
+            '''
+            SELECT result FROM results
+            WHERE query=? AND chrom=? AND start=? AND end=? AND add_left=? AND add_right=?
+            ''',
+            key
+        ).fetchone()
+
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def put(self, key, result):
+        self.pending[tuple(key)] = json.dumps(result)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending == {}:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?)",
+            [key + (result,) for key, result in self.pending.iteritems()]
+        )
+        self.conn.commit()
+        self.pending = {}
+
+open_stores = {}
+query_caches = {}
+
+def get_store(bedgraph_fname):
+    try:
+        return open_stores[bedgraph_fname]
+    except KeyError:
+        open_stores[bedgraph_fname] = open_store(bedgraph_fname)
+        return open_stores[bedgraph_fname]
+
+def get_query_cache(bedgraph_fname):
+    # Connections can't be shared with forked processes, so key by PID
+    cache_key = (os.getpid(), bedgraph_fname)
+    try:
+        return query_caches[cache_key]
+    except KeyError:
+        get_store(bedgraph_fname)
+        query_caches[cache_key] = QueryCache(bedgraph_fname)
+        return query_caches[cache_key]
+
+def flush_query_caches():
+    '''
+    Write out the results held by this process's query caches
+    '''
+    for (pid, _), cache in query_caches.iteritems():
+        if pid == os.getpid():
+            cache.flush()
+
+def cached_query(query, query_func, bedgraph_fname, chrom, start, end,
+                 add_left, add_right, use_cache):
+    key = ("{}.{}".format(query, QUERY_VERSION), chrom, start, end, add_left, add_right)
+    if use_cache:
+        found, result = get_query_cache(bedgraph_fname).get(key)
+        if found:
+            return result
+
+    result = query_func(
+        get_store(bedgraph_fname), chrom, start - add_left, end + add_right
+    )
+
+    if use_cache:
+        get_query_cache(bedgraph_fname).put(key, result)
+
+    return result
+
+def get_region_sites(store, chrom, region_start, region_end):
+    positions, levels = store.region_sites(chrom, region_start, region_end)
+    if len(positions) == 0:
+        return None
+    return [[int(p), float(l)] for p,l in zip(positions, levels)]
+
+def get_region_stats(store, chrom, region_start, region_end):
+    meth_stats = store.region_stats(chrom, region_start, region_end)
+    if meth_stats[0] is None:
+        return None
+    return {
+        "mean":meth_stats[0],
+        "variance":meth_stats[1],
+        "level":meth_stats[2]
+    }
+
+def region_sites(bedgraph_fname, chrom, start, end, add_left=0, add_right=0,
+                 use_cache=True):
+    '''
+    [position, level] pairs for the CpGs with data between start - add_left
+    and end + add_right, or None if there are none.
+    '''
+    return cached_query(
+        "sites", get_region_sites, bedgraph_fname, chrom, start, end,
+        add_left, add_right, use_cache
+    )
+
+def region_stats(bedgraph_fname, chrom, start, end, add_left=0, add_right=0,
+                 use_cache=True):
+    '''
+    Dict of mean, variance and pooled level for the CpGs between
+    start - add_left and end + add_right, or None if there is no data. The
+    level is None if the CpGs have no coverage.
+    '''
+    return cached_query(
+        "stats", get_region_stats, bedgraph_fname, chrom, start, end,
+        add_left, add_right, use_cache
+    )
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bedgraph", nargs="+")
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Rebuild stores even if they are up to date"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for bedgraph_fname in args.bedgraph:
+        if args.force or not store_is_current(bedgraph_fname):
+            convert_bedgraph(bedgraph_fname)
+        else:
+            logging.info("Store for {} is up to date".format(bedgraph_fname))
@@ -1,9 +1,13 @@
 #!/bin/bash
 
-for d in $(find data/all_exons_int_retrocopy_blocks/ -type d | sed '1d');
+EXONDIR=/home/jg600/projects/stringtie_merge/data/all_exons
+
+for e in $(find $EXONDIR -type d | sed '1d');
 do
-MRG=$(echo $d | cut -d/ -f3)
-/usr/bin/python src/filter_block_intersect.py $d/exons.retrocopy_blocks.intersect /home/jg600/projects/stringtie_merge/data/stringtie_merge/$MRG"_merge.db" /home/jg600/projects/mm10_ref/retrogenes/formatted_beds/ucscRetroInfo6.db 0.5 $d/transcripts.retrocopies.filtered-intersect
+MRG=$(echo $e | cut -d/ -f8)
+d=data/all_exons_int_retrocopy_blocks/$MRG
+mkdir -p $d
+/usr/bin/python src/filter_block_intersect.py --blockBed $HOME/projects/mm10_ref/retrogenes/formatted_beds/ucscRetroInfo6.blocks.bed $e/exons.bed /home/jg600/projects/stringtie_merge/data/stringtie_merge/$MRG"_merge.db" /home/jg600/projects/mm10_ref/retrogenes/formatted_beds/ucscRetroInfo6.db 0.5 $d/transcripts.retrocopies.filtered-intersect
 
 cat $d/transcripts.retrocopies.filtered-intersect | awk '{print $1,$2,$3,$4,$5,$6}' | sort -k1,1 -k2,2n | uniq | sed -r 's/\s+/\t/g' > $d/transcripts.retrocopy.bed
 
@@ -8,28 +8,39 @@ for each BED file:
       calculate summary statistics (overall level, mean, std dev)
       return None if no CpGs in region
 Store results in a dict and write to JSON
+
+Methylation data is read from a memory-mapped binary store built from each
+bedgraph by bedgraph_store.py (created automatically if missing or stale).
 '''
 
 import sys
 import json
 import os
-import linecache
-from math import *
-import subprocess
+import shutil
+import tempfile as tf
 import multiprocessing as mp
 from Queue import Empty
 import logging
 
 import numpy as np
 
-SCRIPTDIR="/home/jg600/bs-seq.bedgraphs/scripts"
+from bedgraph_store import BedgraphStore, get_store_dir, store_is_current, convert_bedgraph
+
 logging.basicConfig(level=logging.INFO)
 
 class GetMethProcess(mp.Process):
+    '''
+    Worker that takes jobs of the form (BED label, bedgraph label, bedgraph,
+    regions file, first, last), computes methylation statistics for rows
+    [first, last) of the memory-mapped region arrays and puts the resulting
+    arrays on the results queue.
+    '''
     def __init__(self, job_queue, results_queue):
         mp.Process.__init__(self)
         self.job_queue = job_queue
         self.results_queue = results_queue
+        self.stores = {}
+        self.regions = {}
         logging.info("Initialised {}".format(self.name))
 
     def run(self):
@@ -41,163 +52,28 @@ class GetMethProcess(mp.Process):
                 logging.info("Received STOP signal, stopping {}".format(self.name))
                 return 0
             else:
-                l, bed, gl, bedgraph_fname, idx_dict = job
-                logging.info("Retrieved {}/{} pair, processing".format(l, gl))
-                data = self.get_meth_data(bed, bedgraph_fname, idx_dict)
-                logging.info("Finished {}/{} pair, putting results on queue".format(l, gl))
-                self.results_queue.put([l, gl, data])
-
-
-    def get_meth_data(self, bed, bedgraph_fname, idx_dict):
-        data = {}
-        num_regions = len(bed)
-        for i, (key, info) in enumerate(bed.iteritems()):
-            if (i+1)%100 == 0:
-                logging.info("{}: Processed {}/{} regions".format(self.name, i+1, num_regions))
-
-            data[key] = {}
-            chrom = info["chrom"]
-            region_start = info["start"]
-            region_end = info["end"]
-
-            first_line, last_line = self.bisection_search(
-                bedgraph_fname,
-                idx_dict[chrom]["first"],
-                idx_dict[chrom]["last"],
-                region_start,
-                region_end
-            )
-
-            if first_line is None:
-                data[key] = None
-            else:
-                meth_stats = self.get_meth_stats(
-                    bedgraph_fname, first_line, last_line)
-                if None in meth_stats:
-                    data[key] = None
-                else:
-                    data[key] = {
-                        "mean":meth_stats[0],
-                        "variance":meth_stats[1],
-                        "level":meth_stats[2]
-                    }
-
-        logging.info("{}: Processed {}/{} regions".format(self.name, num_regions, num_regions))
-        return data
-
-    def bisection_search(self, bedgraph_fname, chrom_first_line, chrom_last_line, region_start, region_end):
-        '''
-        Search through a bedgraph to find the first and last lines contained within
-        a given genomic region.
-        '''
-
-        # Get the data from the first and last lines of the region to be searched
-        first_line_list = linecache.getline(bedgraph_fname, chrom_first_line).strip().split()
-        last_line_list = linecache.getline(bedgraph_fname, chrom_last_line).strip().split()
-
-        region_first_line = 0
-        region_last_line = 0
-
-        if region_start <= int(first_line_list[1]):
-            # Region starts before first CpG in the chromosome
-            region_first_line = chrom_first_line
-        else:
-            found = False
-            top_line = chrom_first_line
-            bottom_line = chrom_last_line
-            mid_line = int(floor((top_line + bottom_line)/2))
-
-            while (bottom_line != top_line + 1) and not found:
-                line = linecache.getline(bedgraph_fname, mid_line).strip().split()
-                position = int(line[1])
-
-                if position > region_start:
-                    # Take top half
-                    bottom_line = mid_line
-                    mid_line = int(floor((top_line + bottom_line)/2))
-                elif position < region_start:
-                    # Take bottom half
-                    top_line = mid_line
-                    mid_line = int(floor((top_line + bottom_line)/2))
-                elif position == region_start:
-                    # Exact hit
-                    region_first_line = mid_line
-                    found = True
-
-            if not found:
-                region_first_line = bottom_line
-
-        if region_end >= int(last_line_list[1]):
-            # Region ends after last CpG in the chromosome
-            region_last_line = chrom_last_line
-        else:
-            found = False
-            top_line = region_first_line
-            bottom_line = chrom_last_line
-            mid_line = int(floor((top_line + bottom_line)/2))
-
-            while (bottom_line != top_line + 1) and not found:
-                line = linecache.getline(bedgraph_fname, mid_line).strip().split()
-                position = int(line[1])
-
-                if position > region_end:
-                    # Take top half
-                    bottom_line = mid_line
-                    mid_line = int(floor((top_line + bottom_line)/2))
-                elif position < region_end:
-                    # Take bottom half
-                    top_line = mid_line
-                    mid_line = int(floor((top_line + bottom_line)/2))
-                elif position == region_end:
-                    region_last_line = mid_line
-                    found = True
-
-            if not found:
-                region_last_line = top_line
-
-        if region_first_line == region_last_line:
-            # Either there are no CpGs in this region, or this line contains the
-            # only CpG in the region
-            line = linecache.getline(bedgraph_fname, region_first_line).strip().split()
-            position = int(line[1])
-            if region_start <= position <= region_end:
-                # Only CpG in the region
-                pass
-            else:
-                # No CpGs in the region
-                return None,None
-
-        return [region_first_line, region_last_line]
-
-    def get_meth_stats(self, bedgraph_fname, first_line, last_line):
-        '''
-        Given a pair of lines in a bedgraph file, collect all the data in between
-        these lines and calculate summary statistics
-        '''
-        meth_levels = []
-        meth_reads = []
-        cvg = []
-
-        for i in range(first_line, last_line + 1):
-            line_list = linecache.getline(bedgraph_fname, i).strip().split()
-            try:
-                meth_levels.append(float(line_list[3]))
-                mr = int(line_list[4])
-                umr = int(line_list[5])
-                meth_reads.append(mr)
-                cvg.append(mr + umr)
-            except ValueError:
-                # No data for this CpG
-                continue
-
-        if meth_levels == []:
-            return None, None, None
-
-        mean = np.mean(meth_levels)
-        variance = np.std(meth_levels)**2
-        level = float(sum(meth_reads))/sum(cvg)
-
-        return mean, variance, level
+                l, gl, bedgraph_fname, regions_fname, first, last = job
+                data = self.get_meth_data(bedgraph_fname, regions_fname, first, last)
+                self.results_queue.put([l, gl, first, data])
+
+    def get_meth_data(self, bedgraph_fname, regions_fname, first, last):
+        try:
+            store = self.stores[bedgraph_fname]
+        except KeyError:
+            store = BedgraphStore(get_store_dir(bedgraph_fname))
+            self.stores[bedgraph_fname] = store
+
+        try:
+            regions = self.regions[regions_fname]
+        except KeyError:
+            regions = np.load(regions_fname, mmap_mode='r')
+            self.regions[regions_fname] = regions
+
+        return store.region_stats_batch(
+            regions["chrom"][first:last],
+            regions["start"][first:last],
+            regions["end"][first:last]
+        )
 
 def open_bed(bed_fname):
     logging.info("Reading in {}".format(bed_fname))
@@ -216,25 +92,41 @@ def open_bed(bed_fname):
     logging.info("Finished reading {}".format(bed_fname))
     return bed
 
-def get_bedgraph_idx(idx_fname):
-    logging.info("Fetching bedgraph index info from {}".format(idx_fname))
-
-    index_dict = {}
-    with open(idx_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split(",")
-            index_dict[line_list[0]] = {
-                "first":int(line_list[1]),
-                "last":int(line_list[2])
-            }
-
-    logging.info("Finished")
-    return index_dict
-
-def get_meth_data(input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs):
+def save_bed_regions(bed, regions_fname):
+    '''
+    Write the regions of a BED dict to a .npy record array sorted by
+    chromosome and start, so that workers can memory-map it and each chunk of
+    rows touches a small part of a bedgraph store. Returns the region keys in
+    the same order.
+    '''
+    keys = sorted(bed.keys(), key=lambda k: (bed[k]["chrom"], bed[k]["start"]))
+
+    max_chrom_len = max([len(bed[k]["chrom"]) for k in keys] + [1])
+    regions = np.zeros(
+        len(keys),
+        dtype=[("chrom", "S%d" % max_chrom_len), ("start", np.int64), ("end", np.int64)]
+    )
+    for i, k in enumerate(keys):
+        regions[i] = (bed[k]["chrom"], bed[k]["start"], bed[k]["end"])
+
+    np.save(regions_fname, regions)
+    return keys
+
+def iter_meth_data_chunks(
+        input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs,
+        chunk_size=10000):
+    '''
+    Work is split into chunks of at most chunk_size regions of one BED file
+    against one bedgraph, so all workers stay busy however few BED files or
+    bedgraphs there are. Region coordinates are shared with the workers
+    through memory-mapped files rather than pickled into each job.
+
+    Yields (BED label, bedgraph label, region keys, means, variances, levels)
+    for each chunk as it finishes, with NaN statistics for regions without
+    data, so that results can be consumed without holding them all.
+    '''
     logging.info("Starting to get methylation data")
 
-    meth_data = {l:{gl:{} for gl in bedgraph_labels} for l in bed_labels}
     job_queue = mp.Queue()
     results_queue = mp.Queue()
 
@@ -245,49 +137,76 @@ def get_meth_data(input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs)
 
     logging.info("All processes started")
 
-    logging.info("Checking bedgraph index files")
+    logging.info("Checking bedgraph binary stores")
 
-    bedgraph_idx_fnames = []
     for graph_fname in bedgraphs:
-        graph_idx_fn = graph_fname + ".idx"
-        if not os.path.isfile(graph_idx_fn):
-            logging.info("Missing index file for {}".format(graph_fname))
-            logging.info("Creating index file now ... ")
-            subprocess.call(
-                "bash {}/index_bedgraph.sh {}".format(SCRIPTDIR, graph_fname),
-                shell=True
-            )
-            logging.info("Finished making index file")
-        bedgraph_idx_fnames.append(graph_idx_fn)
+        if not store_is_current(graph_fname):
+            logging.info("Missing or out of date store for {}".format(graph_fname))
+            convert_bedgraph(graph_fname)
+
+    logging.info("Checked all bedgraph binary stores")
+
+    regions_dir = tf.mkdtemp()
+
+    try:
+        logging.info("Starting to put jobs on queue")
 
-    logging.info("Checked all bedgraph index files")
+        bed_keys = {}
+        num_jobs = 0
+        for i, (bed_fname, l) in enumerate(zip(input_beds, bed_labels)):
+            regions_fname = os.path.join(regions_dir, "{}.npy".format(i))
+            bed_keys[l] = save_bed_regions(open_bed(bed_fname), regions_fname)
+            num_regions = len(bed_keys[l])
 
-    logging.info("Starting to put jobs on queue")
-    num_results = len(input_beds)*len(bedgraphs)
+            for graph_fname, gl in zip(bedgraphs, bedgraph_labels):
+                logging.info("Putting {}/{} chunks on queue".format(l, gl))
+                for first in range(0, num_regions, chunk_size):
+                    last = min(first + chunk_size, num_regions)
+                    job_queue.put([l, gl, graph_fname, regions_fname, first, last])
+                    num_jobs += 1
 
-    for bed_fname, l in zip(input_beds, bed_labels):
-        bed = open_bed(bed_fname)
-        for graph_fname, gl, idx_fname in zip(bedgraphs, bedgraph_labels, bedgraph_idx_fnames):
-            idx_dict = get_bedgraph_idx(idx_fname)
+        for _ in range(num_procs):
+            job_queue.put("STOP")
 
-            logging.info("Putting {}/{} pair on queue".format(l, gl))
-            job_queue.put([l, bed, gl, graph_fname, idx_dict])
+        logging.info("All jobs on queue")
+        logging.info("Retrieving results")
 
-    for _ in range(num_procs):
-        job_queue.put("STOP")
+        for count in range(1, num_jobs + 1):
+            l, gl, first, (means, variances, levels) = results_queue.get()
+            keys = bed_keys[l][first:first + len(means)]
+            yield l, gl, keys, means, variances, levels
 
-    logging.info("All jobs on queue")
-    logging.info("Retrieving results")
+            if count % 10 == 0:
+                logging.info("Retrieved {}/{} chunks".format(count, num_jobs))
 
-    count = 0
-    while True:
-        l, gl, data = results_queue.get()
-        count += 1
-        meth_data[l][gl] = data
-        if count == num_results:
-            break
+        for p in procs:
+            p.join()
+    finally:
+        shutil.rmtree(regions_dir)
 
     logging.info("All results retrieved")
+
+def get_meth_data(
+        input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs,
+        chunk_size=10000):
+    meth_data = {l:{gl:{} for gl in bedgraph_labels} for l in bed_labels}
+
+    chunks = iter_meth_data_chunks(
+        input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs,
+        chunk_size=chunk_size
+    )
+
+    for l, gl, keys, means, variances, levels in chunks:
+        for key, mean, variance, level in zip(keys, means, variances, levels):
+            if np.isnan(mean):
+                meth_data[l][gl][key] = None
+            else:
+                meth_data[l][gl][key] = {
+                    "mean":float(mean),
+                    "variance":float(variance),
+                    "level":None if np.isnan(level) else float(level)
+                }
+
     return meth_data
 
 def write_data(meth_data, output_fname):
@@ -296,6 +215,72 @@ def write_data(meth_data, output_fname):
         json.dump(meth_data, out, indent=4, sort_keys=True)
     logging.info("Finished writing data")
 
+def write_columnar_data(
+        input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs,
+        output_fname, chunk_size=10000):
+    '''
+    Write methylation data as a table with one row per region x bedgraph,
+    with fields bed_label, graph_label, region, mean, variance and level
+    (NaN where the JSON output would have null). The file is a sequence of
+    .npy record arrays, one appended per finished chunk, so memory use is
+    bounded by the chunk size; read it back with load_columnar_data.
+    '''
+    logging.info("Writing columnar methylation data to {}".format(output_fname))
+
+    chunks = iter_meth_data_chunks(
+        input_beds, bed_labels, bedgraphs, bedgraph_labels, num_procs,
+        chunk_size=chunk_size
+    )
+
+    with open(output_fname, 'wb') as out:
+        for l, gl, keys, means, variances, levels in chunks:
+            table = np.zeros(
+                len(keys),
+                dtype=[
+                    ("bed_label", "S%d" % max(len(l), 1)),
+                    ("graph_label", "S%d" % max(len(gl), 1)),
+                    ("region", "S%d" % max([len(k) for k in keys] + [1])),
+                    ("mean", np.float64),
+                    ("variance", np.float64),
+                    ("level", np.float64)
+                ]
+            )
+            no_data = np.isnan(means)
+            table["bed_label"] = l
+            table["graph_label"] = gl
+            table["region"] = keys
+            table["mean"] = np.where(no_data, np.nan, means)
+            table["variance"] = np.where(no_data, np.nan, variances)
+            table["level"] = levels
+
+            np.save(out, table)
+
+    logging.info("Finished writing data")
+
+def load_columnar_data(fname):
+    '''
+    Read a file written by write_columnar_data into a single record array.
+    '''
+    chunks = []
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            chunks.append(np.load(f))
+
+    if chunks == []:
+        return np.zeros(0)
+
+    # Chunks may have different string field widths, widen them all to match
+    dtype = []
+    for name in chunks[0].dtype.names:
+        field_dtypes = [c.dtype[name] for c in chunks]
+        if field_dtypes[0].kind == "S":
+            dtype.append((name, "S%d" % max(d.itemsize for d in field_dtypes)))
+        else:
+            dtype.append((name, field_dtypes[0]))
+
+    return np.concatenate([c.astype(dtype) for c in chunks])
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -303,14 +288,26 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--bedLabel", action="append")
     parser.add_argument("-g", "--BEDgraph", action="append")
     parser.add_argument("-L", "--graphLabel", action="append")
+    parser.add_argument("-c", "--chunkSize", type=int, default=10000,
+        help="Maximum number of regions per job")
+    parser.add_argument("-f", "--outputFormat", choices=["json", "columnar"],
+        default="json",
+        help="columnar writes one row per region x bedgraph as results arrive")
     parser.add_argument("num_procs", type=int)
     parser.add_argument("output_fname")
     args = parser.parse_args()
 
-    meth_data = get_meth_data(
-        args.inputBed, args.bedLabel,
-        args.BEDgraph, args.graphLabel,
-        args.num_procs
-    )
-
-    write_data(meth_data, args.output_fname)
+    if args.outputFormat == "columnar":
+        write_columnar_data(
+            args.inputBed, args.bedLabel,
+            args.BEDgraph, args.graphLabel,
+            args.num_procs, args.output_fname, chunk_size=args.chunkSize
+        )
+    else:
+        meth_data = get_meth_data(
+            args.inputBed, args.bedLabel,
+            args.BEDgraph, args.graphLabel,
+            args.num_procs, chunk_size=args.chunkSize
+        )
+
+        write_data(meth_data, args.output_fname)
@@ -1,17 +1,47 @@
 '''
 Draw histograms of methylation level, mean, and variance for each set of regions
-in the given data.
+in the given data. Accepts either the JSON or the columnar output of
+get_meth_data.py.
 '''
 
 import sys
 import json
 from itertools import product
 import matplotlib.pyplot as plt
-from numpy import linspace
+from numpy import linspace, isnan
 from scipy.stats import gaussian_kde
 
+from get_meth_data import load_columnar_data
+
+NPY_MAGIC = "\x93NUMPY"
+
+def get_columnar_plot_data(meth_data_fname):
+    '''
+    As get_plot_data, for the columnar output of get_meth_data.py.
+    '''
+    table = load_columnar_data(meth_data_fname)
+
+    data_types = ["level", "mean", "variance"]
+    region_sets = sorted(set(table["bed_label"]))
+    meth_sets = sorted(set(table["graph_label"]))
+
+    table = table[~isnan(table["mean"])]
+
+    plot_data = {dt:{} for dt in data_types}
+    for rs, ms in product(region_sets, meth_sets):
+        plot_key = rs + "/" + ms
+        rows = table[(table["bed_label"] == rs) & (table["graph_label"] == ms)]
+        for dt in data_types:
+            vals = rows[dt]
+            plot_data[dt][plot_key] = vals[~isnan(vals)].tolist()
+
+    return plot_data
+
 def get_plot_data(meth_data_json):
-    with open(meth_data_json, 'r') as f:
+    with open(meth_data_json, 'rb') as f:
+        if f.read(len(NPY_MAGIC)) == NPY_MAGIC:
+            return get_columnar_plot_data(meth_data_json)
+        f.seek(0)
         meth_data = json.load(f)
 
     data_types = ["level", "mean", "variance"]
@@ -33,7 +63,8 @@ def get_plot_data(meth_data_json):
                 if f is None:
                     continue
                 for dt, val in f.iteritems():
-                    plot_data[dt][plot_key].append(val)
+                    if val is not None:
+                        plot_data[dt][plot_key].append(val)
 
     return plot_data
 
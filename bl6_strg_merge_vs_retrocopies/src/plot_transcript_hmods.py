@@ -7,8 +7,6 @@ For a given set of transcripts, for each transcript in the set:
 
 import sys
 import os
-import traceback as tb
-import re
 import linecache
 import logging
 import subprocess
@@ -22,6 +20,11 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import matplotlib.patches as mpatches
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from gtf_tables import load_gtf
+
 logging.basicConfig(level=logging.INFO)
 
 class IntersectionProcess(mp.Process):
@@ -66,52 +69,26 @@ class IntersectionProcess(mp.Process):
 
         return overlaps
 
-def get_attr_dict(attr_str):
-    return dict(
-        map(
-            lambda y: re.split(' *"', y)[0:-1],
-            map(
-                lambda x: x.strip(),
-                attr_str.split(";")[0:-1]
-            )
-        )
-    )
-
 def parse_gtf(gtf_fname):
     logging.info("Parsing GTF file")
 
+    gtf = load_gtf(gtf_fname)
+
     gtf_dict = {}
-    with open(gtf_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
-
-            line_list = line.strip().split("\t")
-            if line_list[2] not in ["transcript", "exon"]:
-                continue
-            try:
-                attrs = get_attr_dict(line_list[-1])
-            except ValueError:
-                print(tb.format_exc())
-                print(line_list[-1])
-                sys.exit()
-
-            if line_list[2] == "transcript":
-                chromosome = line_list[0]
-                if "chr" not in chromosome:
-                    chromosome = "chr" + chromosome
-
-                gtf_dict[attrs["transcript_id"]] = {
-                    "chromosome":chromosome,
-                    "start":int(line_list[3]),
-                    "end":int(line_list[4]),
-                    "strand":line_list[6],
-                    "exons":[],
-                    "gene_name":attrs["gene_name"]
-                }
-            elif line_list[2] == "exon":
-                gtf_dict[attrs["transcript_id"]]["exons"]\
-                    .append((int(line_list[3]), int(line_list[4])))
+    for i, (transcript_id, chromosome, strand, gene_name) in enumerate(zip(
+            gtf.get_column("transcript_id"), gtf.get_column("chrom"),
+            gtf.get_column("strand"), gtf.get_column("gene_name"))):
+        if "chr" not in chromosome:
+            chromosome = "chr" + chromosome
+
+        gtf_dict[transcript_id] = {
+            "chromosome":chromosome,
+            "start":int(gtf.start[i]),
+            "end":int(gtf.end[i]),
+            "strand":strand,
+            "exons":gtf.get_exons(i),
+            "gene_name":gene_name
+        }
 
     logging.info("Finished parsing GTF file")
 
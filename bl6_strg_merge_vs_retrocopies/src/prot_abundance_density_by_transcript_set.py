@@ -4,7 +4,8 @@ GTF file linking transcript IDs to gene names, plot protein abundance density
 for each set of transcripts.
 '''
 
-import re
+import sys
+import os
 
 import matplotlib
 matplotlib.use('Agg')
@@ -13,30 +14,14 @@ import matplotlib.patches as mpatches
 import numpy as np
 from scipy.stats import gaussian_kde
 
-def get_attr_dict(attr_str):
-    return dict(
-        map(
-            lambda y: re.split(' *"', y)[0:-1],
-            map(
-                lambda x: x.strip(),
-                attr_str.split(";")[0:-1])))
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from gtf_tables import load_gtf
 
 def get_transcript_to_gene_dict(gtf_fname):
-    transcript2gene = {}
-    with open(gtf_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
-
-            line_list = line.strip().split("\t")
-            if line_list[2] != "transcript":
-                continue
-
-            attr_dict = get_attr_dict(line_list[-1])
-
-            transcript2gene[attr_dict["transcript_id"]] = attr_dict["gene_name"]
-
-    return transcript2gene
+    gtf = load_gtf(gtf_fname)
+    return dict(zip(gtf.get_column("transcript_id"), gtf.get_column("gene_name")))
 
 def get_protein_data(proteome_tsv_fname):
     protein_data = {}
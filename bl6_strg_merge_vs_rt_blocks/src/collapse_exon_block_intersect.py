@@ -4,64 +4,94 @@ exons into transcripts and the retrotransposon blocks into full elements,
 and write an mBED file with each transcript/retrotransposon pair.
 '''
 
+import os
+import sys
 import tempfile as tf
 import subprocess
 
-def get_transcript_dict(exon_fname):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from chrom_stream import get_chrom_offsets, read_chrom_lines, iter_chrom_groups
+
+INTERSECT_COLUMNS = [
+    "exon_chromosome", "exon_start", "exon_end",
+    "exon_name", "exon_score", "exon_strand",
+    "block_chromosome", "block_start", "block_end",
+    "block_name", "block_score", "block_strand",
+    "overlap"
+]
+BLOCK_START = INTERSECT_COLUMNS.index("block_start")
+EXON_NAME = INTERSECT_COLUMNS.index("exon_name")
+BLOCK_NAME = INTERSECT_COLUMNS.index("block_name")
+OVERLAP = INTERSECT_COLUMNS.index("overlap")
+
+def collapse_exons(lines, transcripts=None):
+    '''
+    Collapse exon BED lines into a dict of transcripts, keeping only those
+    named in transcripts if it is given.
+    '''
     transcript_dict = {}
-    with open(exon_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split()
-            transcript = ".".join(line_list[3].split(".")[0:-1])
-            start = int(line_list[1])
-            end = int(line_list[2])
-            length = end - start
-            if transcript not in transcript_dict:
-                transcript_dict[transcript] = {
-                    "chromosome":line_list[0],
-                    "start":start,
-                    "end":end,
-                    "strand":line_list[5],
-                    "total_exon_length":length
-                }
-            else:
-                transcript_dict[transcript]["start"] = min(start, transcript_dict[transcript]["start"])
-                transcript_dict[transcript]["end"] = max(end, transcript_dict[transcript]["end"])
-                transcript_dict[transcript]["total_exon_length"] += length
+    for line in lines:
+        line_list = line.strip().split()
+        transcript = ".".join(line_list[3].split(".")[0:-1])
+        if transcripts is not None and transcript not in transcripts:
+            continue
+        start = int(line_list[1])
+        end = int(line_list[2])
+        length = end - start
+        if transcript not in transcript_dict:
+            transcript_dict[transcript] = {
+                "chromosome":line_list[0],
+                "start":start,
+                "end":end,
+                "strand":line_list[5],
+                "total_exon_length":length
+            }
+        else:
+            transcript_dict[transcript]["start"] = min(start, transcript_dict[transcript]["start"])
+            transcript_dict[transcript]["end"] = max(end, transcript_dict[transcript]["end"])
+            transcript_dict[transcript]["total_exon_length"] += length
     return transcript_dict
 
-def get_block_dict(block_fname):
+def get_transcript_dict(exon_fname):
+    with open(exon_fname, 'r') as f:
+        return collapse_exons(f)
+
+def collapse_blocks(lines, features=None):
+    '''
+    Collapse retrotransposon block BED lines into a dict of full elements,
+    keeping only those named in features if it is given.
+    '''
     block_dict = {}
-    with open(block_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split()
-            feature = line_list[3]
-            start = int(line_list[1])
-            end = int(line_list[2])
-            if feature not in block_dict:
-                block_dict[feature] = {
-                    "chromosome":line_list[0],
-                    "start":start,
-                    "end":end,
-                    "strand":line_list[5]
-                }
-            else:
-                block_dict[feature]["start"] = min(start, block_dict[feature]["start"])
-                block_dict[feature]["end"] = max(end, block_dict[feature]["end"])
+    for line in lines:
+        line_list = line.strip().split()
+        feature = line_list[3]
+        if features is not None and feature not in features:
+            continue
+        start = int(line_list[1])
+        end = int(line_list[2])
+        if feature not in block_dict:
+            block_dict[feature] = {
+                "chromosome":line_list[0],
+                "start":start,
+                "end":end,
+                "strand":line_list[5]
+            }
+        else:
+            block_dict[feature]["start"] = min(start, block_dict[feature]["start"])
+            block_dict[feature]["end"] = max(end, block_dict[feature]["end"])
     return block_dict
 
+def get_block_dict(block_fname):
+    with open(block_fname, 'r') as f:
+        return collapse_blocks(f)
+
 def get_intersect_dict(intersect_fname):
-    column_names = [
-        "exon_chromosome", "exon_start", "exon_end",
-        "exon_name", "exon_score", "exon_strand",
-        "block_chromosome", "block_start", "block_end",
-        "block_name", "block_score", "block_strand",
-        "overlap"
-    ]
     intersect_dict = {}
     with open(intersect_fname, 'r') as f:
         for line in f:
-            line_dict = {k:v for k,v in zip(column_names, line.strip().split())}
+            line_dict = {k:v for k,v in zip(INTERSECT_COLUMNS, line.strip().split())}
 
             if line_dict["block_start"] == "-1":
                 continue
@@ -122,6 +152,60 @@ def write_output(output_lines, output_fname):
             shell=True
         )
 
+def get_intersect_pairs(lines):
+    '''
+    Sum the overlaps in intersect lines by transcript/element pair.
+    '''
+    pairs = {}
+    for line in lines:
+        line_list = line.split()
+        if line_list[BLOCK_START] == "-1":
+            continue
+
+        transcript_name = ".".join(line_list[EXON_NAME].split(".")[0:-1])
+        key = (transcript_name, line_list[BLOCK_NAME])
+        pairs[key] = pairs.get(key, 0) + int(line_list[OVERLAP])
+
+    return pairs
+
+def write_sorted_output(intersect_fname, exon_bed_fname, block_bed_fname, output_fname):
+    '''
+    Streaming version of get_output and write_output, for an intersect
+    grouped by chromosome (as from bedtools intersect on sorted BEDs). Each
+    chromosome is collapsed and written in turn, reading only that
+    chromosome's exons and blocks (located through a cached index of the
+    BEDs), so at most one chromosome's pairs are held in memory. Lines are
+    sorted by start within each chromosome, with chromosomes in the order of
+    the intersect, which matches sort -k1,1 -k2,2n when it was sorted that way.
+    '''
+    exon_offsets = get_chrom_offsets(exon_bed_fname)
+    block_offsets = get_chrom_offsets(block_bed_fname)
+
+    with open(output_fname, 'w') as out:
+        for chrom, lines in iter_chrom_groups(intersect_fname):
+            pairs = get_intersect_pairs(lines)
+            if pairs == {}:
+                continue
+
+            transcript_dict = collapse_exons(
+                read_chrom_lines(exon_bed_fname, exon_offsets, chrom),
+                set(t for t, _ in pairs)
+            )
+            block_dict = collapse_blocks(
+                read_chrom_lines(block_bed_fname, block_offsets, chrom),
+                set(f for _, f in pairs)
+            )
+
+            out_lines = []
+            for (transcript, feature), overlap in pairs.iteritems():
+                transcript_line, feature_line \
+                        = get_output_line(transcript, feature, transcript_dict, block_dict)
+                out_lines.append("\t".join([transcript_line, feature_line, str(overlap)]))
+
+            out_lines.sort(key=lambda l: (int(l.split("\t", 2)[1]), l))
+            for line in out_lines:
+                out.write(line + "\n")
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -129,9 +213,17 @@ if __name__ == "__main__":
     parser.add_argument("exon_bed_fname")
     parser.add_argument("block_bed_fname")
     parser.add_argument("output_fname")
+    parser.add_argument("--sorted", action="store_true",
+        help="The intersect is grouped by chromosome (e.g. from sorted BEDs): "
+             "collapse and write it one chromosome at a time")
     args = parser.parse_args()
 
-    output_lines = get_output(
-        args.intersect_fname, args.exon_bed_fname, args.block_bed_fname)
+    if args.sorted:
+        write_sorted_output(
+            args.intersect_fname, args.exon_bed_fname, args.block_bed_fname,
+            args.output_fname)
+    else:
+        output_lines = get_output(
+            args.intersect_fname, args.exon_bed_fname, args.block_bed_fname)
 
-    write_output(output_lines, args.output_fname)
+        write_output(output_lines, args.output_fname)
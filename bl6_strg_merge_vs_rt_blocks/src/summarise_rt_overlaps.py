@@ -4,8 +4,13 @@ write out a file with one line per transcript with a summary of overlaps for
 each.
 '''
 
-import tempfile as tf
-import subprocess
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from chrom_parallel import run_by_chrom
 
 def get_output_lines(intersect_dict):
     output_lines = []
@@ -17,41 +22,59 @@ def get_output_lines(intersect_dict):
         output_lines.append(line)
     return output_lines
 
-def summarise_intersects(mbed_fname, output_fname):
+def get_intersect_dict(lines):
     intersect_dict = {}
+    for line in lines:
+        line_list = line.strip().split()
+        transcript = line_list[3]
+        element_type = ":".join(line_list[9].split(":")[0:2])
+        overlap = int(line_list[-1])
+        if transcript not in intersect_dict:
+            transcript_line = "\t".join(line_list[0:6])
+            intersect_dict[transcript] = {"line":transcript_line, "overlaps":{element_type:overlap}}
+        else:
+            try:
+                intersect_dict[transcript]["overlaps"][element_type] += overlap
+            except KeyError:
+                intersect_dict[transcript]["overlaps"][element_type] = overlap
+    return intersect_dict
 
-    with open(mbed_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split()
-            transcript = line_list[3]
-            element_type = ":".join(line_list[9].split(":")[0:2])
-            overlap = int(line_list[-1])
-            if transcript not in intersect_dict:
-                transcript_line = "\t".join(line_list[0:6])
-                intersect_dict[transcript] = {"line":transcript_line, "overlaps":{element_type:overlap}}
-            else:
-                try:
-                    intersect_dict[transcript]["overlaps"][element_type] += overlap
-                except KeyError:
-                    intersect_dict[transcript]["overlaps"][element_type] = overlap
-
-    output_lines = get_output_lines(intersect_dict)
-
-    with tf.NamedTemporaryFile() as tmp:
-        for line in output_lines:
-            tmp.write(line + "\n")
-        tmp.flush()
-
-        subprocess.check_output(
-            "sort -k1,1 -k2,2n {} > {}".format(tmp.name, output_fname),
-            shell=True
+def sort_output_lines(output_lines):
+    '''
+    Sort output lines by chromosome then start, as sort -k1,1 -k2,2n
+    '''
+    output_lines.sort(key=lambda l: (l.split("\t", 1)[0], int(l.split("\t", 2)[1]), l))
+    return output_lines
+
+def summarise_chrom(lines):
+    '''
+    Summarise the mBED lines of one chromosome, sorted by start.
+    '''
+    return sort_output_lines(get_output_lines(get_intersect_dict(lines)))
+
+def summarise_intersects(mbed_fname, output_fname, threads=1):
+    if threads > 1:
+        run_by_chrom(
+            mbed_fname, output_fname, summarise_chrom, threads=threads,
+            sort_chroms=True
         )
+        return
+
+    with open(mbed_fname, 'r') as f:
+        intersect_dict = get_intersect_dict(f)
+
+    with open(output_fname, 'w') as out:
+        for line in sort_output_lines(get_output_lines(intersect_dict)):
+            out.write(line + "\n")
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("mbed_fname")
     parser.add_argument("output_fname")
+    parser.add_argument("--threads", type=int, default=1,
+        help="Summarise chromosomes in parallel with this many processes "
+             "(the mBED must be grouped by chromosome)")
     args = parser.parse_args()
 
-    summarise_intersects(args.mbed_fname, args.output_fname)
+    summarise_intersects(args.mbed_fname, args.output_fname, threads=args.threads)
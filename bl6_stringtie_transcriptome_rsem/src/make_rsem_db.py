@@ -1,15 +1,17 @@
 #!/usr/bin/python
 
-import sqlite3
+import sys
 import os
 
-def make_rsem_db(db_fname, samples_dir, filepath):
-    conn = sqlite3.connect(db_fname)
-    cur = conn.cursor()
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from sqlite_bulk_load import BulkLoader
 
-    cur.execute(
+TABLES = [
+    (
+        "stringtie_rsem",
         '''
-        CREATE TABLE stringtie_rsem (
         sample TEXT NOT NULL,
         transcript_id TEXT NOT NULL,
         gene_id TEXT NOT NULL,
@@ -19,29 +21,24 @@ def make_rsem_db(db_fname, samples_dir, filepath):
         tpm REAL NOT NULL,
         fpkm REAL NOT NULL,
         isopct REAL NOT NULL
-        )
-        '''
+        ''',
+        []
     )
+]
 
-    for sample in os.listdir(samples_dir):
-        fname = os.path.join(samples_dir, sample, filepath)
-        data = []
-        with open(fname, 'r') as f:
-            num_cols = len(f.readline().strip().split())+1
-            for line in f:
-                row = line.strip().split()
-                row[2] = int(row[2])
-                row[3:] = map(float, row[3:])
-                row = [sample] + row
-                data.append(row)
-        cur.executemany(
-        '''
-        INSERT INTO stringtie_rsem VALUES ({})
-        '''.format(",".join(["?"]*num_cols)),
-        data
-        )
+def make_rsem_db(db_fname, samples_dir, filepath, parallel=False):
+    with BulkLoader(db_fname, TABLES, parallel=parallel) as loader:
+        for sample in os.listdir(samples_dir):
+            fname = os.path.join(samples_dir, sample, filepath)
+            with open(fname, 'r') as f:
+                f.readline()
+                for line in f:
+                    row = line.strip().split()
+                    row[2] = int(row[2])
+                    row[3:] = map(float, row[3:])
+                    loader.add("stringtie_rsem", [sample] + row)
 
-    conn.commit()
+        loader.finish()
 
 if __name__ == "__main__":
     import argparse
@@ -49,6 +46,8 @@ if __name__ == "__main__":
     parser.add_argument("db_fname")
     parser.add_argument("samples_dir")
     parser.add_argument("filepath")
+    parser.add_argument("-p", "--parallel", action="store_true",
+        help="Insert rows from a separate process while parsing")
     args = parser.parse_args()
 
-    make_rsem_db(args.db_fname, args.samples_dir, args.filepath)
+    make_rsem_db(args.db_fname, args.samples_dir, args.filepath, parallel=args.parallel)
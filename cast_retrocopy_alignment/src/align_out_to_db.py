@@ -2,61 +2,70 @@
 Create an SQLite database from the results of a blastn alignment
 '''
 
-import sqlite3
+import sys
+import os
 
-def make_row(line_list):
-    row = []
-    for i,x in enumerate(line_list):
-        if i in [0,1]:
-            row.append(x)
-        elif i in [2,10,11]:
-            row.append(float(x))
-        else:
-            row.append(int(x))
-    return row
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from sqlite_bulk_load import BulkLoader
+from blast_tab import COLUMNS, load_blast
 
-def make_db(align_out_fname, db_fname):
+CHUNK_SIZE = 100000
 
-    conn = sqlite3.connect(db_fname)
-    cur = conn.cursor()
+def make_rows(blast_hits, first, last):
+    '''
+    Rows for the hits first to last, with query and subject names
+    '''
+    chunk = blast_hits.hits[first:last]
+    columns = [
+        blast_hits.get_names(c, slice(first, last)) if c in ("query", "subject") \
+            else chunk[c].tolist() \
+                for c in COLUMNS
+    ]
+    return zip(*columns)
 
-    cur.execute(
-        '''
-        CREATE TABLE alignment (
-            query_name TEXT,
-            subject_name TEXT,
-            percent_identity REAL,
-            alignment_length INT,
-            mismatches INT,
-            gap_opens INT,
-            query_start INT,
-            query_end INT,
-            subject_start INT,
-            subject_end INT,
-            expect_value REAL,
-            bit_score REAL
-        )
+TABLES = [
+    (
+        "alignment",
         '''
+        query_name TEXT,
+        subject_name TEXT,
+        percent_identity REAL,
+        alignment_length INT,
+        mismatches INT,
+        gap_opens INT,
+        query_start INT,
+        query_end INT,
+        subject_start INT,
+        subject_end INT,
+        expect_value REAL,
+        bit_score REAL
+        ''',
+        []
     )
+]
 
-    data = []
-    with open(align_out_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split()
-            data.append(make_row(line_list))
-
-    cur.executemany(
-        "INSERT INTO alignment VALUES ({})".format(",".join(["?"]*len(data[0]))),
-        data
-    )
+def make_db(align_out_fname, db_fname, parallel=False, use_cache=True):
+    blast_hits = load_blast(align_out_fname, use_cache=use_cache)
+    with BulkLoader(db_fname, TABLES, chunk_size=CHUNK_SIZE, parallel=parallel) as loader:
+        for first in range(0, len(blast_hits), CHUNK_SIZE):
+            loader.add_rows("alignment", make_rows(blast_hits, first, first + CHUNK_SIZE))
 
-    conn.commit()
+        loader.finish()
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("align_out_fname")
     parser.add_argument("db_fname")
+    parser.add_argument("-p", "--parallel", action="store_true",
+        help="Insert rows from a separate process while parsing")
+    parser.add_argument("--noCache", action="store_true",
+        help="Parse the blastn output without reading or writing its cache")
     args = parser.parse_args()
 
-    make_db(args.align_out_fname, args.db_fname)
+    make_db(
+        args.align_out_fname, args.db_fname, parallel=args.parallel,
+        use_cache=not args.noCache
+    )
@@ -4,85 +4,63 @@ chromosome matches the subject chromosome, and the match length as a proportion
 of the query length is above a certain threshold.
 '''
 
+import sys
+import os
 import logging
-from collections import OrderedDict
 
-logging.basicConfig(level=logging.INFO)
+import numpy as np
 
-FIELDS=OrderedDict([
-    ("query_name",str),
-    ("subject_name",str),
-    ("percent_identity",float),
-    ("aln_length",int),
-    ("mismatches",int),
-    ("gap_opens",int),
-    ("query_start",int),
-    ("query_end",int),
-    ("subject_start",int),
-    ("subject_end",int),
-    ("evalue",float),
-    ("bit_score",float),
-    ("line",str)
-])
-
-def line_to_dict(line):
-    line_list = line.strip().split()
-    return {f:t(l) for (f,t),l in zip(FIELDS.iteritems(), line_list + [line])}
-
-def get_blastn_out_dict(blast_out_fname):
-    logging.info("Loading blastn output")
-    blastn_out_dict = {}
-    with open(blast_out_fname, 'r') as f:
-        for i,line in enumerate(f):
-            if (i+1)%1000 == 0:
-                logging.info("{} lines parsed".format(i+1))
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from blast_tab import load_blast
 
-            line_list = line.strip().split()
-            name = line_list[0]
-            try:
-                blastn_out_dict[name].append(line_to_dict(line))
-            except KeyError:
-                blastn_out_dict[name] = [line_to_dict(line)]
-    logging.info("All lines parsed, returning dict")
-    return blastn_out_dict
+logging.basicConfig(level=logging.INFO)
 
-def filter_blastn(blastn_out_dict, query_bed_fname, min_length_prop):
+def filter_blastn(blast_hits, query_bed_fname, min_length_prop):
+    '''
+    Indices of the hits that pass the filters, ordered by the query's line in
+    the BED file and then by position in the blastn output
+    '''
     logging.info("Filtering blastn output")
 
-    filtered = []
+    codes = blast_hits.get_codes()
+
+    # Chromosome (as a string pool code, -2 if no hit is on it), length and
+    # BED line of each query, indexed by the query's code
+    query_chrom = np.full(len(codes), -1, dtype=np.int32)
+    query_length = np.ones(len(codes), dtype=np.float64)
+    query_order = np.full(len(codes), -1, dtype=np.int64)
 
     with open(query_bed_fname, 'r') as f:
         for i,line in enumerate(f):
-            if (i+1)%1000 == 0:
-                logging.info("{} query lines parsed".format(i+1))
-
             line_list = line.strip().split()
-            chrom = line_list[0]
-            length = int(line_list[2]) - int(line_list[1])
-            name = line_list[3]
-
             try:
-                matches = blastn_out_dict[name]
+                name = codes[line_list[3]]
             except KeyError:
                 continue
 
-            for match in matches:
-                if chrom != match["subject_name"]:
-                    continue
-                else:
-                    length_prop = float(match["aln_length"])/length
-                    if length_prop < min_length_prop:
-                        continue
-                    else:
-                        filtered.append(match["line"])
+            query_chrom[name] = codes.get(line_list[0], -2)
+            query_length[name] = int(line_list[2]) - int(line_list[1])
+            query_order[name] = i
+
+    hits = blast_hits.hits
+    query = hits["query"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        length_prop = hits["aln_length"]/query_length[query]
+
+    keep = np.flatnonzero(
+        (query_order[query] >= 0) &
+        (query_chrom[query] == hits["subject"]) &
+        (length_prop >= min_length_prop)
+    )
 
-    logging.info("Finished filtering")
-    return filtered
+    logging.info("Finished filtering, {} of {} hits kept".format(len(keep), len(hits)))
+    return keep[np.argsort(query_order[query[keep]], kind="mergesort")]
 
-def write_output(filtered, output_fname):
+def write_output(blast_hits, filtered, output_fname):
     logging.info("Writing output")
-    with open(output_fname, 'wa') as out:
-        out.write("".join(filtered))
+    blast_hits.write_lines(filtered, output_fname)
     logging.info("Finished")
 
 if __name__ == "__main__":
@@ -92,11 +70,13 @@ if __name__ == "__main__":
     parser.add_argument("query_bed_fname")
     parser.add_argument("min_length_prop", type=float)
     parser.add_argument("output_fname")
+    parser.add_argument("--noCache", action="store_true",
+        help="Parse the blastn output without reading or writing its cache")
     args = parser.parse_args()
 
-    blastn_out_dict = get_blastn_out_dict(args.blast_out_fname)
+    blast_hits = load_blast(args.blast_out_fname, use_cache=not args.noCache)
 
     filtered = filter_blastn(
-        blastn_out_dict, args.query_bed_fname, args.min_length_prop)
+        blast_hits, args.query_bed_fname, args.min_length_prop)
 
-    write_output(filtered, args.output_fname)
+    write_output(blast_hits, filtered, args.output_fname)
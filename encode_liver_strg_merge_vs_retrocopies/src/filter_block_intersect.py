@@ -2,14 +2,23 @@
 Filter the results from bedtools intersect -wao between a set of exons and
 the blocks of retrocopies based on reciprocal overlap as a proportion of total
 exon/block length. Output a file in the bedtools intersect output format.
+With --blockBed, the overlaps are instead computed in memory from the exon and
+block BEDs.
 '''
 
 import sqlite3
 import sys
-import tempfile as tf
-import subprocess
+import os
+from functools import partial
 
-def get_intersect_dict(intersect_fname):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+)
+from db_lookup import fetch_by_key
+from chrom_parallel import run_by_chrom
+from interval_index import IntervalIndex, overlap_sums
+
+def lines_to_intersect_dict(lines):
     column_names = [
         "exon_chromosome", "exon_start", "exon_end",
         "exon_name", "exon_score", "exon_strand",
@@ -18,50 +27,87 @@ def get_intersect_dict(intersect_fname):
         "overlap"
     ]
     intersect_dict = {}
+    for line in lines:
+        line_dict = {k:v for k,v in zip(column_names, line.strip().split())}
+
+        if line_dict["block_start"] == "-1":
+            continue
+
+        transcript_name = ".".join(line_dict["exon_name"].split(".")[0:-1])
+        element_name = line_dict["block_name"].split(":")[2]
+
+
+        if transcript_name in intersect_dict:
+            try:
+                intersect_dict[transcript_name][element_name] \
+                    += int(line_dict["overlap"])
+            except KeyError:
+                intersect_dict[transcript_name][element_name] \
+                    = int(line_dict["overlap"])
+        else:
+            intersect_dict[transcript_name] \
+                = {element_name:int(line_dict["overlap"])}
+
+    return intersect_dict
+
+def get_intersect_dict(intersect_fname):
     with open(intersect_fname, 'r') as f:
+        return lines_to_intersect_dict(f)
+
+def read_exon_bed(exon_bed):
+    '''
+    Read the exons in a BED file named <transcript>.<exon number>. Returns
+    (chroms, starts, ends) arrays, each exon's transcript code and the
+    transcript names the codes index.
+    '''
+    chroms = []
+    starts = []
+    ends = []
+    codes = []
+    transcripts = []
+    transcript_idx = {}
+    with open(exon_bed, 'r') as f:
         for line in f:
-            line_dict = {k:v for k,v in zip(column_names, line.strip().split())}
+            line_list = line.split()
+            transcript_name = ".".join(line_list[3].split(".")[0:-1])
+            try:
+                code = transcript_idx[transcript_name]
+            except KeyError:
+                code = len(transcripts)
+                transcript_idx[transcript_name] = code
+                transcripts.append(transcript_name)
 
-            if line_dict["block_start"] == "-1":
-                continue
+            chroms.append(line_list[0])
+            starts.append(int(line_list[1]))
+            ends.append(int(line_list[2]))
+            codes.append(code)
 
-            transcript_name = ".".join(line_dict["exon_name"].split(".")[0:-1])
-            element_name = line_dict["block_name"].split(":")[2]
+    return (chroms, starts, ends), codes, transcripts
 
+def get_intersect_dict_from_beds(exon_bed, block_bed):
+    '''
+    Build the same dict as get_intersect_dict straight from the exon and
+    retrocopy block BEDs, summing the overlaps in memory rather than going
+    through bedtools intersect output.
+    '''
+    index = IntervalIndex.from_bed(block_bed, lambda name: name.split(":")[2])
+    intervals, exon_codes, transcripts = read_exon_bed(exon_bed)
 
-            if transcript_name in intersect_dict:
-                try:
-                    intersect_dict[transcript_name][element_name] \
-                        += int(line_dict["overlap"])
-                except KeyError:
-                    intersect_dict[transcript_name][element_name] \
-                        = int(line_dict["overlap"])
-            else:
-                intersect_dict[transcript_name] \
-                    = {element_name:int(line_dict["overlap"])}
+    intersect_dict = {}
+    for transcript_code, label_code, overlap in zip(
+            *[a.tolist() for a in overlap_sums(index, intervals, exon_codes)]):
+        intersect_dict.setdefault(
+            transcripts[transcript_code], {}
+        )[index.labels[label_code]] = overlap
 
     return intersect_dict
 
-def get_output_line(transcript, retrocopy, exon_cur, block_cur):
-    transcript_list = list(
-        exon_cur.execute(
-            '''
-            SELECT chromosome, start_coord, end_coord, transcript_id, strand
-            FROM transcript WHERE transcript_id=?
-            ''',
-            (transcript, )).fetchone()
-    )
+def get_output_line(transcript, retrocopy, transcript_rows, retrocopy_rows):
+    transcript_list = list(transcript_rows[transcript][0:5])
     transcript_list.insert(-1,0)
     transcript_line = "\t".join(map(str, transcript_list))
 
-    retrocopy_list = list(
-        block_cur.execute(
-            '''
-            SELECT chromosome, start_coord, end_coord, name, strand
-            FROM retrocopy WHERE name=?
-            ''',
-            (retrocopy, )).fetchone()
-    )
+    retrocopy_list = list(retrocopy_rows[retrocopy][0:5])
     retrocopy_list.insert(-1,0)
     retrocopy_line = "\t".join(map(str, retrocopy_list))
 
@@ -73,6 +119,9 @@ def filter_intersects(intersect_dict, exon_db, block_db, overlap_cutoff):
     greater than the overlap cutoff. If it is, check the same for the
     retrocopies it overlaps with. If this also exceeds the overlap_cutoff,
     put the pair in the output list.
+
+    The rows for all transcripts and retrocopies involved are fetched up
+    front, in batches, rather than queried once per pair.
     '''
 
     out_intersects = []
@@ -83,54 +132,64 @@ def filter_intersects(intersect_dict, exon_db, block_db, overlap_cutoff):
     block_conn = sqlite3.connect(block_db)
     block_cur = block_conn.cursor()
 
+    transcript_rows = fetch_by_key(
+        exon_cur, "transcript", "transcript_id",
+        ["chromosome", "start_coord", "end_coord", "transcript_id", "strand", "exon_length"],
+        intersect_dict.keys()
+    )
+
+    retrocopy_rows = fetch_by_key(
+        block_cur, "retrocopy", "name",
+        ["chromosome", "start_coord", "end_coord", "name", "strand", "block_length"],
+        set(r for intersects in intersect_dict.itervalues() for r in intersects)
+    )
+
     for transcript, intersects in intersect_dict.iteritems():
         try:
-            total_exon_length = exon_cur.execute(
-                "SELECT exon_length FROM transcript WHERE transcript_id=?",
-                (transcript, )
-            ).fetchone()[0]
-        except:
+            total_exon_length = transcript_rows[transcript][5]
+        except KeyError:
             print(transcript)
-            print(exon_cur.execute(
-                "SELECT * FROM transcript WHERE transcript_id=?",
-                (transcript, )
-            ).fetchone())
             sys.exit()
 
         for retrocopy, overlap in intersects.iteritems():
             try:
-                total_block_length = block_cur.execute(
-                    "SELECT block_length FROM retrocopy WHERE name=?",
-                    (retrocopy, )
-                ).fetchone()[0]
-            except TypeError:
+                total_block_length = retrocopy_rows[retrocopy][5]
+            except KeyError:
                 print(retrocopy)
-                print(block_cur.execute(
-                    "SELECT block_length FROM retrocopy WHERE name=?",
-                    (retrocopy, )
-                ).fetchone())
                 sys.exit()
 
             exon_prop = float(overlap)/total_exon_length
             block_prop = float(overlap)/total_block_length
 
             if exon_prop >= overlap_cutoff and block_prop >= overlap_cutoff:
-                transcript_line, retrocopy_line \
-                    = get_output_line(transcript, retrocopy, exon_cur, block_cur)
+                transcript_line, retrocopy_line = get_output_line(
+                    transcript, retrocopy, transcript_rows, retrocopy_rows
+                )
                 out_intersects.append([transcript_line, retrocopy_line, str(overlap)])
 
     return out_intersects
 
+def get_output_lines(out_intersects):
+    out_lines = ["\t".join(intersect) for intersect in out_intersects]
+    out_lines.sort(key=lambda l: (l.split("\t", 1)[0], int(l.split("\t", 2)[1]), l))
+    return out_lines
+
+def filter_chrom(lines, exon_db, block_db, overlap_cutoff):
+    '''
+    Filter the intersect lines of one chromosome, returning sorted output
+    lines.
+    '''
+    return get_output_lines(filter_intersects(
+        lines_to_intersect_dict(lines), exon_db, block_db, overlap_cutoff
+    ))
+
 def write_output_file(out_intersects, output_fname):
-    with tf.NamedTemporaryFile() as tmp:
-        for intersect in out_intersects:
-            tmp.write("\t".join(intersect) + "\n")
-        tmp.flush()
-
-        subprocess.check_output(
-            "sort -k1,1 -k2,2n {} > {}".format(tmp.name, output_fname),
-            shell=True
-        )
+    '''
+    Write the intersects sorted by chromosome then start, as sort -k1,1 -k2,2n.
+    '''
+    with open(output_fname, 'w') as out:
+        for line in get_output_lines(out_intersects):
+            out.write(line + "\n")
 
 if __name__ == "__main__":
     import argparse
@@ -140,11 +199,34 @@ if __name__ == "__main__":
     parser.add_argument("block_db")
     parser.add_argument("overlap_cutoff", type=float)
     parser.add_argument("output_fname")
+    parser.add_argument("--blockBed",
+        help="Read intersect_fname as a BED of exons and join it to this BED "
+             "of retrocopy blocks in memory, rather than reading bedtools "
+             "intersect -wao output")
+    parser.add_argument("--threads", type=int, default=1,
+        help="Filter chromosomes in parallel with this many processes "
+             "(the intersect must be grouped by chromosome)")
     args = parser.parse_args()
 
-    intersect_dict = get_intersect_dict(args.intersect_fname)
+    if args.threads > 1:
+        if args.blockBed is not None:
+            parser.error("--threads needs bedtools intersect input, not --blockBed")
+        run_by_chrom(
+            args.intersect_fname, args.output_fname,
+            partial(
+                filter_chrom, exon_db=args.exon_db, block_db=args.block_db,
+                overlap_cutoff=args.overlap_cutoff
+            ),
+            threads=args.threads, sort_chroms=True
+        )
+    else:
+        if args.blockBed is not None:
+            intersect_dict = get_intersect_dict_from_beds(
+                args.intersect_fname, args.blockBed)
+        else:
+            intersect_dict = get_intersect_dict(args.intersect_fname)
 
-    out_intersects = filter_intersects(
-        intersect_dict, args.exon_db, args.block_db, args.overlap_cutoff)
+        out_intersects = filter_intersects(
+            intersect_dict, args.exon_db, args.block_db, args.overlap_cutoff)
 
-    write_output_file(out_intersects, args.output_fname)
+        write_output_file(out_intersects, args.output_fname)
@@ -2,90 +2,190 @@
 Inputs:
 - mBED file of transcribed retroocpies with transcript, retrocopy, parent
 - mBED file of untranscribed retrocopies with retrocopy, parent
-- indexed FASTA file of retrocopy sequences
-- indexed FASTA file of parent sequences
-- output directory for alignment files
+- FASTA file of retrocopy sequences and its .fai index (from index_fasta.py)
+- FASTA file of parent sequences and its .fai index
+- output directory for the alignment results
+
+Pairs are sent to a pool of worker processes in batches through a bounded
+queue, and each worker aligns its batches with an aligner backend and puts
+the parsed results on a results queue. As each batch completes, its results
+are added to an alignment_store.AlignmentStore (alignments.db in the output
+directory by default). Pairs already in the store are skipped, so an
+interrupted run can be restarted with the same arguments. The raw matcher
+output for each pair is only kept with --rawOutput.
+
+A backend is a class constructed in each worker with the directory for raw
+output (None to keep none), with an align_batch method that takes a list of
+(retrocopy, parent, retrocopy sequence, parent sequence) tuples and returns a
+list of (retrocopy, parent, result) tuples, where result is (length,
+identity, similarity, gaps, score), or None if the alignment failed.
+"matcher" runs EMBOSS matcher on each pair and "sw" aligns in process with
+local_align.py; other backends can be added to BACKENDS or given as
+"module:Class".
 '''
 
 import sys
 import os
 import sqlite3
 import multiprocessing as mp
-from Queue import Empty
+import Queue
 import subprocess
 import tempfile as tf
-from math import floor
+import importlib
+import shutil
+import logging
+import traceback
 from random import shuffle
 
-class Aligner(mp.Process):
-    def __init__(self, queue, output_dir):
-        mp.Process.__init__(self)
-        self.queue = queue
-        self.output_dir = output_dir
-        self.align_cmd = "matcher {} {} {}"
+from alignment_store import AlignmentStore
+from fasta_reader import IndexedFasta
+from local_align import align_pairs
+from progress import Progress
 
-    def run(self):
-        while True:
-            try:
-                rc_name, retrocopy_fa_str, parent_fa_str = self.queue.get(timeout=10)
-            except Empty:
-                return 0
-            else:
-                self.align(rc_name, retrocopy_fa_str, parent_fa_str)
-
-    def align(self, retrocopy_name, retrocopy_fa_str, parent_fa_str):
-        output_path = os.path.join(self.output_dir, retrocopy_name + ".matcher")
-
-        with tf.NamedTemporaryFile() as rc_fa, tf.NamedTemporaryFile() as parent_fa:
-            rc_fa.write(retrocopy_fa_str)
-            rc_fa.flush()
-            parent_fa.write(parent_fa_str)
-            parent_fa.flush()
-
-            code = subprocess.check_output(
-                "matcher {} {} {} 2>/dev/null".format(rc_fa.name, parent_fa.name, output_path),
-                shell=True
-            )
-
-
-def get_idx_dict(idx_fname):
-    idx_dict = {}
-    with open(idx_fname, 'r') as f:
+RESULTS_DB = "alignments.db"
+
+def get_output_path(output_dir, retrocopy_name):
+    return os.path.join(output_dir, retrocopy_name + ".matcher")
+
+def parse_matcher_output(output_fname):
+    '''
+    (length, identity, similarity, gaps, score) from the header of a matcher
+    output file, with identity and similarity as fractions of the length
+    '''
+    fields = {}
+    with open(output_fname, 'r') as f:
         for line in f:
-            line_list = line.strip().split(":")
-            idx_dict[line_list[2]] = map(int, line_list[0:2])
-    return idx_dict
-
-def get_fa_str(lines, fasta):
-    head = lines[1]
-    tail = lines[1] - lines[0] + 1
-    fa_str = subprocess.check_output(
-        "head -{} {} | tail -{}".format(head, fasta, tail),
-        shell=True
+            line_list = line.strip("# \n").split(":", 1)
+            if len(line_list) == 2 and line_list[0] in \
+                    ("Length", "Identity", "Similarity", "Gaps", "Score"):
+                fields[line_list[0]] = line_list[1].split()[0]
+
+    length = int(fields["Length"])
+    identity, similarity, gaps = [
+        int(fields[x].split("/")[0]) for x in ("Identity", "Similarity", "Gaps")
+    ]
+    return (
+        length, float(identity)/max(length, 1), float(similarity)/max(length, 1),
+        gaps, float(fields["Score"])
     )
-    return fa_str
 
-def make_alignments(
-        retrocopy_parent_db, retrocopy_fasta, retrocopy_fasta_idx,
-        parent_fasta, parent_fasta_idx, output_dir, num_procs, shuffle_pairs
-    ):
+class MatcherBackend(object):
     '''
-    For each retrocopy, find its parent, get the corresponding sequences and put
-    in temp files, then do a pairwise alignment and put the resulting file in
-    the output directory.
+    Align each pair with EMBOSS matcher. The sequences of a batch are written
+    to a temporary directory shared by the batch, along with matcher's output,
+    which is parsed and then moved to the raw output directory if there is
+    one.
     '''
 
-    retrocopy_idx = get_idx_dict(retrocopy_fasta_idx)
-    parent_idx = get_idx_dict(parent_fasta_idx)
+    def __init__(self, raw_dir=None):
+        self.raw_dir = raw_dir
 
-    queue = mp.Queue()
+    def align_batch(self, pairs):
+        results = []
+        tmp_dir = tf.mkdtemp()
+        try:
+            for i, (rc, parent, rc_seq, parent_seq) in enumerate(pairs):
+                rc_fa = os.path.join(tmp_dir, "{}.rc.fa".format(i))
+                parent_fa = os.path.join(tmp_dir, "{}.parent.fa".format(i))
+                with open(rc_fa, 'w') as out:
+                    out.write(">{}\n{}\n".format(rc, rc_seq))
+                with open(parent_fa, 'w') as out:
+                    out.write(">{}\n{}\n".format(parent, parent_seq))
+
+                output_path = os.path.join(tmp_dir, "{}.matcher".format(i))
+                with open(os.devnull, 'w') as devnull:
+                    code = subprocess.call(
+                        ["matcher", rc_fa, parent_fa, output_path],
+                        stdout=devnull, stderr=devnull
+                    )
+
+                result = None
+                if code == 0 and os.path.exists(output_path):
+                    try:
+                        result = parse_matcher_output(output_path)
+                    except (KeyError, ValueError):
+                        pass
+
+                if result is None:
+                    logging.warning("matcher failed for {}".format(rc))
+                elif self.raw_dir is not None:
+                    shutil.move(output_path, get_output_path(self.raw_dir, rc))
+
+                results.append((rc, parent, result))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return results
+
+class LocalAlignBackend(object):
+    '''
+    Align each batch in process with local_align.py's banded Smith-Waterman.
+    No raw output is written.
+    '''
 
-    aligners = [Aligner(queue, output_dir) for _ in range(num_procs)]
-    for a in aligners:
-        a.start()
+    def __init__(self, raw_dir=None):
+        self.raw_dir = raw_dir
+
+    def align_batch(self, pairs):
+        aligned = align_pairs([(rc_seq, parent_seq) for _, _, rc_seq, parent_seq in pairs])
+        return [
+            (rc, parent, (
+                int(r["length"]), float(r["identity"]), float(r["similarity"]),
+                int(r["gaps"]), float(r["score"])
+            )) \
+                for (rc, parent, _, _), r in zip(pairs, aligned)
+        ]
+
+BACKENDS = {
+    "matcher":MatcherBackend,
+    "sw":LocalAlignBackend
+}
+
+def get_backend(name):
+    '''
+    The backend class registered under name, or "module:Class"
+    '''
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        pass
+
+    if ":" not in name:
+        raise ValueError("Unknown aligner backend: {}".format(name))
+
+    module_name, class_name = name.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)
 
-    #a = Aligner(queue, output_dir)
+class AlignProcess(mp.Process):
+    '''
+    Worker that takes batches of pairs from job_queue until it receives
+    "STOP", aligns them with its own instance of backend and puts the
+    (retrocopy, parent, result) tuples on results_queue.
+    '''
 
+    def __init__(self, job_queue, results_queue, backend, raw_dir):
+        mp.Process.__init__(self)
+        self.job_queue = job_queue
+        self.results_queue = results_queue
+        self.backend = backend
+        self.raw_dir = raw_dir
+
+    def run(self):
+        aligner = self.backend(self.raw_dir)
+        while True:
+            batch = self.job_queue.get()
+            if batch == "STOP":
+                break
+
+            try:
+                results = aligner.align_batch(batch)
+            except Exception:
+                logging.error("Alignment batch failed:\n{}".format(traceback.format_exc()))
+                results = [(rc, parent, None) for rc, parent, _, _ in batch]
+
+            self.results_queue.put(results)
+
+def get_pairs(retrocopy_parent_db, shuffle_pairs):
     conn = sqlite3.connect(retrocopy_parent_db)
     cur = conn.cursor()
     retrocopy_parents = cur.execute("SELECT * FROM retrogenes_parents").fetchall()
@@ -102,55 +202,130 @@ def make_alignments(
         shuffle(parents)
         retrocopy_parents = [(r, p) for r, p in zip(retrocopies[0:shuffle_pairs], parents[0:shuffle_pairs])]
 
-
     conn.close()
 
-    align_count = 0
+    return retrocopy_parents
 
-    num_pairs = len(retrocopy_parents)
-    percent = 0
-    print('['+' '*50+']'),
-    print('\r'),
+def make_alignments(
+        retrocopy_parent_db, retrocopy_fasta, retrocopy_fasta_idx,
+        parent_fasta, parent_fasta_idx, output_dir, num_procs, shuffle_pairs,
+        backend="matcher", batch_size=20, results_db=None, raw_output=False
+    ):
+    '''
+    For each retrocopy, find its parent, get the corresponding sequences and
+    send them in batches to num_procs workers to align, adding the results to
+    results_db (alignments.db in output_dir by default) as they complete.
+    Pairs already in results_db are skipped. With raw_output, each pair's
+    matcher output is also kept in output_dir. Returns the numbers of pairs
+    aligned and failed.
+    '''
 
-    for i, (rc, parent) in enumerate(retrocopy_parents):
+    backend = get_backend(backend)
 
-        if parent is None:
-            continue
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if results_db is None:
+        results_db = os.path.join(output_dir, RESULTS_DB)
+    store = AlignmentStore(results_db)
+    stored = store.get_retrocopies()
 
-        retrocopy_fa_str = get_fa_str(retrocopy_idx[rc], retrocopy_fasta)
+    retrocopy_parents = get_pairs(retrocopy_parent_db, shuffle_pairs)
 
-        try:
-            pidx = parent_idx[parent]
-        except KeyError:
-            continue
+    retrocopy_fa = IndexedFasta(retrocopy_fasta, retrocopy_fasta_idx)
+    parent_fa = IndexedFasta(parent_fasta, parent_fasta_idx)
 
-        parent_fa_str = get_fa_str(pidx, parent_fasta)
+    # A short queue bounds the number of sequences held in memory
+    job_queue = mp.Queue(maxsize=2*num_procs)
+    results_queue = mp.Queue()
 
-        align_count += 1
-        queue.put((rc, retrocopy_fa_str, parent_fa_str))
+    aligners = [
+        AlignProcess(
+            job_queue, results_queue, backend, output_dir if raw_output else None
+        ) \
+            for _ in range(num_procs)
+    ]
+    for a in aligners:
+        a.start()
 
-        #a.align(rc, retrocopy_fa_str, parent_fa_str)
+    progress = Progress("Aligning pairs", total=len(retrocopy_parents), unit="pairs")
+    counts = {"sent":0, "done":0, "aligned":0, "failed":0}
 
-        percent = 100.0*(float(i)/num_pairs)
-        num_bars = int(floor(percent/2))
-        print('\r'),
-        print('['+'|'*num_bars+' '*(50-num_bars)+']'),
+    def collect(timeout=None):
+        try:
+            results = results_queue.get(timeout=timeout)
+        except Queue.Empty:
+            if not any(a.is_alive() for a in aligners):
+                raise RuntimeError("Aligners exited before all pairs were aligned")
+            return
+        rows = [(rc, parent) + result for rc, parent, result in results if result is not None]
+        store.add(rows)
+        counts["aligned"] += len(rows)
+        counts["failed"] += len(results) - len(rows)
+        counts["done"] += len(results)
+
+    def put_job(job):
+        while True:
+            try:
+                job_queue.put(job, timeout=1)
+                return
+            except Queue.Full:
+                while not results_queue.empty():
+                    collect()
+                if not any(a.is_alive() for a in aligners):
+                    raise RuntimeError("Aligners exited before all pairs were aligned")
+
+    def send(batch):
+        put_job(batch)
+        counts["sent"] += len(batch)
+
+    num_existing = 0
+    try:
+        batch = []
+        for rc, parent in retrocopy_parents:
+            progress.update()
+
+            if parent is None or parent not in parent_fa:
+                continue
+
+            if rc in stored:
+                num_existing += 1
+                continue
+
+            batch.append((rc, parent, retrocopy_fa.get_seq(rc), parent_fa.get_seq(parent)))
+            if len(batch) >= batch_size:
+                send(batch)
+                batch = []
+
+        if batch != []:
+            send(batch)
+
+        progress.finish()
+
+        print("Finished processing all pairs.")
+        print("{} sent for alignment, {} already aligned.".format(counts["sent"], num_existing))
         sys.stdout.flush()
 
-    print('\r'),
-    print('['+'|'*50+']')
-    sys.stdout.flush()
+        for _ in aligners:
+            put_job("STOP")
 
-    print("Finished processing all pairs.")
-    print("{} sent for alignment.".format(align_count))
+        while counts["done"] < counts["sent"]:
+            collect(timeout=1)
 
-    while(len(os.listdir(output_dir)) < align_count):
-        print(
-            "Waiting for {} alignment files"
-                .format(align_count - len(os.listdir(output_dir)))
-        )
+        for a in aligners:
+            a.join()
+    finally:
+        for a in aligners:
+            if a.is_alive():
+                a.terminate()
+        retrocopy_fa.close()
+        parent_fa.close()
+        store.close()
 
     print("All alignments finished.")
+    if counts["failed"] > 0:
+        print("{} alignments failed.".format(counts["failed"]))
+
+    return counts["aligned"], counts["failed"]
 
 
 if __name__ == "__main__":
@@ -158,17 +333,31 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("retrocopy_parent_db")
     parser.add_argument("retrocopy_fasta")
-    parser.add_argument("retrocopy_fasta_idx")
+    parser.add_argument("retrocopy_fasta_idx",
+        help="faidx-style index of retrocopy_fasta (.fai, from index_fasta.py)")
     parser.add_argument("parent_fasta")
-    parser.add_argument("parent_fasta_idx")
+    parser.add_argument("parent_fasta_idx",
+        help="faidx-style index of parent_fasta (.fai, from index_fasta.py)")
     parser.add_argument("output_dir")
     parser.add_argument("num_procs", type=int)
     parser.add_argument("shuffle_pairs", type=int)
+    parser.add_argument("--backend", default="matcher",
+        help="Aligner backend: one of {} or module:Class (default matcher)"
+            .format(", ".join(sorted(BACKENDS))))
+    parser.add_argument("--batchSize", type=int, default=20,
+        help="Number of pairs sent to a worker at a time")
+    parser.add_argument("--resultsDb",
+        help="SQLite database for the alignment results (default " +
+            "output_dir/{})".format(RESULTS_DB))
+    parser.add_argument("--rawOutput", action="store_true",
+        help="Also keep each pair's matcher output in output_dir")
     args = parser.parse_args()
 
     make_alignments(
         args.retrocopy_parent_db,
         args.retrocopy_fasta, args.retrocopy_fasta_idx,
         args.parent_fasta, args.parent_fasta_idx,
-        args.output_dir, args.num_procs, args.shuffle_pairs
+        args.output_dir, args.num_procs, args.shuffle_pairs,
+        backend=args.backend, batch_size=args.batchSize,
+        results_db=args.resultsDb, raw_output=args.rawOutput
     )
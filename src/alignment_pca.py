@@ -11,58 +11,51 @@ from sklearn.cluster import KMeans
 from sklearn.manifold import TSNE
 from sklearn import preprocessing
 
+from blast_tab import load_blast
+
 def get_data(aln_out_fname, query_feat_fname):
 
-    aln_dict = {}
-    with open(aln_out_fname, 'r') as f:
+    blast_hits = load_blast(aln_out_fname)
+    codes = blast_hits.get_codes()
+
+    # Chromosome (as a string pool code) and length of each query feature,
+    # indexed by the feature's code
+    feat_chrom = np.full(len(codes), -1, dtype=np.int32)
+    feat_length = np.ones(len(codes), dtype=np.int64)
+    with open(query_feat_fname, 'r') as f:
         for line in f:
             line_list = line.strip().split()
             try:
-                aln_dict[line_list[0]].append([
-                    line_list[1],
-                    float(line_list[2]),
-                    int(line_list[3]),
-                    int(line_list[5]),
-                    float(line_list[10]),
-                    float(line_list[11])
-                ])
+                name = codes[line_list[3]]
             except KeyError:
-                aln_dict[line_list[0]] = [[
-                    line_list[1],
-                    float(line_list[2]),
-                    int(line_list[3]),
-                    int(line_list[5]),
-                    float(line_list[10]),
-                    float(line_list[11])
-                ]]
-
-    feat_length_dict = {}
-    with open(query_feat_fname, 'r') as f:
-        for line in f:
-            line_list = line.strip().split()
-            feat_length_dict[line_list[3]] = {
-                "chrom":line_list[0],
-                "length":int(line_list[2]) - int(line_list[1])
-            }
+                continue
+            feat_chrom[name] = codes.get(line_list[0], -2)
+            feat_length[name] = int(line_list[2]) - int(line_list[1])
 
-    data = []
+    hits = blast_hits.hits
+    query = hits["query"]
+    same_chrom = np.flatnonzero(feat_chrom[query] == hits["subject"])
+    hits = hits[same_chrom]
+    query = query[same_chrom]
 
-    f = open("high_aln.txt", 'wa')
+    # Integer proportion of the feature length, as the alignment lengths and
+    # feature lengths are both integers
+    prop_len = hits["aln_length"] // feat_length[query]
+    p = (hits["gap_opens"]/100.0)*prop_len
 
-    for rc, l in aln_dict.iteritems():
-        for dl in l:
-            if feat_length_dict[rc]["chrom"] == dl[0]:
-                dl[2] = dl[2]/feat_length_dict[rc]["length"]
-                p = ((dl[3])/100.0)*dl[2]
-                dl.append(p)
+    high = np.flatnonzero(prop_len > 0.8)
 
-                if dl[2] > 0.8:
-                    f.write(rc + "\n")
+    f = open("high_aln.txt", 'wa')
+    for rc in blast_hits.get_names("query", same_chrom[high]):
+        f.write(rc + "\n")
+    f.close()
 
-                    data.append(dl[1:])
+    data = np.column_stack([
+        hits["percent_identity"], prop_len, hits["gap_opens"],
+        hits["evalue"], hits["bit_score"], p
+    ])[high]
 
-    f.close()
-    return data
+    return data.tolist()
 
 def plot_hists(data):
     fig, ax = plt.subplots(6, 1)
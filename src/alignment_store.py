@@ -0,0 +1,67 @@
+'''
+SQLite store of retrocopy-parent alignment results, one row per retrocopy in
+the alignments table:
+retrocopy, parent, length, identity, similarity, gaps, score
+where length counts alignment columns (including gaps), identity and
+similarity are fractions of the length and gaps is the number of gap columns.
+
+align_retrocopies_parents.py appends rows as each batch of alignments
+completes, and uses the retrocopies already stored to resume interrupted runs;
+plotting scripts read the rows they need back by retrocopy.
+'''
+
+import sqlite3
+
+from db_lookup import fetch_by_key
+
+TABLE = "alignments"
+COLUMNS = ["retrocopy", "parent", "length", "identity", "similarity", "gaps", "score"]
+COLUMN_DEFS = ", ".join([
+    "retrocopy text PRIMARY KEY",
+    "parent text",
+    "length integer",
+    "identity real",
+    "similarity real",
+    "gaps integer",
+    "score real"
+])
+
+class AlignmentStore(object):
+
+    def __init__(self, db_fname):
+        '''
+        Open the store in db_fname, creating the table if needed
+        '''
+        self.db_fname = db_fname
+        self.conn = sqlite3.connect(db_fname)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(TABLE, COLUMN_DEFS))
+        self.conn.commit()
+
+    def add(self, rows):
+        '''
+        Add rows of COLUMNS, replacing any earlier rows for the same
+        retrocopies
+        '''
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                TABLE, ",".join(["?"]*len(COLUMNS))
+            ),
+            rows
+        )
+        self.conn.commit()
+
+    def get_retrocopies(self):
+        '''
+        The set of retrocopies with a stored alignment
+        '''
+        return set(r for r, in self.conn.execute("SELECT retrocopy FROM {}".format(TABLE)))
+
+    def fetch(self, retrocopies, columns):
+        '''
+        Dict of retrocopy -> tuple of columns, for the given retrocopies that
+        have a stored alignment
+        '''
+        return fetch_by_key(self.conn.cursor(), TABLE, "retrocopy", columns, retrocopies)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,160 @@
+'''
+Cache parsed annotation files (GTFs, repeat BEDs, ...) next to their source,
+so that scripts run repeatedly on the same annotation only parse it once.
+
+Each parsed result lives in its own directory, <source>.cache/<name>/, written
+by a save function and read back by a load function supplied by the caller
+(typically as .npy files opened memory-mapped, so a warm load costs little
+more than reading the metadata). A meta.json file in the directory records the
+source's size, mtime and SHA-1 digest along with a caller-supplied key (e.g. a
+format version, or the options the result was built with).
+
+A cached result is used when the key and size match and either the mtime
+matches or, if only the mtime has changed (e.g. the file was copied or
+touched), the content digest still matches. Results built with different
+keys are kept side by side.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile as tf
+import logging
+
+CACHE_VERSION = 1
+
+def hash_file(fname, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def get_source_info(fname):
+    st = os.stat(fname)
+    return {"size":st.st_size, "mtime":int(st.st_mtime)}
+
+def get_cache_dir(source_fname, name, key=None):
+    if key is not None:
+        key_hash = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        name = "{}.{}".format(name, key_hash[:12])
+    return os.path.join(source_fname + ".cache", name)
+
+def read_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "meta.json"), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_meta(cache_dir, source_info, digest, key):
+    meta = {
+        "version":CACHE_VERSION,
+        "source":source_info,
+        "sha1":digest,
+        "key":key
+    }
+    with open(os.path.join(cache_dir, "meta.json"), 'w') as out:
+        json.dump(meta, out)
+
+def cache_is_current(source_fname, cache_dir, key=None):
+    '''
+    Check whether the result cached in cache_dir was built from the current
+    contents of source_fname with the same key. Where only the mtime has
+    changed, the source is hashed, and the cache's recorded mtime updated if
+    the contents are unchanged.
+    '''
+    meta = read_meta(cache_dir)
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return False
+
+    # Round trip the key through JSON so that it compares like the stored one
+    if meta["key"] != json.loads(json.dumps(key)):
+        return False
+
+    source_info = get_source_info(source_fname)
+    if meta["source"]["size"] != source_info["size"]:
+        return False
+    if meta["source"]["mtime"] == source_info["mtime"]:
+        return True
+
+    logging.info("{} has a new mtime, checking its contents".format(source_fname))
+    if hash_file(source_fname) != meta["sha1"]:
+        return False
+
+    try:
+        write_meta(cache_dir, source_info, meta["sha1"], key)
+    except IOError:
+        pass
+    return True
+
+def load_cached(source_fname, name, build, save, load, key=None):
+    '''
+    Get a parsed result for source_fname: load(cache_dir) if the cached copy
+    is current, otherwise build(), which is then written with
+    save(result, cache_dir) for next time. If the cache cannot be written
+    (e.g. a read-only annotation directory), the built result is still
+    returned.
+    '''
+    cache_dir = get_cache_dir(source_fname, name, key)
+
+    if cache_is_current(source_fname, cache_dir, key):
+        try:
+            return load(cache_dir)
+        except (IOError, ValueError, KeyError):
+            logging.warning("Could not load cached {}, rebuilding".format(cache_dir))
+
+    source_info = get_source_info(source_fname)
+    result = build()
+
+    try:
+        parent_dir = os.path.dirname(cache_dir)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+
+        # Write to a temporary directory first so that other processes never
+        # see a partially written cache
+        tmp_dir = tf.mkdtemp(dir=parent_dir)
+        try:
+            save(result, tmp_dir)
+            write_meta(tmp_dir, source_info, hash_file(source_fname), key)
+            if os.path.isdir(cache_dir):
+                shutil.rmtree(cache_dir)
+            os.rename(tmp_dir, cache_dir)
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+    except (IOError, OSError):
+        logging.warning("Could not write cache {}".format(cache_dir))
+
+    return result
+
+def clear_cache(source_fname, name, key=None):
+    cache_dir = get_cache_dir(source_fname, name, key)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+def benchmark_cache(source_fname, name, build, save, load, key=None, use=None, repeats=3):
+    '''
+    Time a cold load (parse and write the cache) against warm loads from the
+    cache. use(result), if given, is applied to each result and included in
+    the timings, e.g. to build the dicts a script actually works with.
+    '''
+    def timed_load():
+        t0 = time.time()
+        result = load_cached(source_fname, name, build, save, load, key)
+        if use is not None:
+            use(result)
+        return time.time() - t0
+
+    clear_cache(source_fname, name, key)
+    cold = timed_load()
+    warm = [timed_load() for _ in range(repeats)]
+
+    print("{}: cold {:.3f}s, warm {:.3f}s (best of {}), {:.0f}x".format(
+        source_fname, cold, min(warm), repeats, cold/max(min(warm), 1e-6)
+    ))
+
+    return cold, warm
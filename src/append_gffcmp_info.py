@@ -6,9 +6,10 @@ file to add the biotype of matching reference transcripts.
 '''
 
 import sys
-import re
 import logging
 
+from gtf_tables import load_gtf
+
 logging.basicConfig(level=logging.INFO)
 
 def get_tmap_dict(tmap_fname):
@@ -25,31 +26,12 @@ def get_tmap_dict(tmap_fname):
     logging.info("Done")
     return tmap_dict
 
-def get_attr_dict(attr_str):
-    return dict(
-        map(
-            lambda y: re.split(' *"', y)[0:-1],
-            map(
-                lambda x: x.strip(),
-                attr_str.split(";")[0:-1]
-            )
-        )
-    )
-
 def get_gtf_dict(gtf_fname):
     logging.info("Parsing GTF file")
-    gtf_dict = {}
-    with open(gtf_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
-
-            line_list = line.strip().split("\t")
-
-            if line_list[2] == "transcript":
-                attr_str = line_list[-1]
-                attr_dict = get_attr_dict(attr_str)
-                gtf_dict[attr_dict["transcript_id"]] = attr_dict["transcript_biotype"]
+    gtf = load_gtf(gtf_fname)
+    gtf_dict = dict(zip(
+        gtf.get_column("transcript_id"), gtf.get_column("transcript_biotype")
+    ))
     logging.info("Done")
     return gtf_dict
 
@@ -0,0 +1,182 @@
+'''
+Read blastn tabular output (-outfmt 6) into a typed NumPy record array in a
+single streaming pass, cached next to the file by annotation_cache.py so that
+later runs (and other scripts reading the same output) memory-map the parsed
+hits instead of parsing the file again.
+
+Each hit is one record of BLAST_DTYPE, holding the 12 standard columns with
+query and subject names interned as int32 codes into a shared string pool,
+plus the byte offset and length of its line, so the original lines can be
+written back out unchanged:
+
+    blast_hits = load_blast("retrocopies_vs_genome.blastn")
+    keep = blast_hits.hits["percent_identity"] > 90
+    blast_hits.write_lines(np.flatnonzero(keep), "filtered.blastn")
+
+Where the whole table is not needed, iter_blast_chunks yields the hits a
+chunk at a time.
+'''
+
+import os
+import mmap
+import logging
+
+import numpy as np
+
+from annotation_cache import load_cached
+
+BLAST_VERSION = 1
+CHUNK_SIZE = 100000
+
+BLAST_DTYPE = np.dtype([
+    ("query", np.int32),
+    ("subject", np.int32),
+    ("percent_identity", np.float64),
+    ("aln_length", np.int32),
+    ("mismatches", np.int32),
+    ("gap_opens", np.int32),
+    ("query_start", np.int32),
+    ("query_end", np.int32),
+    ("subject_start", np.int64),
+    ("subject_end", np.int64),
+    ("evalue", np.float64),
+    ("bit_score", np.float64),
+    ("offset", np.int64),
+    ("line_length", np.int32)
+])
+
+# The outfmt 6 columns, in file order
+COLUMNS = [name for name in BLAST_DTYPE.names if name not in ("offset", "line_length")]
+
+class BlastHits(object):
+
+    def __init__(self, blast_fname, strings, hits):
+        '''
+        blast_fname is the blastn output the hits were read from, strings the
+        string pool and hits a record array of BLAST_DTYPE.
+        '''
+        self.blast_fname = blast_fname
+        self.strings = strings
+        self.hits = hits
+
+    def __len__(self):
+        return len(self.hits)
+
+    def get_codes(self):
+        '''
+        Dict of string -> code in the string pool
+        '''
+        return {s:i for i,s in enumerate(self.strings)}
+
+    def get_names(self, field, idx=None):
+        '''
+        The "query" or "subject" names of the hits (or of the hits at idx) as
+        a list of strings
+        '''
+        codes = self.hits[field] if idx is None else self.hits[field][idx]
+        strings = self.strings
+        return [strings[c] for c in codes.tolist()]
+
+    def write_lines(self, idx, output_fname):
+        '''
+        Write the original lines of the hits at idx, in that order
+        '''
+        offsets = self.hits["offset"][idx].tolist()
+        lengths = self.hits["line_length"][idx].tolist()
+
+        with open(self.blast_fname, 'rb') as f, open(output_fname, 'w') as out:
+            if os.path.getsize(self.blast_fname) == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset, length in zip(offsets, lengths):
+                    out.write(data[offset:offset + length])
+            finally:
+                data.close()
+
+    def save(self, hits_dir):
+        np.save(os.path.join(hits_dir, "hits.npy"), self.hits)
+        np.save(
+            os.path.join(hits_dir, "strings.npy"),
+            np.frombuffer("\0".join(self.strings), dtype=np.uint8)
+        )
+
+    @classmethod
+    def load(cls, blast_fname, hits_dir, mmap_mode='r'):
+        '''
+        Load hits written by save, memory-mapped.
+        '''
+        hits = np.load(os.path.join(hits_dir, "hits.npy"), mmap_mode=mmap_mode)
+        strings = np.load(os.path.join(hits_dir, "strings.npy")).tostring().split("\0")
+        return cls(blast_fname, strings, hits)
+
+def iter_blast_chunks(blast_fname, strings=None, chunk_size=CHUNK_SIZE):
+    '''
+    Parse blastn tabular output, yielding record arrays of BLAST_DTYPE of up
+    to chunk_size hits. Query and subject names are interned into the list
+    strings, which is extended in place. Blank and comment lines are skipped.
+    '''
+    if strings is None:
+        strings = []
+    string_idx = {s:i for i,s in enumerate(strings)}
+
+    def intern(s):
+        try:
+            return string_idx[s]
+        except KeyError:
+            string_idx[s] = len(strings)
+            strings.append(s)
+            return string_idx[s]
+
+    rows = []
+    offset = 0
+    with open(blast_fname, 'r') as f:
+        for line in f:
+            line_list = line.split()
+            if line_list != [] and line_list[0][0] != "#":
+                rows.append((
+                    intern(line_list[0]), intern(line_list[1]),
+                    float(line_list[2]), int(line_list[3]), int(line_list[4]),
+                    int(line_list[5]), int(line_list[6]), int(line_list[7]),
+                    int(line_list[8]), int(line_list[9]),
+                    float(line_list[10]), float(line_list[11]),
+                    offset, len(line)
+                ))
+                if len(rows) >= chunk_size:
+                    yield np.array(rows, dtype=BLAST_DTYPE)
+                    rows = []
+            offset += len(line)
+
+    if rows != []:
+        yield np.array(rows, dtype=BLAST_DTYPE)
+
+def read_blast(blast_fname, chunk_size=CHUNK_SIZE):
+    '''
+    Parse blastn tabular output into a BlastHits
+    '''
+    logging.info("Parsing {}".format(blast_fname))
+
+    strings = []
+    chunks = []
+    for chunk in iter_blast_chunks(blast_fname, strings, chunk_size):
+        chunks.append(chunk)
+        logging.info("{} lines parsed".format(sum(len(c) for c in chunks)))
+
+    hits = np.concatenate(chunks) if chunks != [] else np.zeros(0, dtype=BLAST_DTYPE)
+    return BlastHits(blast_fname, strings, hits)
+
+def load_blast(blast_fname, use_cache=True):
+    '''
+    Get the BlastHits for blastn tabular output, from the annotation cache if
+    it is up to date, otherwise by parsing the file and (re)writing the cache.
+    '''
+    if not use_cache:
+        return read_blast(blast_fname)
+
+    return load_cached(
+        blast_fname, "blast_hits",
+        lambda: read_blast(blast_fname),
+        lambda blast_hits, hits_dir: blast_hits.save(hits_dir),
+        lambda hits_dir: BlastHits.load(blast_fname, hits_dir),
+        key=BLAST_VERSION
+    )
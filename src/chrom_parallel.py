@@ -0,0 +1,137 @@
+'''
+Run per-chromosome work over chromosome-grouped files (sorted BEDs, bedtools
+output, UCSC tables) in parallel.
+
+The input's chromosomes are located by byte offset with chrom_stream.py, and
+each worker process reads only the lines of the chromosomes it is given,
+passes them to a function that yields output lines, and writes those to a
+temporary file. The temporary files are then concatenated in the order the
+chromosomes appear in the input, so the output is the same as from running
+the function over each chromosome in turn, or with sort_chroms in
+lexicographic order of chromosome name, so that a function that sorts each
+chromosome's output gives the same file as sort -k1,1 -k2,2n over the whole
+output. Chromosomes are handed out largest first, to keep the workers evenly
+loaded.
+
+Scripts expose this as a --threads option, e.g.
+
+    run_by_chrom(
+        intersect_fname, output_fname,
+        functools.partial(classify_lines, min_percent_overlap=50),
+        threads=args.threads
+    )
+'''
+
+import os
+import shutil
+import tempfile as tf
+import multiprocessing as mp
+import Queue
+import traceback
+import logging
+
+from chrom_stream import get_chrom_offsets, read_chrom_lines
+
+class ChromProcess(mp.Process):
+    '''
+    Worker that takes (chromosome number, chromosome) jobs from job_queue
+    until it receives "STOP", writing process_lines' output for each to a
+    file in tmp_dir and putting (chromosome number, file name) on
+    results_queue, or (chromosome number, None) if it failed.
+    '''
+
+    def __init__(
+            self, job_queue, results_queue, in_fname, chrom_offsets,
+            process_lines, tmp_dir):
+        mp.Process.__init__(self)
+        self.job_queue = job_queue
+        self.results_queue = results_queue
+        self.in_fname = in_fname
+        self.chrom_offsets = chrom_offsets
+        self.process_lines = process_lines
+        self.tmp_dir = tmp_dir
+
+    def run(self):
+        while True:
+            job = self.job_queue.get()
+            if job == "STOP":
+                break
+
+            i, chrom = job
+            out_fname = os.path.join(self.tmp_dir, "{}.out".format(i))
+            try:
+                with open(out_fname, 'w') as out:
+                    lines = read_chrom_lines(self.in_fname, self.chrom_offsets, chrom)
+                    for line in self.process_lines(lines):
+                        out.write(line + "\n")
+            except Exception:
+                logging.error("Processing {} failed:\n{}".format(
+                    chrom, traceback.format_exc()
+                ))
+                self.results_queue.put((i, None))
+                continue
+
+            self.results_queue.put((i, out_fname))
+
+def run_by_chrom(
+        in_fname, output_fname, process_lines, threads=1, chrom_field=0,
+        sort_chroms=False):
+    '''
+    Apply process_lines to the lines of each chromosome of in_fname (which
+    must be grouped by chromosome, in column chrom_field) using up to
+    threads worker processes, and write the lines it yields (without
+    newlines) to output_fname, chromosomes in input order, or sorted by name
+    with sort_chroms.
+    '''
+    chrom_offsets = get_chrom_offsets(in_fname, chrom_field=chrom_field)
+    chroms = sorted(chrom_offsets, key=lambda c: chrom_offsets[c][0])
+    sizes = [chrom_offsets[c][1] - chrom_offsets[c][0] for c in chroms]
+
+    tmp_dir = tf.mkdtemp(dir=os.path.dirname(os.path.abspath(output_fname)))
+    workers = []
+    try:
+        job_queue = mp.Queue()
+        results_queue = mp.Queue()
+        for _ in range(max(min(threads, len(chroms)), 1)):
+            worker = ChromProcess(
+                job_queue, results_queue, in_fname, chrom_offsets,
+                process_lines, tmp_dir
+            )
+            worker.start()
+            workers.append(worker)
+
+        for i in sorted(range(len(chroms)), key=lambda i: sizes[i], reverse=True):
+            job_queue.put((i, chroms[i]))
+        for _ in workers:
+            job_queue.put("STOP")
+
+        out_fnames = {}
+        while len(out_fnames) < len(chroms):
+            try:
+                i, out_fname = results_queue.get(timeout=1)
+            except Queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    raise RuntimeError("Workers exited before all chromosomes were processed")
+                continue
+
+            if out_fname is None:
+                raise RuntimeError("Processing {} in {} failed".format(chroms[i], in_fname))
+            out_fnames[i] = out_fname
+            logging.info("Processed {} ({}/{})".format(chroms[i], len(out_fnames), len(chroms)))
+
+        for worker in workers:
+            worker.join()
+
+        order = range(len(chroms))
+        if sort_chroms:
+            order.sort(key=lambda i: chroms[i])
+
+        with open(output_fname, 'w') as out:
+            for i in order:
+                with open(out_fnames[i], 'r') as f:
+                    shutil.copyfileobj(f, out)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,122 @@
+'''
+Read chromosome-grouped text files (sorted BEDs, bedtools output) one
+chromosome at a time, so that genome-wide files can be processed with a
+working set no bigger than the largest chromosome.
+
+get_chrom_offsets records the byte range of each chromosome in a file, cached
+next to it by annotation_cache.py, after which read_chrom_lines can seek
+straight to any chromosome. iter_chrom_groups streams a file as consecutive
+per-chromosome groups of lines.
+'''
+
+import os
+import json
+from itertools import groupby
+
+from annotation_cache import load_cached
+
+OFFSETS_VERSION = 1
+
+def get_line_chrom(line, chrom_field=0):
+    return line.split(None, chrom_field + 1)[chrom_field]
+
+def is_data_line(line):
+    return line.strip() != "" and not line.startswith(("#", "track", "browser"))
+
+def build_chrom_offsets(fname, chrom_field=0):
+    '''
+    One pass over fname, recording the (start, end) byte offsets of each
+    chromosome's lines, in file order, where the chromosome is in column
+    chrom_field. Raises ValueError if the lines of a chromosome are not
+    contiguous.
+    '''
+    offsets = []
+    seen = set()
+    chrom = None
+    offset = 0
+
+    with open(fname, 'rb') as f:
+        for line in f:
+            if is_data_line(line):
+                line_chrom = get_line_chrom(line, chrom_field)
+                if line_chrom != chrom:
+                    if line_chrom in seen:
+                        raise ValueError(
+                            "{} is not grouped by chromosome ({} appears twice)"
+                            .format(fname, line_chrom)
+                        )
+                    if chrom is not None:
+                        offsets[-1][2] = offset
+                    seen.add(line_chrom)
+                    offsets.append([line_chrom, offset, None])
+                    chrom = line_chrom
+            offset += len(line)
+
+    if chrom is not None:
+        offsets[-1][2] = offset
+
+    return [tuple(o) for o in offsets]
+
+def save_chrom_offsets(offsets, cache_dir):
+    with open(os.path.join(cache_dir, "offsets.json"), 'w') as out:
+        json.dump(offsets, out)
+
+def load_chrom_offsets(cache_dir):
+    with open(os.path.join(cache_dir, "offsets.json"), 'r') as f:
+        return [(str(c), s, e) for c, s, e in json.load(f)]
+
+def get_chrom_offsets(fname, chrom_field=0, use_cache=True):
+    '''
+    Dict of chromosome: (start, end) byte offsets of its lines in fname,
+    from the cache if it is up to date.
+    '''
+    if use_cache:
+        offsets = load_cached(
+            fname, "chrom_offsets",
+            lambda: build_chrom_offsets(fname, chrom_field),
+            save_chrom_offsets, load_chrom_offsets,
+            key=[OFFSETS_VERSION, chrom_field]
+        )
+    else:
+        offsets = build_chrom_offsets(fname, chrom_field)
+
+    return {c:(s, e) for c, s, e in offsets}
+
+def read_chrom_lines(fname, chrom_offsets, chrom):
+    '''
+    Yield the lines of fname on chrom, using offsets from get_chrom_offsets.
+    '''
+    try:
+        start, end = chrom_offsets[chrom]
+    except KeyError:
+        return
+
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        for line in f:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            if is_data_line(line):
+                yield line
+
+def iter_chrom_groups(fname, chrom_field=0):
+    '''
+    Stream fname as (chromosome, lines) pairs, one per run of lines on the
+    same chromosome, where lines is an iterator to be consumed before moving
+    on to the next pair. Raises ValueError if a chromosome comes up again
+    after another, i.e. the file is not grouped by chromosome.
+    '''
+    seen = set()
+    with open(fname, 'r') as f:
+        for chrom, lines in groupby(
+                (l for l in f if is_data_line(l)),
+                lambda l: get_line_chrom(l, chrom_field)):
+            if chrom in seen:
+                raise ValueError(
+                    "{} is not grouped by chromosome ({} appears twice)"
+                    .format(fname, chrom)
+                )
+            seen.add(chrom)
+            yield chrom, lines
@@ -13,10 +13,13 @@ e.g., LINE:80,Simple_repeat:15
 
 import sys
 import re
-import subprocess
 from math import *
+from functools import partial
 import argparse
 
+from chrom_parallel import run_by_chrom
+from progress import Progress
+
 class Indel(object):
 	def __init__(self, start, end, strand, min_percent_overlap):
 		self.length = int(end) - int(start)
@@ -66,6 +69,27 @@ class Indel(object):
 
 		return intersect_list, classification
 
+def add_intersect_line(intersect_dict, line, min_percent_overlap):
+	line_list = re.split("\s+", line.strip())
+	indel_name = " ".join(line_list[0:4])
+	intersect_str = " ".join(line_list[6:10])
+	try:
+		intersect_dict[indel_name].add_intersection(
+			intersect_str,
+			int(line_list[-1])
+		)
+	except KeyError:
+		intersect_dict[indel_name] = Indel(
+									line_list[1],
+									line_list[2],
+									line_list[5],
+									min_percent_overlap
+		)
+		intersect_dict[indel_name].add_intersection(
+			intersect_str,
+			int(line_list[-1])
+		)
+
 def intersect_file_to_dict(intersect_fname, min_percent_overlap):
 	'''
 	Keys are a string with chromosome, start, end, name for an indel.
@@ -79,70 +103,56 @@ def intersect_file_to_dict(intersect_fname, min_percent_overlap):
 
 	with open(intersect_fname, 'r') as f:
 
-		print('['+' '*50+']'),
-		print('\r'),
-		num_lines = int(
-			subprocess.check_output(
-				"wc -l %s | awk '{print $1}'" % intersect_fname,
-				shell=True
-			)
-		)
-		percent = 0.0
+		progress = Progress.for_file("Processing intersection file", intersect_fname)
 
-		for i,line in enumerate(f):
-			line_list = re.split("\s+", line.strip())
-			indel_name = " ".join(line_list[0:4])
-			intersect_str = " ".join(line_list[6:10])
-			try:
-				intersect_dict[indel_name].add_intersection(
-					intersect_str,
-					int(line_list[-1])
-				)
-			except KeyError:
-				intersect_dict[indel_name] = Indel(
-											line_list[1],
-											line_list[2],
-											line_list[5],
-											min_percent_overlap
-				)
-				intersect_dict[indel_name].add_intersection(
-					intersect_str,
-					int(line_list[-1])
-				)
-
-			percent = 100.0*(float(i)/num_lines)
-			num_bars = int(floor(percent/2))
-			print('\r'),
-			print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-			sys.stdout.flush()
-
-	print("\nDone")
+		for line in f:
+			add_intersect_line(intersect_dict, line, min_percent_overlap)
+			progress.update(len(line))
+
+		progress.finish()
+
+	print("Done")
 	return intersect_dict
 
+def get_output_line(indel_name, indel):
+	out_list = [
+		re.sub(" ", "\t", indel_name),
+		"0",
+		indel.strand
+	]
+
+	intersect_list, classification = indel.get_intersect_list()
+
+	intersect_str = ",".join(
+		[
+			"{}:{}".format(elem_type, percent) \
+			for percent, elem_type in intersect_list
+		]
+	)
+	out_list += [classification, intersect_str]
+	return "\t".join(out_list)
+
+def classify_chrom(lines, min_percent_overlap):
+	'''
+	Classify the indels in the intersect lines of one chromosome, returning
+	their output lines.
+	'''
+	intersect_dict = {}
+	for line in lines:
+		add_intersect_line(intersect_dict, line, min_percent_overlap)
+
+	return [
+		get_output_line(indel_name, indel) \
+		for indel_name, indel in intersect_dict.iteritems()
+	]
+
 def write_output(intersect_dict, output_fname):
 	print("Writing output file ... "),
 	sys.stdout.flush()
 
 	with open(output_fname, 'wa') as f:
 		for indel_name in intersect_dict.keys():
-			out_list = [
-				re.sub(" ", "\t", indel_name),
-				"0",
-				intersect_dict[indel_name].strand
-			]
-
-			intersect_list, classification \
-				= intersect_dict[indel_name].get_intersect_list()
-
-			intersect_str = ",".join(
-				[
-					"{}:{}".format(elem_type, percent) \
-					for percent, elem_type in intersect_list
-				]
-			)
-			out_list += [classification, intersect_str]
-			out_str = "\t".join(out_list) + "\n"
-			f.write(out_str)
+			f.write(get_output_line(indel_name, intersect_dict[indel_name]) + "\n")
 
 	print("Done")
 
@@ -151,13 +161,24 @@ if __name__ == "__main__":
 	parser.add_argument("intersect_fname")
 	parser.add_argument("output_fname")
 	parser.add_argument("min_percent_overlap")
+	parser.add_argument("--threads", type=int, default=1,
+		help="Classify chromosomes in parallel with this many processes " +
+			"(the intersect must be sorted by chromosome)")
 	args = parser.parse_args()
 
-	intersect_dict = intersect_file_to_dict(
-		args.intersect_fname,
-		args.min_percent_overlap
-	)
-	write_output(intersect_dict, args.output_fname)
+	if args.threads > 1:
+		run_by_chrom(
+			args.intersect_fname,
+			args.output_fname,
+			partial(classify_chrom, min_percent_overlap=args.min_percent_overlap),
+			threads=args.threads
+		)
+	else:
+		intersect_dict = intersect_file_to_dict(
+			args.intersect_fname,
+			args.min_percent_overlap
+		)
+		write_output(intersect_dict, args.output_fname)
 
 
 
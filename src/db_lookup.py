@@ -0,0 +1,31 @@
+'''
+Bulk lookups against the transcript/retrocopy SQLite databases. Rather than
+one SELECT per row needed, rows are fetched for all distinct keys at once in
+batched IN (...) queries against an indexed key column, so the number of
+queries depends on the number of distinct keys, not on how often each is
+used.
+'''
+
+# SQLite's default limit on the number of ? parameters in one query is 999
+MAX_BATCH_SIZE = 999
+
+def fetch_by_key(cur, table, key_column, columns, keys, batch_size=500):
+    '''
+    Fetch the given columns of every row of table whose key_column is in
+    keys. Returns a dict mapping each key found to a tuple of its columns;
+    keys with no row are left out.
+    '''
+    keys = list(set(keys))
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    select = ", ".join([key_column] + list(columns))
+
+    rows = {}
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i+batch_size]
+        query = "SELECT {} FROM {} WHERE {} IN ({})".format(
+            select, table, key_column, ",".join(["?"]*len(batch))
+        )
+        for row in cur.execute(query, batch):
+            rows[row[0]] = row[1:]
+
+    return rows
@@ -4,12 +4,20 @@ respective parent transcripts. Alignment score is calculated as % of the
 retrocopy that matches the parent, i.e.,
 (similarity*match_length)/retrocopy_length
 Also show the alignment scores for retrocopies aligned to random transcripts.
+
+Scores are read from a directory of matcher output files or an alignment
+results database (from align_retrocopies_parents.py), or, if "-" is given in
+place of either, computed in process with local_align.py from the
+retrocopy and parent FASTA files (indexed with index_fasta.py). For the
+random alignments, this aligns the given number of retrocopies to shuffled
+parents without writing any files.
 '''
 
 import os
 import sqlite3
 import linecache
 import re
+from random import shuffle
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -17,6 +25,14 @@ import matplotlib.patches as mpatches
 from scipy.stats import gaussian_kde
 import numpy as np
 
+from db_lookup import fetch_by_key
+from alignment_store import AlignmentStore
+from fasta_reader import IndexedFasta
+from local_align import align_pairs
+
+# Given in place of an alignment directory to align in process
+IN_PROCESS = "-"
+
 def parse_alignment_file(aln_path):
     length_line = linecache.getline(aln_path, 21)
     sim_line = linecache.getline(aln_path, 23)
@@ -27,52 +43,145 @@ def parse_alignment_file(aln_path):
     return length, similarity
 
 
+def get_pair_scores(pairs, lengths, retrocopy_fa, parent_fa):
+    '''
+    Alignment scores of (retrocopy, parent) pairs, aligned in process
+    '''
+    results = align_pairs([
+        (retrocopy_fa.get_seq(rc), parent_fa.get_seq(parent)) \
+            for rc, parent in pairs
+    ])
+    return list(results["similarity"]*results["length"]/np.array(lengths, dtype=float))
+
+def get_stored_scores(results_db, lengths):
+    '''
+    Alignment scores of the retrocopies in the lengths dict that have results
+    in an alignment results database
+    '''
+    store = AlignmentStore(results_db)
+    rows = store.fetch(lengths.keys(), ["length", "similarity"])
+    store.close()
+    return [
+        (similarity*aln_length)/lengths[rc] \
+            for rc, (aln_length, similarity) in rows.iteritems()
+    ]
+
+def get_random_pairs(cur, num_pairs):
+    '''
+    num_pairs retrocopies paired with shuffled parents, reshuffling as many
+    times as needed
+    '''
+    retrocopy_parents = cur.execute("SELECT * FROM retrogenes_parents").fetchall()
+    retrocopies = [r for r, p in retrocopy_parents if p is not None]
+    parents = [p for r, p in retrocopy_parents if p is not None]
+
+    random_pairs = []
+    while len(random_pairs) < num_pairs and parents != []:
+        shuffle(retrocopies)
+        shuffle(parents)
+        random_pairs += zip(retrocopies, parents)
+
+    return random_pairs[:num_pairs]
+
 def get_plot_data(
         input_fname_list, label_list,
-        alignment_dir, random_alignment_dir, retrocopy_parent_db
+        alignment_dir, random_alignment_dir, retrocopy_parent_db,
+        retrocopy_fasta=None, parent_fasta=None, num_random_pairs=1000
     ):
     assert "RANDOM_ALN" not in label_list, "RANDOM_ALN cannot be included as a label"
 
     plot_data = {l:[] for l in label_list + ["RANDOM_ALN"]}
 
-    aligned_retrocopies = os.listdir(alignment_dir)
+    conn = sqlite3.connect(retrocopy_parent_db)
+    cur = conn.cursor()
 
-    for l, fn in zip(label_list, input_fname_list):
-        with open(fn, 'r') as f:
-            for line in f:
-                line_list = line.strip().split()
-                retrocopy_fname = line_list[3] + ".matcher"
-                if retrocopy_fname not in aligned_retrocopies:
-                    continue
-                else:
-                    aln_path = os.path.join(alignment_dir, retrocopy_fname)
+    if IN_PROCESS in (alignment_dir, random_alignment_dir):
+        retrocopy_fa = IndexedFasta(retrocopy_fasta)
+        parent_fa = IndexedFasta(parent_fasta)
 
-                length = int(line_list[2]) - int(line_list[1])
-                aln_length, similarity = parse_alignment_file(aln_path)
+    if alignment_dir == IN_PROCESS:
+        for l, fn in zip(label_list, input_fname_list):
+            with open(fn, 'r') as f:
+                lengths = {}
+                for line in f:
+                    line_list = line.strip().split()
+                    lengths[line_list[3]] = int(line_list[2]) - int(line_list[1])
 
-                aln_score = (similarity*aln_length)/length
+            parents = fetch_by_key(
+                cur, "retrogenes_parents", "retrogene", ["parents"], lengths.keys()
+            )
+            pairs = [
+                (rc, parents[rc][0]) for rc in lengths \
+                    if rc in parents and parents[rc][0] in parent_fa \
+                        and rc in retrocopy_fa
+            ]
+            plot_data[l] = get_pair_scores(
+                pairs, [lengths[rc] for rc, _ in pairs], retrocopy_fa, parent_fa
+            )
+    elif os.path.isfile(alignment_dir):
+        for l, fn in zip(label_list, input_fname_list):
+            with open(fn, 'r') as f:
+                lengths = {}
+                for line in f:
+                    line_list = line.strip().split()
+                    lengths[line_list[3]] = int(line_list[2]) - int(line_list[1])
 
-                plot_data[l].append(aln_score)
+            plot_data[l] = get_stored_scores(alignment_dir, lengths)
+    else:
+        aligned_retrocopies = set(os.listdir(alignment_dir))
 
-    random_alignments = os.listdir(random_alignment_dir)
-    random_retrocopies = [".".join(f.split(".")[0:-1]) for f in random_alignments]
-    random_aln_paths = [os.path.join(random_alignment_dir, f) for f in random_alignments]
+        for l, fn in zip(label_list, input_fname_list):
+            with open(fn, 'r') as f:
+                for line in f:
+                    line_list = line.strip().split()
+                    retrocopy_fname = line_list[3] + ".matcher"
+                    if retrocopy_fname not in aligned_retrocopies:
+                        continue
+                    else:
+                        aln_path = os.path.join(alignment_dir, retrocopy_fname)
 
-    conn = sqlite3.connect(retrocopy_parent_db)
-    cur = conn.cursor()
-    rows = cur.execute(
-        "SELECT retrogene_id, end_coord-start_coord \
-        FROM retrogenes \
-        WHERE retrogene_id IN ({})"\
-            .format(",".join(["?"]*len(random_retrocopies))),
-        random_retrocopies
+                    length = int(line_list[2]) - int(line_list[1])
+                    aln_length, similarity = parse_alignment_file(aln_path)
+
+                    aln_score = (similarity*aln_length)/length
+
+                    plot_data[l].append(aln_score)
+
+    if random_alignment_dir == IN_PROCESS:
+        random_pairs = [
+            (rc, parent) for rc, parent in get_random_pairs(cur, num_random_pairs) \
+                if parent in parent_fa and rc in retrocopy_fa
+        ]
+        random_retrocopies = [rc for rc, _ in random_pairs]
+    elif os.path.isfile(random_alignment_dir):
+        store = AlignmentStore(random_alignment_dir)
+        random_retrocopies = list(store.get_retrocopies())
+        store.close()
+    else:
+        random_alignments = os.listdir(random_alignment_dir)
+        random_retrocopies = [".".join(f.split(".")[0:-1]) for f in random_alignments]
+        random_aln_paths = [os.path.join(random_alignment_dir, f) for f in random_alignments]
+
+    length_dict = fetch_by_key(
+        cur, "retrogenes", "retrogene_id", ["end_coord-start_coord"], random_retrocopies
     )
-    length_dict = dict(rows)
+    conn.close()
 
-    for rand_aln_path, rand_rc in zip(random_aln_paths, random_retrocopies):
-        aln_length, similarity = parse_alignment_file(rand_aln_path)
-        aln_score = (similarity*aln_length)/length_dict[rand_rc]
-        plot_data["RANDOM_ALN"].append(aln_score)
+    if random_alignment_dir == IN_PROCESS:
+        plot_data["RANDOM_ALN"] = get_pair_scores(
+            random_pairs, [length_dict[rc][0] for rc in random_retrocopies],
+            retrocopy_fa, parent_fa
+        )
+    elif os.path.isfile(random_alignment_dir):
+        plot_data["RANDOM_ALN"] = get_stored_scores(
+            random_alignment_dir,
+            {rc:length_dict[rc][0] for rc in random_retrocopies}
+        )
+    else:
+        for rand_aln_path, rand_rc in zip(random_aln_paths, random_retrocopies):
+            aln_length, similarity = parse_alignment_file(rand_aln_path)
+            aln_score = (similarity*aln_length)/length_dict[rand_rc][0]
+            plot_data["RANDOM_ALN"].append(aln_score)
 
     return plot_data
 
@@ -121,16 +230,32 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--inputFname", action="append", help="BED of retrocopies")
     parser.add_argument("-l", "--label", action="append")
     parser.add_argument("-c", "--color", action="append")
-    parser.add_argument("alignment_dir")
-    parser.add_argument("random_alignment_dir")
+    parser.add_argument("alignment_dir",
+        help="Directory of matcher files or alignment results database, " +
+            "or - to align in process")
+    parser.add_argument("random_alignment_dir",
+        help="Directory of matcher files or alignment results database " +
+            "for random pairs, or - to align random pairs in process")
     parser.add_argument("retrocopy_parent_db")
     parser.add_argument("plot_title")
     parser.add_argument("img_fname")
+    parser.add_argument("--retrocopyFasta",
+        help="FASTA of retrocopy sequences, for aligning in process")
+    parser.add_argument("--parentFasta",
+        help="FASTA of parent sequences, for aligning in process")
+    parser.add_argument("--randomPairs", type=int, default=1000,
+        help="Number of random pairs to align in process (default 1000)")
     args = parser.parse_args()
 
+    if IN_PROCESS in (args.alignment_dir, args.random_alignment_dir) and \
+            (args.retrocopyFasta is None or args.parentFasta is None):
+        parser.error("--retrocopyFasta and --parentFasta are needed to align in process")
+
     plot_data = get_plot_data(
         args.inputFname, args.label,
-        args.alignment_dir, args.random_alignment_dir, args.retrocopy_parent_db
+        args.alignment_dir, args.random_alignment_dir, args.retrocopy_parent_db,
+        retrocopy_fasta=args.retrocopyFasta, parent_fasta=args.parentFasta,
+        num_random_pairs=args.randomPairs
     )
 
     draw_density_plot(
@@ -0,0 +1,126 @@
+'''
+Random access to the sequences of a FASTA file by name, using a faidx-style
+index (<fasta>.fai, as written by index_fasta.py or samtools faidx).
+
+The FASTA file is memory-mapped, and each sequence is sliced out of it using
+the byte offset and line wrapping recorded in the index, so a lookup costs
+the same however far into the file the sequence is:
+
+    fasta = IndexedFasta("retrocopies.fa")
+    fa_str = fasta.get_fasta("retrocopy_1")
+    seq = fasta.get_seq("chr1", 1000, 2000)
+'''
+
+import os
+import mmap
+import logging
+
+from index_fasta import index_fasta, write_fai
+
+def read_fai(fai_fname):
+    '''
+    Read a .fai file to a dict of name -> (length, offset, line bases,
+    line width). Raises ValueError if the file is not a faidx index (such as
+    an old first:last:name .idx file).
+    '''
+    fai = {}
+    with open(fai_fname, 'r') as f:
+        for i, line in enumerate(f):
+            line_list = line.rstrip("\r\n").split("\t")
+            try:
+                if len(line_list) != 5:
+                    raise ValueError
+                fai[line_list[0]] = tuple(int(x) for x in line_list[1:5])
+            except ValueError:
+                raise ValueError(
+                    "{} is not a faidx .fai index (line {}: {!r}); " \
+                        "write one with index_fasta.py".format(fai_fname, i + 1, line.rstrip())
+                )
+    return fai
+
+def is_stale(index_fname, fasta_fname):
+    '''
+    Whether index_fname is older than fasta_fname
+    '''
+    return os.path.getmtime(index_fname) < os.path.getmtime(fasta_fname)
+
+class IndexedFasta(object):
+
+    def __init__(self, fasta_fname, fai_fname=None):
+        '''
+        Open fasta_fname with its index fai_fname. By default this is
+        <fasta_fname>.fai, which is (re)built if it does not exist or is older
+        than fasta_fname. A given fai_fname is used as is, with a warning if
+        it is older than fasta_fname, as the offsets in it may be wrong.
+        '''
+        if fai_fname is None:
+            fai_fname = fasta_fname + ".fai"
+            if not os.path.exists(fai_fname) or is_stale(fai_fname, fasta_fname):
+                write_fai(index_fasta(fasta_fname)[1], fai_fname)
+        elif is_stale(fai_fname, fasta_fname):
+            logging.warning("{} is older than {}, its offsets may be out of date".format(
+                fai_fname, fasta_fname
+            ))
+
+        self.fasta_fname = fasta_fname
+        self.fai = read_fai(fai_fname)
+
+        self.fasta_file = open(fasta_fname, 'rb')
+        if os.path.getsize(fasta_fname) > 0:
+            self.data = mmap.mmap(self.fasta_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+    def __contains__(self, name):
+        return name in self.fai
+
+    def __len__(self):
+        return len(self.fai)
+
+    def get_length(self, name):
+        return self.fai[name][0]
+
+    def _byte_pos(self, name, pos):
+        '''
+        The offset in the file of base pos (0-based) of sequence name
+        '''
+        length, offset, line_bases, line_width = self.fai[name]
+        return offset + (pos // line_bases)*line_width + pos % line_bases
+
+    def get_seq(self, name, start=0, end=None):
+        '''
+        The sequence of name from start to end (0-based, half-open), without
+        line breaks. Raises KeyError if name is not in the index.
+        '''
+        length = self.fai[name][0]
+        if end is None or end > length:
+            end = length
+        start = max(start, 0)
+        if start >= end:
+            return ""
+
+        raw = self.data[self._byte_pos(name, start):self._byte_pos(name, end - 1) + 1]
+        return raw.replace("\n", "").replace("\r", "")
+
+    def get_fasta(self, name):
+        '''
+        The FASTA record for name, with its sequence wrapped as in the file
+        '''
+        length, offset, line_bases, line_width = self.fai[name]
+        if length == 0:
+            return ">{}\n".format(name)
+
+        raw = self.data[offset:self._byte_pos(name, length - 1) + 1]
+        return ">{}\n{}\n".format(name, raw)
+
+    def close(self):
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.fasta_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -3,23 +3,33 @@ Script to get the coordinates of indels inside repeats using
 rmskJoinedBaseline.txt type file. Extracts all the blocks and their types
 (aligned, indel, etc.), then finds gaps just using the aligned blocks, rather
 than relying on insertion/deletion starts and sizes
+
+By default each element's gaps are written as soon as its line is parsed, so
+memory use does not grow with the size of the table. Where the whole table is
+needed in memory, read_rmsk_blocks holds the blocks of all elements in flat
+NumPy arrays (RmskBlocks) rather than as per-block dicts.
 '''
 
 import sys
-import re
-import subprocess
 import argparse
+from array import array
 from math import *
 
+import numpy as np
+
+from chrom_parallel import run_by_chrom
+from progress import Progress
+
+# Block type codes
+BLOCK_TYPES = ["aligned", "insertion", "deletion", "indel"]
+ALIGNED, INSERTION, DELETION, INDEL = range(len(BLOCK_TYPES))
+
 def line_to_blocks(line_list):
 	'''
 	Parse a line from rmskJoinedBaseline.txt to produce a list of the element's
-	component blocks and their types
+	component blocks and their types, as (start, end, type code) tuples
 	'''
 
-	# Define a list of dictionaries, one dict per block
-	# Keys are start, end, type
-	# Options for type are ("aligned", "insertion", "deletion", "indel")
 	block_list = []
 	num_blocks = int(line_list[10])
 	# Get the block sizes and start positions
@@ -40,15 +50,15 @@ def line_to_blocks(line_list):
 	for i, (size, start) in enumerate(zip(block_lengths, block_starts)):
 		if i == 0:
 			# First block is always unaligned (maybe empty)
-			block_list.append({"start":element_start, "end":aligned_start, "type":"indel"})
+			block_list.append((element_start, aligned_start, INDEL))
 			current_coord = aligned_start
 		elif i == num_blocks-1:
 			# Last block is always unaligned (maybe empty)
-			block_list.append({"start":aligned_end, "end":element_end, "type":"indel"})
+			block_list.append((aligned_end, element_end, INDEL))
 		else:
 			if size > 0 and start >= 0:
 				# This is an aligned block
-				block_list.append({"start":current_coord, "end":current_coord+size, "type":"aligned"})
+				block_list.append((current_coord, current_coord+size, ALIGNED))
 				current_coord += size
 			elif size > 0 and start == -1:
 				# This is an indel or deletion.
@@ -59,9 +69,9 @@ def line_to_blocks(line_list):
 				indel_end = element_start + block_starts[i+1]
 				if current_coord == indel_end:
 					# Pure deletion with no insertion
-					block_list.append({"start":current_coord, "end":indel_end, "type":"deletion"})
+					block_list.append((current_coord, indel_end, DELETION))
 				else:
-					block_list.append({"start":current_coord, "end":indel_end, "type":"indel"})
+					block_list.append((current_coord, indel_end, INDEL))
 					current_coord = indel_end
 
 			elif size <= 0 and start == -1:
@@ -69,7 +79,7 @@ def line_to_blocks(line_list):
 				# We can't get the end of the block using the size of the block
 				# so we have to use relative start of the *next* block.
 				insert_end = element_start + block_starts[i+1]
-				block_list.append({"start":current_coord+size, "end":insert_end, "type":"insertion"})
+				block_list.append((current_coord+size, insert_end, INSERTION))
 				current_coord = insert_end
 
 	if len(block_list) != num_blocks:
@@ -82,152 +92,216 @@ def line_to_blocks(line_list):
 
 	return block_list
 
-def get_blocks(rmsk_input):
+def find_gaps(block_list):
 	'''
-	Parse a rmskJoinedBaseline.txt file produce a dict where keys are element
-	id numbers and values are lists of component blocks plus other information
-	about the element
+	Function to find the gaps using the positions of the aligned blocks.
+	Returns (start, end) tuples.
 	'''
-	blocks_by_element = {}
+	current_end = -1
+	gap_list = []
+	for start, end, block_type in block_list:
+		if block_type == ALIGNED:
+			if current_end != -1 and start-current_end > 1:
+				gap_list.append((current_end, start))
+			current_end = end
+	return gap_list
 
-	with open(rmsk_input, 'r') as f:
+def get_gap_line(chrom, start, end, name, strand):
+	return "\t".join([chrom, str(start), str(end), name, "0", strand])
 
-		num_lines = int(subprocess.check_output("wc -l %s | awk '{print $1}'" % rmsk_input, shell = True))
-		percent = 0.0
+def iter_line_gaps(lines):
+	'''
+	Parse rmskJoinedBaseline.txt lines one at a time, yielding BED lines for
+	the gaps in each element
+	'''
+	for line in lines:
+		line_list = line.split()
+		if line_list == []:
+			continue
 
-		print("Processing rmsk file")
-		print('['+' '*50+']'),
-		print('\r'),
+		name = line_list[4]+":"+line_list[-1]
+		for start, end in find_gaps(line_to_blocks(line_list)):
+			yield get_gap_line(line_list[1], start, end, name, line_list[6])
 
-		for i,line in enumerate(f):
-			line_list = re.split("\s+", line.strip())
+def gaps_chrom(lines):
+	'''
+	BED lines for the gaps in the elements on the rmsk lines of one chromosome
+	'''
+	return iter_line_gaps(lines)
 
-			id_num = int(line_list[-1])
+def stream_gaps(rmsk_input, output_fname):
+	'''
+	Write the gaps in each element as its line is read
+	'''
+	print("Processing rmsk file")
+	sys.stdout.flush()
 
-			blocks_by_element[id_num] = {
-				"chrom":line_list[1],
-				"start":int(line_list[2]),
-				"end":int(line_list[3]),
-				"name":line_list[4],
-				"strand":line_list[6],
-				"blocks":line_to_blocks(line_list)
-			}
+	progress = Progress.for_file("Processing rmsk file", rmsk_input)
 
-			percent = 100.0*(float(i)/num_lines)
-			num_bars = int(floor(percent/2))
-			print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-			print('\r'),
-			sys.stdout.flush()
+	def read_lines(f):
+		for line in f:
+			progress.update(len(line))
+			yield line
 
-		print('['+'|'*50+']')
-		print('\r'),
-		print("Done")
-		sys.stdout.flush()
+	with open(rmsk_input, 'r') as f, open(output_fname, 'w') as out:
+		for gap_line in iter_line_gaps(read_lines(f)):
+			out.write(gap_line + "\n")
 
-	return blocks_by_element
+	progress.finish()
+	print("Done")
 
-def find_gaps(block_list):
+class RmskBlocks(object):
 	'''
-	Function to find the gaps using the positions of the aligned blocks
+	The blocks of all elements of a rmskJoinedBaseline.txt file in flat
+	arrays. Elements are rows of id_num, chrom, name and strand (chrom and
+	name as codes into the strings list); the blocks of element i are rows
+	block_offsets[i] to block_offsets[i+1] of block_start, block_end and
+	block_type.
 	'''
-	current_start = -1
-	current_end = -1
-	gap_list = []
-	for block in block_list:
-		if block["type"] == "aligned":
-			if current_start == -1 and current_end == -1:
-				current_start = block["start"]
-				current_end = block["end"]
-			else:
-				if block["start"]-current_end > 1:
-					gap_list.append({"start":current_end, "end":block["start"]})
-				current_start = block["start"]
-				current_end = block["end"]
-	return gap_list
 
-def write_gaps(blocks_by_element, output_fname):
+	def __init__(self, strings, arrays):
+		self.strings = strings
+		self.id_num = arrays["id_num"]
+		self.chrom = arrays["chrom"]
+		self.name = arrays["name"]
+		self.strand = arrays["strand"]
+		self.block_offsets = arrays["block_offsets"]
+		self.block_start = arrays["block_start"]
+		self.block_end = arrays["block_end"]
+		self.block_type = arrays["block_type"]
+
+	def __len__(self):
+		return len(self.id_num)
+
+	def get_blocks(self, i):
+		'''
+		(start, end, type code) tuples of the blocks of element i
+		'''
+		first, last = self.block_offsets[i], self.block_offsets[i+1]
+		return zip(
+			self.block_start[first:last].tolist(),
+			self.block_end[first:last].tolist(),
+			self.block_type[first:last].tolist()
+		)
+
+	def find_gaps(self):
+		'''
+		The gaps between consecutive aligned blocks of every element, as
+		arrays of element indices, starts and ends, ordered by element
+		'''
+		aligned = np.flatnonzero(self.block_type == ALIGNED)
+		element = np.repeat(
+			np.arange(len(self)), np.diff(self.block_offsets)
+		)[aligned]
+
+		prev_end = self.block_end[aligned[:-1]]
+		next_start = self.block_start[aligned[1:]]
+		is_gap = (element[:-1] == element[1:]) & (next_start - prev_end > 1)
+
+		return element[1:][is_gap], prev_end[is_gap], next_start[is_gap]
+
+def read_rmsk_blocks(rmsk_input):
 	'''
-	Extract the indel blocks and write them to the given file
+	Parse a rmskJoinedBaseline.txt file into an RmskBlocks table
 	'''
+	strings = []
+	string_idx = {}
+
+	def intern(s):
+		try:
+			return string_idx[s]
+		except KeyError:
+			string_idx[s] = len(strings)
+			strings.append(s)
+			return string_idx[s]
+
+	id_num = array('l')
+	chrom = array('i')
+	name = array('i')
+	strand = []
+	block_counts = array('l')
+	block_start = array('l')
+	block_end = array('l')
+	block_type = array('b')
+
+	print("Processing rmsk file")
+	sys.stdout.flush()
+	progress = Progress.for_file("Processing rmsk file", rmsk_input)
 
-	print("Extracting insertions and indels")
-
-	output_list = []
-	num_lost = 0
-
-	print('['+' '*50+']'),
-	print('\r'),
-	num_elems = len(blocks_by_element)
-	percent = 0.0
-
-	for i,id_num in enumerate(blocks_by_element.keys()):
-		element_info = blocks_by_element[id_num]
-		name = element_info["name"]+":"+str(id_num)
-
-		gap_list = find_gaps(element_info["blocks"])
-		for gap in gap_list:
-			out_str = "\t".join([
-				element_info["chrom"],
-				str(gap["start"]),
-				str(gap["end"]),
-				name,
-				"0",
-				element_info["strand"]
-			])
-			output_list.append(out_str)
-
-		percent = 100.0*(float(i)/num_elems)
-		num_bars = int(floor(percent/2))
-		print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-		print('\r'),
-		sys.stdout.flush()
-
-	print('['+'|'*50+']')
+	with open(rmsk_input, 'r') as f:
+		for line in f:
+			progress.update(len(line))
+			line_list = line.split()
+			if line_list == []:
+				continue
+
+			blocks = line_to_blocks(line_list)
+			id_num.append(int(line_list[-1]))
+			chrom.append(intern(line_list[1]))
+			name.append(intern(line_list[4]))
+			strand.append(line_list[6])
+			block_counts.append(len(blocks))
+			for start, end, b_type in blocks:
+				block_start.append(start)
+				block_end.append(end)
+				block_type.append(b_type)
+
+	progress.finish()
 	print("Done")
-	print("Writing to file ... "),
+
+	return RmskBlocks(strings, {
+		"id_num":np.array(id_num, dtype=np.int64),
+		"chrom":np.array(chrom, dtype=np.int32),
+		"name":np.array(name, dtype=np.int32),
+		"strand":np.array(strand, dtype="S1"),
+		"block_offsets":np.concatenate(([0], np.cumsum(block_counts))).astype(np.int64),
+		"block_start":np.array(block_start, dtype=np.int64),
+		"block_end":np.array(block_end, dtype=np.int64),
+		"block_type":np.array(block_type, dtype=np.int8)
+	})
+
+def write_gaps(rmsk_blocks, output_fname):
+	'''
+	Find the gaps in all elements of an RmskBlocks table and write them to
+	the given file, ordered by element ID
+	'''
+	print("Extracting insertions and indels")
 	sys.stdout.flush()
-	with open(output_fname, 'wa') as f:
-		f.write("\n".join(output_list))
-	print("Done")
 
+	element, gap_start, gap_end = rmsk_blocks.find_gaps()
+	order = np.argsort(rmsk_blocks.id_num[element], kind="mergesort")
+
+	strings = rmsk_blocks.strings
+	with open(output_fname, 'w') as out:
+		for i, start, end in zip(
+				element[order].tolist(), gap_start[order].tolist(),
+				gap_end[order].tolist()):
+			out.write(get_gap_line(
+				strings[rmsk_blocks.chrom[i]], start, end,
+				strings[rmsk_blocks.name[i]] + ":" + str(rmsk_blocks.id_num[i]),
+				rmsk_blocks.strand[i]
+			) + "\n")
+
+	print("Done")
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("rmsk_input")
 	parser.add_argument("output_fname")
+	parser.add_argument("--threads", type=int, default=1,
+		help="Process chromosomes in parallel with this many processes " +
+			"(the rmsk file must be sorted by chromosome)")
+	parser.add_argument("--inMemory", action="store_true",
+		help="Read the whole table into memory first and write the gaps " +
+			"ordered by element ID, rather than in file order")
 	args = parser.parse_args()
 
-	blocks_by_element = get_blocks(args.rmsk_input)
-	write_gaps(blocks_by_element, args.output_fname)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-#
+	if args.threads > 1:
+		run_by_chrom(
+			args.rmsk_input, args.output_fname, gaps_chrom,
+			threads=args.threads, chrom_field=1
+		)
+	elif args.inMemory:
+		write_gaps(read_rmsk_blocks(args.rmsk_input), args.output_fname)
+	else:
+		stream_gaps(args.rmsk_input, args.output_fname)
@@ -27,12 +27,11 @@ with the actual values. The null distribution is generated as follows:
 
 import sys
 import os
+import shutil
 import subprocess
 from StringIO import StringIO
-import re
 import time
-import multiprocessing as mp
-import random
+import logging
 import numpy.random as nprand
 import scipy.stats as spstats
 import tempfile as tf
@@ -41,6 +40,10 @@ import numpy as np
 import json
 from math import ceil
 
+from interval_index import IntervalIndex
+from permutation_null import draw_samples, get_null_distn, get_file_info
+from annotation_cache import load_cached
+
 def get_flike(cmd_str):
     flike = StringIO(subprocess.check_output(cmd_str, shell=True))
     return flike
@@ -131,172 +134,268 @@ def get_transcript_feat_distns(consensus_rti_intersect_fname):
 
     return classification_props, strand_props, relative_positions
 
-def get_rtis_by_classification(content_classified_rtis_fname):
+def get_rti_table(content_classified_rtis_fname):
+    '''
+    Read the content-classified RTIs into flat arrays, sorted by
+    classification so that the RTIs of class c are the rows between
+    class_offsets[c] and class_offsets[c+1].
+    '''
 
-    print("Getting dict of RTIs by classification ... "),
+    print("Getting table of RTIs by classification ... "),
     sys.stdout.flush()
 
-    rtis_by_classification = {}
+    chrom_names = []
+    chrom_idx = {}
+    class_names = []
+    class_idx = {}
+
+    chrom_codes = []
+    starts = []
+    class_codes = []
 
     with open(content_classified_rtis_fname, 'r') as f:
         for line in f:
-            line_list = re.split("\s+", line.strip())
-            classification = line_list[6]
-            classification = re.sub("\?", "", classification)
-            try:
-                rtis_by_classification[classification].append(line.strip())
-            except KeyError:
-                rtis_by_classification[classification] = [line.strip()]
+            line_list = line.strip().split()
+            chrom = line_list[0]
+            classification = line_list[6].replace("?", "")
+
+            if chrom not in chrom_idx:
+                chrom_idx[chrom] = len(chrom_names)
+                chrom_names.append(chrom)
+            if classification not in class_idx:
+                class_idx[classification] = len(class_names)
+                class_names.append(classification)
+
+            chrom_codes.append(chrom_idx[chrom])
+            starts.append(int(line_list[1]))
+            class_codes.append(class_idx[classification])
+
+    class_codes = np.array(class_codes, dtype=np.int32)
+    order = np.argsort(class_codes, kind="mergesort")
+
+    rti_table = {
+        "chrom_names":np.array(chrom_names),
+        "chrom_codes":np.array(chrom_codes, dtype=np.int32)[order],
+        "starts":np.array(starts, dtype=np.int64)[order],
+        "class_names":class_names,
+        "class_offsets":np.concatenate(
+            ([0], np.cumsum(np.bincount(class_codes, minlength=len(class_names))))
+        )
+    }
 
     print("Done")
     sys.stdout.flush()
 
-    return rtis_by_classification
-
-class NullGenProcess(mp.Process):
-
-    input_queue = None
-    summary_queue = None
-    rtis_by_classification = None
-    classification_sample_counts = None
-    strand_props = None
-    relative_positions = None
-    rmsk_align_bed_fname = None
-    min_prop = None
-    element_class_dict = None
-
-    def __init__(self):
-        mp.Process.__init__(self)
-        self.daemon = True
-
-    def run(self):
-        while True:
-            token = self.input_queue.get()
-            if token == "STOP":
-                return None
-            else:
-                sample_summary = self.generate_sample()
-                self.summary_queue.put(sample_summary)
-
-    def generate_sample(self):
-        rti_sample = self.get_rti_sample()
-        random_tss_sample = self.generate_rand_tss(rti_sample)
-        intersect_summary = self.intersect(random_tss_sample)
-        return intersect_summary
-
-    def get_rti_sample(self):
-        rti_sample = []
-        for classification, count in self.classification_sample_counts.iteritems():
-            rti_sample += random.sample(
-                self.rtis_by_classification[classification], count
-            )
+    return rti_table
 
-        return rti_sample
+def get_class_strata(rti_table, classification_sample_counts):
+    '''
+    Sampling strata for permutation_null: classification_sample_counts[c]
+    RTIs are drawn from the rows of rti_table belonging to each class c.
+    '''
+    strata = []
+    for classification, count in sorted(classification_sample_counts.iteritems()):
+        c = list(rti_table["class_names"]).index(classification)
+        offset = rti_table["class_offsets"][c]
+        num_rtis = rti_table["class_offsets"][c+1] - offset
+        strata.append((int(offset), int(num_rtis), count))
 
-    def jitter(self, n):
-        return n + random.randint(-10, 10)
+    return strata
 
-    def generate_rand_tss(self, rti_sample):
-        random_tss_sample = []
+def generate_rand_tss(
+        rng, rti_table, rti_idx, strand_props, relative_positions):
+    '''
+    Generate random TSSs for a batch of samples of RTIs, given as a
+    (num_samples x sample_size) array of rti_table rows. A transcript is
+    placed on each RTI using a randomly chosen (jittered) relative position,
+    and its TSS taken according to a randomly chosen strand. Returns arrays
+    of the same shape of chromosome codes, indexing rti_table["chrom_names"],
+    and TSS positions.
+    '''
+    shape = rti_idx.shape
 
-        strand_opts = []
-        strand_p = []
+    pos_idx = rng.randint(0, len(relative_positions), size=shape)
+    rel_start = relative_positions[pos_idx, 0] + rng.randint(-10, 11, size=shape)
+    length = relative_positions[pos_idx, 1] + rng.randint(-10, 11, size=shape)
 
-        for k,v in self.strand_props.iteritems():
-            strand_opts.append(k)
-            strand_p.append(v)
+    start = rti_table["starts"][rti_idx] + rel_start
+    end = start + length
 
-        for line in rti_sample:
-            line_list = re.split("\s+", line)
-            chrom = line_list[0]
-            rel_start, length = random.choice(self.relative_positions)
-            rel_start = self.jitter(rel_start)
-            length = self.jitter(length)
-            start = int(line_list[1]) + rel_start
-            end = start + length
-            strand = nprand.choice(strand_opts, p=strand_p)
-            if strand == ".":
-                strand = random.choice(["+", "-"])
+    strand_opts = []
+    strand_p = []
+    for k,v in sorted(strand_props.iteritems()):
+        strand_opts.append(k)
+        strand_p.append(v)
+    strand_opts = np.array(strand_opts)
 
-            if strand == "+":
-                tss = str(start)
-            elif strand == "-":
-                tss = str(end)
+    strand = strand_opts[rng.choice(len(strand_opts), size=shape, p=strand_p)]
+    unstranded = strand == "."
+    strand[unstranded] = np.array(["+", "-"])[rng.randint(0, 2, size=unstranded.sum())]
 
-            random_tss_sample.append("\t".join([chrom, tss, tss]))
+    tss = np.where(strand == "+", start, end)
 
-        return random_tss_sample
+    return rti_table["chrom_codes"][rti_idx], tss
 
-    def intersect(self, random_tss_sample):
-        tmp = tf.NamedTemporaryFile()
-        tmp.write("\n".join(random_tss_sample) + "\n")
-        tmp.flush()
+def save_null_tables(table_dir, rti_table, relative_positions, rmsk_index):
+    '''
+    Write the tables needed to generate null samples to table_dir as .npy
+    files, for the worker processes to memory-map.
+    '''
+    for name, array in rti_table.iteritems():
+        np.save(os.path.join(table_dir, "rti_%s.npy" % name), np.asarray(array))
+    np.save(os.path.join(table_dir, "relative_positions.npy"), relative_positions)
+    rmsk_index.save(os.path.join(table_dir, "rmsk_index"))
+
+def load_null_tables(table_dir):
+    rti_table = {}
+    for fname in os.listdir(table_dir):
+        if fname.startswith("rti_") and fname.endswith(".npy"):
+            rti_table[fname[4:-4]] = np.load(
+                os.path.join(table_dir, fname), mmap_mode='r'
+            )
+    rti_table["class_names"] = list(rti_table["class_names"])
 
-        intersect_cmd = "bedtools intersect -wao -a %s -b %s" \
-                            % (tmp.name, self.rmsk_align_bed_fname)
+    relative_positions = np.load(
+        os.path.join(table_dir, "relative_positions.npy"), mmap_mode='r'
+    )
+    rmsk_index = IntervalIndex.load(os.path.join(table_dir, "rmsk_index"))
 
-        intersect_output = subprocess.check_output(intersect_cmd, shell=True)
+    return rti_table, relative_positions, rmsk_index
 
-        tmp.close()
+class RandTssStatistic(object):
+    '''
+    Statistic for permutation_null: for each sample of RTIs, generates random
+    TSSs and counts their overlaps with each element class, giving a row of
+    class counts followed by the number of TSSs overlapping no element. The
+    RTI and rmskAlign tables are memory-mapped from table_dir on first use, so
+    all workers share one copy of them.
+    '''
+
+    def __init__(self, table_dir, strand_props):
+        self.table_dir = table_dir
+        self.strand_props = strand_props
+        self.tables = None
+
+    def __call__(self, rng, rti_idx):
+        if self.tables is None:
+            self.tables = load_null_tables(self.table_dir)
+        rti_table, relative_positions, rmsk_index = self.tables
+
+        chrom_codes, tss = generate_rand_tss(
+            rng, rti_table, rti_idx, self.strand_props, relative_positions
+        )
+        counts, num_unmatched = count_rand_tss(
+            rmsk_index, rti_table, chrom_codes, tss
+        )
 
-        tmp_intersect = tf.NamedTemporaryFile()
-        tmp_intersect.write(intersect_output)
-        tmp_intersect.flush()
+        return np.column_stack((counts, num_unmatched)).astype(np.int32)
 
-        intersect_summary = get_intersect_summary(tmp_intersect.name, 7, self.min_prop, self.element_class_dict)
+def count_rand_tss(rmsk_index, rti_table, chrom_codes, tss):
+    '''
+    Count element class overlaps for a batch of TSS samples, giving a
+    (num_samples x num_classes) count matrix and the number of TSSs in each
+    sample overlapping no element.
+    '''
+    num_samples = tss.shape[0]
+    groups = np.repeat(np.arange(num_samples), tss.shape[1])
 
-        tmp_intersect.close()
+    return rmsk_index.count_grouped_point_overlaps(
+        chrom_codes, rti_table["chrom_names"], tss, groups, num_samples
+    )
 
-        return intersect_summary
+def get_null_distns(labels, counts, num_unmatched, min_prop, element_class_dict):
+    '''
+    Build the null distribution of each element class from a sample count
+    matrix, keeping the count from each sample in which that class passes the
+    same min_prop filter as get_index_summary.
+    '''
+    labels = list(labels)
+    no_element_class = get_element_class(".", element_class_dict)
+    if no_element_class in labels:
+        counts = counts.astype(np.int64)
+        counts[:, labels.index(no_element_class)] += num_unmatched
+    else:
+        labels.append(no_element_class)
+        counts = np.column_stack((counts, num_unmatched)).astype(np.int64)
+
+    totals = counts.sum(axis=1).astype(float)
+    keep = (counts > 0) & (counts/totals[:,np.newaxis] >= min_prop)
 
-def combine_summaries(summaries):
     null_distns = {}
-    for summ in summaries:
-        for element, count in summ.iteritems():
-            try:
-                null_distns[element].append(count)
-            except KeyError:
-                null_distns[element] = [count]
+    for i, element in enumerate(labels):
+        if keep[:,i].any():
+            null_distns[element] = counts[keep[:,i], i].tolist()
+
     return null_distns
 
+def get_observed_counts(labels, summary, element_class_dict):
+    '''
+    Arrange an unfiltered intersect summary in the same columns as the
+    RandTssStatistic counts, for early stopping on p-value precision.
+    '''
+    no_element_class = get_element_class(".", element_class_dict)
+    observed = [summary.get(element, 0) for element in labels]
+    if no_element_class in labels:
+        observed.append(0)
+    else:
+        observed.append(summary.get(no_element_class, 0))
+
+    return np.array(observed)
+
 def generate_null_distns(
-        transcript_feat_distns, rtis_by_classification, rmsk_align_bed_fname,
-        sample_size, num_samples, min_prop, num_procs, element_class_dict):
+        transcript_feat_distns, rti_table, rmsk_align_bed_fname,
+        sample_size, num_samples, min_prop, num_procs, element_class_dict,
+        batch_size=100, seed=None, query_summary=None, precision=None,
+        cache_dir=None, cache_key=None):
+    '''
+    Sample null TSS sets with permutation_null. If the unfiltered summary of
+    the query intersect and a precision are given, sampling stops once the
+    p-value of every element class count is known to within that precision.
+    '''
 
     print("Generating null distributions ... ")
     sys.stdout.flush()
 
     classification_props, strand_props, relative_positions = transcript_feat_distns
+    relative_positions = np.array(relative_positions, dtype=np.int64)
 
     classification_sample_counts = {k:int(classification_props[k]*sample_size) \
                                         for k in classification_props.keys()}
 
-    input_queue = mp.Queue()
-    summary_queue = mp.Queue()
-
-    for name, value in locals().iteritems():
-        setattr(NullGenProcess, name, value)
-
-    gen_procs = [NullGenProcess() for _ in range(num_procs)]
-    for p in gen_procs:
-        p.start()
-
-    summaries = []
-
-    for i in (range(num_samples) + ["STOP"]*num_procs):
-        input_queue.put(i)
-
-    while len(summaries) < num_samples:
-        print("{}/{} summaries received\r".format(len(summaries), num_samples)),
-        sys.stdout.flush()
-        summaries.append(summary_queue.get())
+    table_dir = tf.mkdtemp()
 
-    print("{}/{} summaries received\r".format(len(summaries), num_samples))
+    try:
+        rmsk_index = get_rmsk_index(rmsk_align_bed_fname, element_class_dict)
+        labels = rmsk_index.labels
+        save_null_tables(table_dir, rti_table, relative_positions, rmsk_index)
+        del rmsk_index
+
+        observed = None
+        if query_summary is not None:
+            observed = get_observed_counts(labels, query_summary, element_class_dict)
+
+        if cache_key is not None:
+            cache_key = {
+                "inputs":cache_key,
+                "element_classes":element_class_dict,
+                "strand_props":strand_props
+            }
+
+        null = get_null_distn(
+            RandTssStatistic(table_dir, strand_props),
+            get_class_strata(rti_table, classification_sample_counts),
+            num_samples, num_procs=num_procs, batch_size=batch_size,
+            seed=seed, observed=observed, precision=precision,
+            cache_dir=cache_dir, cache_key=cache_key
+        )
+    finally:
+        shutil.rmtree(table_dir)
 
-    for p in gen_procs:
-        p.terminate()
+    print("{} null samples generated".format(len(null)))
 
-    null_distns = combine_summaries(summaries)
+    null_distns = get_null_distns(
+        labels, null[:,:-1], null[:,-1], min_prop, element_class_dict
+    )
 
     print("Finished null distributions")
     return null_distns
@@ -324,6 +423,9 @@ def get_intersect_summary(intersect_fname, element_field, min_prop, element_clas
         except KeyError:
             summary[element_class] = int(count)
 
+    return filter_summary(summary, min_prop)
+
+def filter_summary(summary, min_prop):
     filtered_summary = {}
 
     total = sum(summary.values())
@@ -333,6 +435,137 @@ def get_intersect_summary(intersect_fname, element_field, min_prop, element_clas
 
     return filtered_summary
 
+def get_element_class(element, element_class_dict):
+    # Equivalent to `cut -d: -f1,2,3` followed by the class lookup in
+    # get_intersect_summary
+    element = ":".join(element.split(":")[:3])
+    try:
+        return element_class_dict[element]
+    except KeyError:
+        return element
+
+def get_rmsk_index(rmsk_align_bed_fname, element_class_dict):
+    '''
+    Index of the rmskAlign elements labelled by class, cached next to the BED
+    file for each element class dict it is used with.
+    '''
+    return load_cached(
+        rmsk_align_bed_fname, "rmsk_index",
+        lambda: IntervalIndex.from_bed(
+            rmsk_align_bed_fname,
+            lambda name: get_element_class(name, element_class_dict)
+        ),
+        lambda rmsk_index, index_dir: rmsk_index.save(index_dir),
+        IntervalIndex.load,
+        key=element_class_dict
+    )
+
+def get_index_summary(
+        rmsk_index, counts, num_unmatched, min_prop, element_class_dict):
+    '''
+    Turn per-class overlap counts from an IntervalIndex into the same summary
+    that get_intersect_summary produces from `bedtools intersect -wao` output.
+    TSSs overlapping no element appear in that output once, as ".".
+    '''
+    summary = {}
+    for element_class, count in zip(rmsk_index.labels, counts):
+        if count > 0:
+            summary[element_class] = int(count)
+
+    if num_unmatched > 0:
+        no_element_class = get_element_class(".", element_class_dict)
+        summary[no_element_class] \
+            = summary.get(no_element_class, 0) + int(num_unmatched)
+
+    return filter_summary(summary, min_prop)
+
+def bedtools_intersect(
+        chrom_names, chrom_codes, tss, rmsk_align_bed_fname,
+        min_prop, element_class_dict):
+    '''
+    Original implementation of a single sample's intersection, kept for
+    benchmarking: bedtools intersect plus get_intersect_summary.
+    '''
+    tmp = tf.NamedTemporaryFile()
+    for c,t in zip(chrom_codes, tss):
+        tmp.write("%s\t%d\t%d\n" % (chrom_names[c], t, t))
+    tmp.flush()
+
+    intersect_cmd = "bedtools intersect -wao -a %s -b %s" \
+                        % (tmp.name, rmsk_align_bed_fname)
+
+    intersect_output = subprocess.check_output(intersect_cmd, shell=True)
+
+    tmp.close()
+
+    tmp_intersect = tf.NamedTemporaryFile()
+    tmp_intersect.write(intersect_output)
+    tmp_intersect.flush()
+
+    intersect_summary = get_intersect_summary(tmp_intersect.name, 7, min_prop, element_class_dict)
+
+    tmp_intersect.close()
+
+    return intersect_summary
+
+def benchmark_intersect(
+        transcript_feat_distns, rti_table, rmsk_align_bed_fname,
+        sample_size, num_samples, min_prop, element_class_dict):
+    '''
+    Time the in-memory intersection against the original bedtools path on the
+    same random samples, checking that both give identical summaries.
+    '''
+    classification_props, strand_props, relative_positions = transcript_feat_distns
+    relative_positions = np.array(relative_positions, dtype=np.int64)
+
+    classification_sample_counts = {k:int(classification_props[k]*sample_size) \
+                                        for k in classification_props.keys()}
+
+    t0 = time.time()
+    rmsk_index = get_rmsk_index(rmsk_align_bed_fname, element_class_dict)
+    index_time = time.time() - t0
+
+    t0 = time.time()
+    rng = nprand.RandomState()
+    rti_idx = draw_samples(
+        rng, get_class_strata(rti_table, classification_sample_counts),
+        num_samples
+    )
+    chrom_codes, tss = generate_rand_tss(
+        rng, rti_table, rti_idx, strand_props, relative_positions
+    )
+    generate_time_per_sample = (time.time() - t0)/num_samples
+
+    t0 = time.time()
+    counts, num_unmatched = count_rand_tss(rmsk_index, rti_table, chrom_codes, tss)
+    index_summaries = [
+        get_index_summary(
+            rmsk_index, counts[i], num_unmatched[i], min_prop, element_class_dict
+        ) for i in range(num_samples)
+    ]
+    index_time_per_sample = (time.time() - t0)/num_samples
+
+    t0 = time.time()
+    bedtools_summaries = [
+        bedtools_intersect(
+            rti_table["chrom_names"], c, t, rmsk_align_bed_fname,
+            min_prop, element_class_dict
+        ) for c,t in zip(chrom_codes, tss)
+    ]
+    bedtools_time_per_sample = (time.time() - t0)/num_samples
+
+    num_mismatches = sum(
+        1 for a,b in zip(index_summaries, bedtools_summaries) if a != b
+    )
+
+    print("Index build (or cached load) time: {:.3f}s".format(index_time))
+    print("Sample generation: {:.5f}s/sample".format(generate_time_per_sample))
+    print("In-memory intersect: {:.5f}s/sample".format(index_time_per_sample))
+    print("bedtools intersect: {:.5f}s/sample".format(bedtools_time_per_sample))
+    print("Speedup: {:.1f}x".format(bedtools_time_per_sample/index_time_per_sample))
+    print("Mismatched summaries: {}/{}".format(num_mismatches, num_samples))
+    sys.stdout.flush()
+
 def get_params(vals):
     return {"mean":float(np.mean(vals)), "sd":float(np.std(vals))}
 
@@ -495,21 +728,63 @@ if __name__ == "__main__":
     parser.add_argument("sig_dist", type=float)
     parser.add_argument("img_fname")
     parser.add_argument("element_class_json")
+    parser.add_argument(
+        "--batchSize", type=int, default=100,
+        help="Number of null samples generated per job"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="Base random seed, for reproducible null distributions"
+    )
+    parser.add_argument(
+        "--precision", type=float, default=None,
+        help="Stop sampling once every p-value's standard error is below this"
+    )
+    parser.add_argument(
+        "--nullCache", default=None,
+        help="Directory in which to cache null distributions (requires --seed)"
+    )
+    parser.add_argument(
+        "--benchmark", type=int, default=0,
+        help="Compare the in-memory and bedtools intersections on this many samples and exit"
+    )
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO)
+
     with open(args.element_class_json, 'r') as f:
         element_class_dict = json.load(f)
 
     transcript_feat_distns \
         = get_transcript_feat_distns(args.consensus_rti_intersect_fname)
 
-    rtis_by_classification \
-        = get_rtis_by_classification(args.content_classified_rtis_fname)
+    rti_table = get_rti_table(args.content_classified_rtis_fname)
+
+    if args.benchmark > 0:
+        benchmark_intersect(
+            transcript_feat_distns, rti_table,
+            args.rmsk_align_bed_fname, args.sample_size, args.benchmark,
+            args.min_prop, element_class_dict
+        )
+        sys.exit(0)
+
+    query_summary = get_intersect_summary(
+        args.consensus_tss_rmsk_align_intersect_fname, 10, 0, element_class_dict
+    )
 
     null_distns = generate_null_distns(
-        transcript_feat_distns, rtis_by_classification,
+        transcript_feat_distns, rti_table,
         args.rmsk_align_bed_fname, args.sample_size, args.num_samples,
-        args.min_prop, args.num_procs, element_class_dict
+        args.min_prop, args.num_procs, element_class_dict,
+        batch_size=args.batchSize, seed=args.seed,
+        query_summary=query_summary, precision=args.precision,
+        cache_dir=args.nullCache,
+        cache_key=[
+            get_file_info(args.consensus_rti_intersect_fname),
+            get_file_info(args.content_classified_rtis_fname),
+            get_file_info(args.rmsk_align_bed_fname),
+            args.sample_size
+        ]
     )
 
     query_values = get_intersect_summary(
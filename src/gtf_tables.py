@@ -0,0 +1,329 @@
+'''
+Read a GTF file into compact, array-backed transcript and exon tables in a
+single streaming pass. The tables are cached next to the GTF by
+annotation_cache.py, as .npy files that later runs memory-map instead of
+parsing the GTF again.
+
+Transcripts are rows of flat arrays: chromosome, start, end and strand, plus
+one column per attribute found on transcript lines (gene_id, transcript_id,
+gene_name, ...). Strings are interned: chromosome and attribute columns hold
+int32 codes into a shared string pool, with -1 for a missing attribute.
+Exons are held in arrays sorted by transcript, with exon_offsets indexing
+them, so the exons of transcript i are rows exon_offsets[i] to
+exon_offsets[i+1]. Coordinates are kept as in the GTF (1-based, inclusive),
+and chromosome names are not altered.
+
+Transcripts that only appear on exon lines take their attributes from their
+first exon line and span all of their exons.
+'''
+
+import os
+import json
+import logging
+from array import array
+
+import numpy as np
+
+from annotation_cache import load_cached, benchmark_cache
+
+TABLES_VERSION = 1
+EXON_ATTRS = set(["exon_number", "exon_id", "exon_version"])
+
+def parse_attrs(attr_str):
+    '''
+    Parse a GTF attribute field into a dict. Values may be quoted or not;
+    where a key is repeated (e.g. Ensembl's tag) the first value is kept.
+    '''
+    attrs = {}
+    for item in attr_str.split(";"):
+        key, _, value = item.strip().partition(" ")
+        if key != "" and key not in attrs:
+            attrs[key] = value.strip().strip('"')
+
+    return attrs
+
+def get_attr(attr_str, key):
+    '''
+    Value of a single attribute, without parsing the whole attribute field.
+    Returns None if the attribute is missing.
+    '''
+    i = attr_str.find(key + " ")
+    while i > 0 and attr_str[i-1] not in " ;":
+        i = attr_str.find(key + " ", i + 1)
+    if i < 0:
+        return None
+
+    value = attr_str[i + len(key) + 1:].split(";", 1)[0]
+    return value.strip().strip('"')
+
+class GtfTables(object):
+
+    def __init__(self, strings, arrays, attr_names):
+        '''
+        strings is the string pool, arrays a dict of the table arrays and
+        attr_names the attribute columns of the transcript table (stored in
+        arrays as "attr_<name>").
+        '''
+        self.strings = strings
+        self.arrays = arrays
+        self.attr_names = list(attr_names)
+
+        self.chrom = arrays["chrom"]
+        self.start = arrays["start"]
+        self.end = arrays["end"]
+        self.strand = arrays["strand"]
+        self.exon_start = arrays["exon_start"]
+        self.exon_end = arrays["exon_end"]
+        self.exon_number = arrays["exon_number"]
+        self.exon_offsets = arrays["exon_offsets"]
+
+        self.transcript_idx = None
+
+    def __len__(self):
+        return len(self.start)
+
+    def get_column(self, name):
+        '''
+        A transcript column as a list of strings: "chrom", "strand" or any
+        attribute name. Missing attributes are None.
+        '''
+        if name == "strand":
+            return self.strand.tolist()
+
+        if name == "chrom":
+            codes = self.chrom
+        elif name in self.attr_names:
+            codes = self.arrays["attr_" + name]
+        else:
+            return [None]*len(self)
+
+        strings = self.strings
+        return [strings[c] if c >= 0 else None for c in codes.tolist()]
+
+    def get_index(self, transcript_id):
+        '''
+        Row of the transcript with the given ID, or None.
+        '''
+        if self.transcript_idx is None:
+            self.transcript_idx = {
+                t:i for i,t in enumerate(self.get_column("transcript_id"))
+            }
+
+        return self.transcript_idx.get(transcript_id)
+
+    def get_exons(self, i):
+        '''
+        (start, end) tuples of the exons of transcript i, in file order.
+        '''
+        first, last = self.exon_offsets[i], self.exon_offsets[i+1]
+        return zip(
+            self.exon_start[first:last].tolist(),
+            self.exon_end[first:last].tolist()
+        )
+
+    def get_num_exons(self):
+        return np.diff(self.exon_offsets)
+
+    def save(self, tables_dir):
+        '''
+        Write the tables to a directory as .npy arrays, with the string pool
+        as one NUL-separated byte array.
+        '''
+        for name, values in self.arrays.iteritems():
+            np.save(os.path.join(tables_dir, name + ".npy"), values)
+        np.save(
+            os.path.join(tables_dir, "strings.npy"),
+            np.frombuffer("\0".join(self.strings), dtype=np.uint8)
+        )
+
+        with open(os.path.join(tables_dir, "tables.json"), 'w') as out:
+            json.dump(
+                {"arrays":sorted(self.arrays.keys()), "attr_names":self.attr_names},
+                out
+            )
+
+    @classmethod
+    def load(cls, tables_dir, mmap_mode='r'):
+        '''
+        Load tables written by save, with the arrays memory-mapped.
+        '''
+        with open(os.path.join(tables_dir, "tables.json"), 'r') as f:
+            info = json.load(f)
+
+        arrays = {
+            str(name):np.load(
+                os.path.join(tables_dir, name + ".npy"), mmap_mode=mmap_mode
+            ) for name in info["arrays"]
+        }
+        strings = np.load(os.path.join(tables_dir, "strings.npy")).tostring().split("\0")
+
+        return cls(strings, arrays, [str(a) for a in info["attr_names"]])
+
+def read_gtf(gtf_fname):
+    '''
+    Parse a GTF file into a GtfTables in one pass over its transcript and
+    exon lines.
+    '''
+    logging.info("Parsing {}".format(gtf_fname))
+
+    strings = []
+    string_idx = {}
+
+    def intern(s):
+        try:
+            return string_idx[s]
+        except KeyError:
+            string_idx[s] = len(strings)
+            strings.append(s)
+            return string_idx[s]
+
+    chrom = array('i')
+    start = array('i')
+    end = array('i')
+    strand = []
+    has_transcript_line = []
+    attr_cols = {}
+    transcript_rows = {}
+
+    exon_start = array('i')
+    exon_end = array('i')
+    exon_number = array('i')
+    exon_transcript = array('i')
+
+    def set_attrs(row, attrs):
+        for key, value in attrs.iteritems():
+            if key in EXON_ATTRS:
+                continue
+            try:
+                col = attr_cols[key]
+            except KeyError:
+                col = array('i', [-1]*len(start))
+                attr_cols[key] = col
+            col[row] = intern(value)
+
+    with open(gtf_fname, 'r') as f:
+        for line in f:
+            if line[0] == "#":
+                continue
+
+            line_list = line.rstrip("\n").split("\t")
+            if len(line_list) < 9:
+                continue
+            feature = line_list[2]
+            if feature != "transcript" and feature != "exon":
+                continue
+
+            # Most lines are exons of an already seen transcript, for which
+            # only two attributes are needed
+            attr_str = line_list[8]
+            transcript_id = get_attr(attr_str, "transcript_id")
+            s = int(line_list[3])
+            e = int(line_list[4])
+
+            row = transcript_rows.get(transcript_id)
+            if row is None or feature == "transcript":
+                attrs = parse_attrs(attr_str)
+
+            if row is None:
+                row = len(start)
+                transcript_rows[transcript_id] = row
+                chrom.append(intern(line_list[0]))
+                start.append(s)
+                end.append(e)
+                strand.append(line_list[6])
+                has_transcript_line.append(False)
+                for col in attr_cols.itervalues():
+                    col.append(-1)
+                set_attrs(row, attrs)
+
+            if feature == "transcript":
+                start[row] = s
+                end[row] = e
+                if not has_transcript_line[row]:
+                    has_transcript_line[row] = True
+                    set_attrs(row, attrs)
+            else:
+                if not has_transcript_line[row]:
+                    start[row] = min(start[row], s)
+                    end[row] = max(end[row], e)
+                exon_start.append(s)
+                exon_end.append(e)
+                number = get_attr(attr_str, "exon_number")
+                exon_number.append(-1 if number is None else int(number))
+                exon_transcript.append(row)
+
+    num_transcripts = len(start)
+    exon_transcript = np.array(exon_transcript, dtype=np.int32)
+    exon_order = np.argsort(exon_transcript, kind="mergesort")
+
+    arrays = {
+        "chrom":np.array(chrom, dtype=np.int32),
+        "start":np.array(start, dtype=np.int32),
+        "end":np.array(end, dtype=np.int32),
+        "strand":np.array(strand, dtype="S1"),
+        "exon_start":np.array(exon_start, dtype=np.int32)[exon_order],
+        "exon_end":np.array(exon_end, dtype=np.int32)[exon_order],
+        "exon_number":np.array(exon_number, dtype=np.int32)[exon_order],
+        "exon_offsets":np.concatenate((
+            [0],
+            np.cumsum(np.bincount(exon_transcript, minlength=num_transcripts))
+        )).astype(np.int64)
+    }
+    for key, col in attr_cols.iteritems():
+        arrays["attr_" + key] = np.array(col, dtype=np.int32)
+
+    logging.info("Read {} transcripts and {} exons from {}".format(
+        num_transcripts, len(exon_transcript), gtf_fname
+    ))
+
+    return GtfTables(strings, arrays, sorted(attr_cols.keys()))
+
+def load_gtf(gtf_fname, use_cache=True):
+    '''
+    Get the GtfTables for a GTF file, from the annotation cache if it is up
+    to date, otherwise by parsing the GTF and (re)writing the cache.
+    '''
+    if not use_cache:
+        return read_gtf(gtf_fname)
+
+    return load_cached(
+        gtf_fname, "gtf_tables",
+        lambda: read_gtf(gtf_fname),
+        lambda tables, tables_dir: tables.save(tables_dir),
+        GtfTables.load,
+        key=TABLES_VERSION
+    )
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the cached tables for GTF files"
+    )
+    parser.add_argument("gtf_fname", nargs="+")
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="Time a cold load (parse) against warm loads from the cache, "
+             "including building a transcript ID to gene name dict"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for gtf_fname in args.gtf_fname:
+        if args.benchmark:
+            benchmark_cache(
+                gtf_fname, "gtf_tables",
+                lambda: read_gtf(gtf_fname),
+                lambda tables, tables_dir: tables.save(tables_dir),
+                GtfTables.load,
+                key=TABLES_VERSION,
+                use=lambda tables: dict(zip(
+                    tables.get_column("transcript_id"),
+                    tables.get_column("gene_name")
+                ))
+            )
+        else:
+            tables = load_gtf(gtf_fname)
+            print("{}: {} transcripts, {} exons".format(
+                gtf_fname, len(tables), len(tables.exon_start)
+            ))
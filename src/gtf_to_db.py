@@ -3,117 +3,95 @@ Use a GTF output by StringTie to create a database with two tables, transcripts
 and exons.
 '''
 
-import sqlite3
-import re
-from collections import OrderedDict
+import numpy as np
 
-def scrub(s):
-    return re.sub("[\";]", "", s)
+from gtf_tables import load_gtf
+from sqlite_bulk_load import BulkLoader
+from spatial_index import create_rtrees
 
-def gtf_to_db(gtf_fname):
-    db_fname = gtf_fname[0:-4] + ".db"
-
-    conn = sqlite3.connect(db_fname)
-    cur = conn.cursor()
-
-    cur.execute(
-        '''
-        CREATE TABLE transcript (
-            chromosome text,
-            start_coord integer,
-            end_coord integer,
-            strand text,
-            gene_id text,
-            transcript_id text,
-            num_exons integer,
-            exon_length integer,
-            PRIMARY KEY (transcript_id)
-        )
+TABLES = [
+    (
+        "transcript",
         '''
-    )
-
-    cur.execute(
-        '''
-        CREATE TABLE exon (
-            chromosome text,
-            start_coord integer,
-            end_coord integer,
-            strand text,
-            gene_id text,
-            transcript_id text,
-            exon_number integer,
-            PRIMARY KEY (transcript_id, exon_number)
-        )
+        chromosome text,
+        start_coord integer,
+        end_coord integer,
+        strand text,
+        gene_id text,
+        transcript_id text,
+        num_exons integer,
+        exon_length integer
+        ''',
+        [("transcript_pk", "transcript_id", True)]
+    ),
+    (
+        "exon",
         '''
+        chromosome text,
+        start_coord integer,
+        end_coord integer,
+        strand text,
+        gene_id text,
+        transcript_id text,
+        exon_number integer
+        ''',
+        [("exon_pk", "transcript_id, exon_number", True)]
     )
+]
 
-    transcript_dict = OrderedDict()
-    exon_data = []
-
-    with open(gtf_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
-            line_list = line.strip().split()
-            table = line_list[2]
-            chromosome = line_list[0]
-            if "chr" not in chromosome:
-                chromosome = "chr" + chromosome
-            start_coord = int(line_list[3])
-            end_coord = int(line_list[4])
-            strand = line_list[6]
-            gene_id = scrub(line_list[9])
-            transcript_id = scrub(line_list[11])
-            if table == "exon":
-                exon_number = int(scrub(line_list[13]))
-                exon_data.append(
-                    (
-                        chromosome, start_coord, end_coord, strand,
-                        gene_id, transcript_id, exon_number
-                    )
-                )
-                transcript_dict[transcript_id]["exon_length"] \
-                    += (end_coord - start_coord)
-                transcript_dict[transcript_id]["num_exons"] += 1
-            else:
-                transcript_dict[transcript_id] = OrderedDict([
-                    ("chromosome", chromosome),
-                    ("start_coord", start_coord),
-                    ("end_coord", end_coord),
-                    ("strand", strand),
-                    ("gene_id", gene_id),
-                    ("transcript_id", transcript_id),
-                    ("num_exons", 0),
-                    ("exon_length", 0)
-                ])
-
-    transcript_data = [d.values() for d in transcript_dict.values()]
-
-    tcols = len(transcript_data[0])
-    ecols = len(exon_data[1])
-
-    cur.executemany(
-        "INSERT INTO transcript VALUES ({})".format(",".join(["?"]*tcols)),
-        transcript_data
-    )
-
-    cur.executemany(
-        "INSERT INTO exon VALUES ({})".format(",".join(["?"]*ecols)),
-        exon_data
-    )
-
-    conn.commit()
+def gtf_to_db(gtf_fname, parallel=False, rtree=False):
+    db_fname = gtf_fname[0:-4] + ".db"
 
-    num_transcripts = cur.execute("SELECT COUNT(*) FROM transcript").fetchone()
-    num_exons = cur.execute("SELECT COUNT(*) FROM exon").fetchone()
+    with BulkLoader(db_fname, TABLES, parallel=parallel) as loader:
+        gtf = load_gtf(gtf_fname)
+
+        chromosomes = [
+            c if "chr" in c else "chr" + c for c in gtf.get_column("chrom")
+        ]
+        strands = gtf.get_column("strand")
+        gene_ids = gtf.get_column("gene_id")
+        transcript_ids = gtf.get_column("transcript_id")
+        num_exons = gtf.get_num_exons()
+        exon_lengths = np.add.reduceat(
+            np.append(gtf.exon_end - gtf.exon_start, 0), gtf.exon_offsets[:-1]
+        )
+        exon_lengths[num_exons == 0] = 0
+
+        loader.add_rows("transcript", zip(
+            chromosomes, gtf.start.tolist(), gtf.end.tolist(), strands,
+            gene_ids, transcript_ids, num_exons.tolist(), exon_lengths.tolist()
+        ))
+
+        exon_starts = gtf.exon_start.tolist()
+        exon_ends = gtf.exon_end.tolist()
+        exon_numbers = gtf.exon_number.tolist()
+        for i in range(len(gtf)):
+            first, last = gtf.exon_offsets[i], gtf.exon_offsets[i+1]
+            for j in range(first, last):
+                exon_number = exon_numbers[j]
+                if exon_number < 0:
+                    exon_number = j - first + 1
+                loader.add("exon", (
+                    chromosomes[i], exon_starts[j], exon_ends[j],
+                    strands[i], gene_ids[i], transcript_ids[i], exon_number
+                ))
+
+        counts = loader.finish()
+
+    if rtree:
+        create_rtrees(db_fname, [("transcript", False), ("exon", False)])
 
     print("{} transcripts and {} exons inserted into database {}"
-            .format(num_transcripts[0], num_exons[0], db_fname))
+            .format(counts["transcript"], counts["exon"], db_fname))
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("gtf_fname")
+    parser.add_argument("-p", "--parallel", action="store_true",
+        help="Load the transcript and exon tables in parallel")
+    parser.add_argument("--rtree", action="store_true",
+        help="Also build R*Tree indexes for positional queries on both tables")
     args = parser.parse_args()
 
-    gtf_to_db(args.gtf_fname)
+    gtf_to_db(args.gtf_fname, parallel=args.parallel, rtree=args.rtree)
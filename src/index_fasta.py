@@ -1,25 +1,89 @@
 '''
 Index a FASTA file and create an index file with following format:
 first_line:last_line:name
+
+Also creates a samtools faidx-style index (<fasta>.fai) with the columns
+name, length, offset, line bases, line width
+giving the byte offset of each sequence and how it is wrapped, so sequences
+can be read directly from the file with fasta_reader.IndexedFasta.
 '''
 
 import sys
 
 
-input_fa = sys.argv[1]
-output_fname = input_fa + ".idx"
+def index_fasta(input_fa):
+    '''
+    Scan a FASTA file, returning a list of (first_line, last_line, name) line
+    ranges and a list of (name, length, offset, line_bases, line_width) faidx
+    entries. Sequence lines must all be the same length within each record,
+    except the last.
+    '''
+    line_ranges = []
+    fai_entries = []
+
+    def add_record(name, start, end, length, seq_offset, line_bases, line_width):
+        line_ranges.append((start, end, name))
+        fai_entries.append((name, length, seq_offset, line_bases, line_width))
+
+    name = None
+    offset = 0
+    i = 0
+    with open(input_fa, 'r') as f:
+        for line in f:
+            i += 1
+            if line[0] == ">":
+                if name is not None:
+                    add_record(name, start, i - 1, length, seq_offset, line_bases, line_width)
+                name = line.strip().split()[0][1:]
+                start = i
+                seq_offset = offset + len(line)
+                length = 0
+                line_bases = None
+                line_width = None
+                short_line = False
+            elif name is not None:
+                bases = len(line.rstrip("\r\n"))
+                if bases > 0:
+                    if short_line:
+                        raise ValueError(
+                            "{}: inconsistent line length in sequence {} (line {})"
+                                .format(input_fa, name, i)
+                        )
+                    if line_bases is None:
+                        line_bases = bases
+                        line_width = len(line) if line.endswith("\n") else bases + 1
+                    elif bases > line_bases:
+                        raise ValueError(
+                            "{}: inconsistent line length in sequence {} (line {})"
+                                .format(input_fa, name, i)
+                        )
+                    short_line = bases < line_bases
+                    length += bases
+                else:
+                    short_line = True
+            offset += len(line)
+
+    if name is not None:
+        add_record(name, start, i, length, seq_offset, line_bases, line_width)
+
+    return line_ranges, fai_entries
+
+def write_fai(fai_entries, fai_fname):
+    with open(fai_fname, 'w') as out:
+        for name, length, seq_offset, line_bases, line_width in fai_entries:
+            out.write("\t".join(map(str, [
+                name, length, seq_offset, line_bases or 0, line_width or 0
+            ])) + "\n")
+
+
+if __name__ == "__main__":
+    input_fa = sys.argv[1]
+    output_fname = input_fa + ".idx"
+
+    line_ranges, fai_entries = index_fasta(input_fa)
 
-with open(input_fa, 'r') as f, open(output_fname, 'wa') as out:
-    name = f.readline().strip().split()[0][1:]
-    start = 1
-    i = 1
-    for line in f:
-        i += 1
-        if line[0] == ">":
-            end = i - 1
+    with open(output_fname, 'wa') as out:
+        for start, end, name in line_ranges:
             out.write(":".join(map(str, [start, end, name])) + "\n")
-            name = line.strip().split()[0][1:]
-            start = i
 
-    end = i
-    out.write(":".join(map(str, [start, end, name])) + "\n")
+    write_fai(fai_entries, input_fa + ".fai")
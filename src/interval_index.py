@@ -0,0 +1,389 @@
+'''
+In-memory index over the intervals in a BED file, for use where the same
+annotation is intersected many times (e.g. when building null distributions)
+and shelling out to bedtools for every query would dominate the runtime.
+
+Intervals are held in flat NumPy arrays sorted by chromosome and start. Within
+a chromosome they are split into tiers by length (powers of two), so a point
+query only has to scan the intervals starting within one tier-length upstream
+of it. All queries for a chromosome are answered with a handful of vectorised
+searchsorted calls.
+
+Each interval carries an integer label code; labels are arbitrary strings
+derived from the BED name field by a user-supplied function, and overlaps can
+be counted per label directly.
+
+An index can be saved to a directory of .npy files and loaded memory-mapped,
+so worker processes share one read-only copy rather than each holding their
+own.
+'''
+
+import os
+import json
+
+import numpy as np
+
+class IntervalIndex(object):
+
+    def __init__(self, chroms, starts, ends, label_codes, labels):
+        '''
+        chroms, starts, ends and label_codes are parallel sequences, one entry
+        per interval; labels[c] is the label for label code c.
+        '''
+        self.labels = list(labels)
+        self.tiers = {}
+
+        chrom_names, chrom_codes = np.unique(np.asarray(chroms), return_inverse=True)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        label_codes = np.asarray(label_codes, dtype=np.int32)
+
+        # bedtools treats a zero-length interval as covering the bases either
+        # side of it, do the same here so that results match
+        zero_length = starts == ends
+        starts[zero_length] -= 1
+        ends[zero_length] += 1
+
+        lengths = np.maximum(ends - starts, 1)
+        tier_ids = np.ceil(np.log2(lengths)).astype(np.int32)
+
+        # All intervals are held in three flat arrays, ordered by chromosome,
+        # then tier, then start; each tier is a contiguous slice of these
+        order = np.lexsort((starts, tier_ids, chrom_codes))
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.codes = label_codes[order]
+
+        chrom_codes = chrom_codes[order]
+        tier_ids = tier_ids[order]
+        boundaries = np.flatnonzero(
+            (np.diff(chrom_codes) != 0) | (np.diff(tier_ids) != 0)
+        ) + 1
+        tier_starts = np.concatenate(([0], boundaries))
+        tier_ends = np.concatenate((boundaries, [len(order)]))
+
+        for lo, hi in zip(tier_starts, tier_ends):
+            if hi == lo:
+                continue
+            chrom = str(chrom_names[chrom_codes[lo]])
+            max_len = int((self.ends[lo:hi] - self.starts[lo:hi]).max())
+            self.tiers.setdefault(chrom, []).append((int(lo), int(hi), max_len))
+
+    def save(self, index_dir):
+        '''
+        Write the index to a directory as .npy arrays plus a small JSON file,
+        so that it can be memory-mapped by IntervalIndex.load.
+        '''
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        for name in ["starts", "ends", "codes"]:
+            np.save(os.path.join(index_dir, name + ".npy"), getattr(self, name))
+
+        with open(os.path.join(index_dir, "index.json"), 'w') as out:
+            json.dump({"labels":self.labels, "tiers":self.tiers}, out)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        '''
+        Load an index written by save. With the default mmap_mode the interval
+        arrays are memory-mapped read-only, so any number of processes can
+        share a single copy in the page cache.
+        '''
+        index = cls.__new__(cls)
+
+        for name in ["starts", "ends", "codes"]:
+            setattr(
+                index, name,
+                np.load(os.path.join(index_dir, name + ".npy"), mmap_mode=mmap_mode)
+            )
+
+        with open(os.path.join(index_dir, "index.json"), 'r') as f:
+            info = json.load(f)
+
+        index.labels = [str(label) for label in info["labels"]]
+        index.tiers = {
+            str(chrom):[tuple(t) for t in tiers] \
+                for chrom, tiers in info["tiers"].iteritems()
+        }
+
+        return index
+
+    @classmethod
+    def from_bed(cls, bed_fname, label_func=None):
+        '''
+        Build an index from a BED file. label_func maps the name field (4th
+        column) of each line to its label; by default the name is used as is.
+        '''
+        chroms = []
+        starts = []
+        ends = []
+        label_codes = []
+        labels = []
+        label_idx = {}
+
+        with open(bed_fname, 'r') as f:
+            for line in f:
+                line_list = line.split()
+                if len(line_list) < 3:
+                    continue
+                name = line_list[3] if len(line_list) > 3 else "."
+                label = name if label_func is None else label_func(name)
+                try:
+                    code = label_idx[label]
+                except KeyError:
+                    code = len(labels)
+                    label_idx[label] = code
+                    labels.append(label)
+
+                chroms.append(line_list[0])
+                starts.append(int(line_list[1]))
+                ends.append(int(line_list[2]))
+                label_codes.append(code)
+
+        return cls(chroms, starts, ends, label_codes, labels)
+
+    def point_hits(self, chrom, positions):
+        '''
+        Find every interval overlapping each of a set of zero-length point
+        features (written as "chrom pos pos" in BED) on one chromosome.
+        Returns parallel arrays of query indices and hit label codes, with
+        one entry per (query, interval) pair.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        query_idx = []
+        hit_codes = []
+
+        for tier_lo, tier_hi, max_len in self.tiers.get(chrom, []):
+            tier_starts = self.starts[tier_lo:tier_hi]
+            lo = np.searchsorted(tier_starts, positions - max_len, 'left')
+            hi = np.searchsorted(tier_starts, positions, 'right')
+            num_candidates = hi - lo
+            total = int(num_candidates.sum())
+            if total == 0:
+                continue
+
+            cand_query = np.repeat(np.arange(len(positions)), num_candidates)
+            offsets = np.arange(total) \
+                        - np.repeat(np.cumsum(num_candidates) - num_candidates, num_candidates)
+            cand_interval = tier_lo + np.repeat(lo, num_candidates) + offsets
+
+            hit = self.ends[cand_interval] >= positions[cand_query]
+            query_idx.append(cand_query[hit])
+            hit_codes.append(self.codes[cand_interval[hit]])
+
+        if query_idx == []:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+
+        return np.concatenate(query_idx), np.concatenate(hit_codes)
+
+    def interval_hits(self, chrom, starts, ends):
+        '''
+        Find every interval overlapping each of a set of query intervals
+        ([start, end) in BED coordinates) on one chromosome. Returns parallel
+        arrays of query indices, hit label codes and overlap lengths in bp,
+        with one entry per overlapping (query, interval) pair, as in the
+        output of `bedtools intersect -wo`.
+        '''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        query_idx = []
+        hit_codes = []
+        overlaps = []
+
+        for tier_lo, tier_hi, max_len in self.tiers.get(chrom, []):
+            # Intervals in a tier that can reach a query start before its end
+            tier_starts = self.starts[tier_lo:tier_hi]
+            lo = np.searchsorted(tier_starts, starts - max_len, 'right')
+            hi = np.searchsorted(tier_starts, ends, 'left')
+            num_candidates = np.maximum(hi - lo, 0)
+            total = int(num_candidates.sum())
+            if total == 0:
+                continue
+
+            cand_query = np.repeat(np.arange(len(starts)), num_candidates)
+            offsets = np.arange(total) \
+                        - np.repeat(np.cumsum(num_candidates) - num_candidates, num_candidates)
+            cand_interval = tier_lo + np.repeat(lo, num_candidates) + offsets
+
+            hit = self.ends[cand_interval] > starts[cand_query]
+            cand_query = cand_query[hit]
+            cand_interval = cand_interval[hit]
+            query_idx.append(cand_query)
+            hit_codes.append(self.codes[cand_interval])
+            overlaps.append(
+                np.minimum(self.ends[cand_interval], ends[cand_query])
+                    - np.maximum(self.starts[cand_interval], starts[cand_query])
+            )
+
+        if query_idx == []:
+            return (
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.int64)
+            )
+
+        return np.concatenate(query_idx), np.concatenate(hit_codes), np.concatenate(overlaps)
+
+    def count_point_overlaps(self, chroms, positions):
+        '''
+        Count overlaps per label for a set of point features, in the same way
+        as counting the lines of `bedtools intersect -wao` output by B name.
+        Returns an array of counts indexed by label code, and the number of
+        points that overlap nothing (which -wao reports as a single "." line).
+        '''
+        chrom_names, chrom_codes = np.unique(np.asarray(chroms), return_inverse=True)
+        counts, num_unmatched = self.count_grouped_point_overlaps(
+            chrom_codes, chrom_names, positions,
+            np.zeros(len(chrom_codes), dtype=np.int64), 1
+        )
+        return counts[0], num_unmatched[0]
+
+    def count_grouped_point_overlaps(
+            self, chrom_codes, chrom_names, positions, groups, num_groups):
+        '''
+        As count_point_overlaps, but for many independent sets of points at
+        once (e.g. a batch of random samples). Points are given as parallel
+        arrays of chromosome codes (indexing chrom_names), positions and group
+        numbers in [0, num_groups). Returns a (num_groups x num_labels) count
+        matrix and the number of unmatched points in each group.
+        '''
+        chrom_codes = np.asarray(chrom_codes).ravel()
+        positions = np.asarray(positions, dtype=np.int64).ravel()
+        groups = np.asarray(groups, dtype=np.int64).ravel()
+        num_labels = len(self.labels)
+
+        counts = np.zeros(num_groups*num_labels, dtype=np.int64)
+        matched = np.zeros(len(positions), dtype=bool)
+
+        for code in np.unique(chrom_codes):
+            on_chrom = np.flatnonzero(chrom_codes == code)
+            query_idx, hit_codes = self.point_hits(
+                str(chrom_names[code]), positions[on_chrom]
+            )
+            counts += np.bincount(
+                groups[on_chrom[query_idx]]*num_labels + hit_codes,
+                minlength=num_groups*num_labels
+            )
+            matched[on_chrom[query_idx]] = True
+
+        num_unmatched = np.bincount(groups[~matched], minlength=num_groups)
+
+        return counts.reshape((num_groups, num_labels)), num_unmatched
+
+def overlap_sums(index, intervals, groups):
+    '''
+    Total overlap in bp between each group of query intervals (e.g. the exons
+    of a transcript) and each label of index (e.g. the blocks of a
+    retrocopy), as would be got by summing the overlap column of
+    `bedtools intersect -wao` output by A group and B label. intervals is a
+    (chroms, starts, ends) tuple of arrays, as returned by read_bed_intervals,
+    and groups an array of integer group codes, one per interval. Returns
+    parallel arrays of group codes, label codes and overlap sums, for the
+    pairs that overlap at all, ordered by group then label.
+    '''
+    chroms, starts, ends = [np.asarray(x) for x in intervals]
+    groups = np.asarray(groups, dtype=np.int64)
+    num_labels = len(index.labels)
+
+    keys = []
+    overlaps = []
+    for chrom in np.unique(chroms):
+        on_chrom = np.flatnonzero(chroms == chrom)
+        query_idx, hit_codes, hit_overlaps = index.interval_hits(
+            str(chrom), starts[on_chrom], ends[on_chrom]
+        )
+        keys.append(groups[on_chrom[query_idx]]*num_labels + hit_codes)
+        overlaps.append(hit_overlaps)
+
+    if keys == []:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    pair_keys, pair_idx = np.unique(np.concatenate(keys), return_inverse=True)
+    sums = np.bincount(pair_idx, weights=np.concatenate(overlaps)).astype(np.int64)
+
+    return pair_keys // num_labels, pair_keys % num_labels, sums
+
+def read_bed_intervals(bed_fname):
+    '''
+    Read the first three columns of a BED file into arrays of chromosomes,
+    starts and ends, in file order.
+    '''
+    chroms = []
+    starts = []
+    ends = []
+    with open(bed_fname, 'r') as f:
+        for line in f:
+            line_list = line.split()
+            if len(line_list) < 3 or line_list[0] in ["track", "browser"]:
+                continue
+            chroms.append(line_list[0])
+            starts.append(int(line_list[1]))
+            ends.append(int(line_list[2]))
+
+    return (
+        np.array(chroms),
+        np.array(starts, dtype=np.int64),
+        np.array(ends, dtype=np.int64)
+    )
+
+def window_distances(a_intervals, b_intervals):
+    '''
+    For each interval in a_intervals, the smallest window size w for which
+    `bedtools window -u -w w` would report it against b_intervals: 0 if it
+    overlaps a B interval, gap + 1 for the nearest non-overlapping one, and
+    -1 if there are no B intervals on its chromosome. An A interval is
+    therefore reported with window w exactly when 0 <= distance <= w.
+
+    Both arguments are (chroms, starts, ends) tuples of arrays, as returned by
+    read_bed_intervals. B intervals are sorted by start once per chromosome,
+    with a running maximum of their ends, so all A intervals on a chromosome
+    are handled with two searchsorted calls.
+    '''
+    a_chroms, a_starts, a_ends = [np.asarray(x) for x in a_intervals]
+    b_chroms, b_starts, b_ends = [np.asarray(x) for x in b_intervals]
+
+    # Zero-length intervals cover the bases either side, as in bedtools
+    a_starts, a_ends = a_starts.astype(np.int64), a_ends.astype(np.int64)
+    b_starts, b_ends = b_starts.astype(np.int64), b_ends.astype(np.int64)
+    for starts, ends in [(a_starts, a_ends), (b_starts, b_ends)]:
+        zero_length = starts == ends
+        starts[zero_length] -= 1
+        ends[zero_length] += 1
+
+    no_hit = np.iinfo(np.int64).max
+    distances = np.full(len(a_chroms), no_hit, dtype=np.int64)
+
+    for chrom in np.unique(a_chroms):
+        on_b_chrom = np.flatnonzero(b_chroms == chrom)
+        if len(on_b_chrom) == 0:
+            continue
+
+        order = on_b_chrom[np.argsort(b_starts[on_b_chrom], kind="mergesort")]
+        starts = b_starts[order]
+        max_ends = np.maximum.accumulate(b_ends[order])
+
+        on_a_chrom = np.flatnonzero(a_chroms == chrom)
+        q_starts = a_starts[on_a_chrom]
+        q_ends = a_ends[on_a_chrom]
+
+        # B intervals starting at or after the end of A: the first of these is
+        # the nearest downstream
+        first_after = np.searchsorted(starts, q_ends, 'left')
+        has_after = first_after < len(starts)
+        after = np.full(len(on_a_chrom), no_hit, dtype=np.int64)
+        after[has_after] = starts[first_after[has_after]] - q_ends[has_after] + 1
+
+        # B intervals starting before the end of A either overlap it, or end
+        # upstream of it, the furthest-reaching being the nearest
+        has_before = first_after > 0
+        before = np.full(len(on_a_chrom), no_hit, dtype=np.int64)
+        reach = max_ends[first_after[has_before] - 1]
+        before[has_before] = np.where(
+            reach > q_starts[has_before], 0, q_starts[has_before] - reach + 1
+        )
+
+        distances[on_a_chrom] = np.minimum(after, before)
+
+    distances[distances == no_hit] = -1
+    return distances
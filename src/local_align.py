@@ -0,0 +1,233 @@
+'''
+Banded Smith-Waterman local alignment of nucleotide sequences, computed in
+process with NumPy over a batch of pairs at once, for scoring retrocopies
+against their parents without running EMBOSS matcher.
+
+Scoring follows matcher's defaults for nucleotides (EDNAFULL's +5/-4 for
+A/C/G/T, any other base mismatching, gap open 16 and extend 4, so a gap of
+length n costs 16 + 4*(n-1)). Each pair is only aligned within band of the
+diagonal with the most unique shared k-mers, which is where a retrocopy and
+its parent line up. Pairs are sorted by length and aligned batch_size at a
+time, filling the DP matrix one row of the band at a time for the whole
+batch; the horizontal gaps within a row are found with a running maximum
+rather than cell by cell.
+
+For each pair the score, alignment length (including gaps), identity and
+similarity (as fractions of the alignment length, as reported by matcher)
+and number of gap columns of the best local alignment are returned in a
+record array:
+
+    results = align_pairs([(retrocopy_seq, parent_seq), ...])
+    results["length"], results["similarity"]
+'''
+
+import numpy as np
+
+MATCH = 5
+MISMATCH = -4
+GAP_OPEN = 16
+GAP_EXTEND = 4
+
+BAND = 32
+SEED_K = 11
+BATCH_SIZE = 256
+
+NEG_INF = -10**8
+
+RESULT_DTYPE = np.dtype([
+    ("score", np.int32),
+    ("length", np.int32),
+    ("identity", np.float64),
+    ("similarity", np.float64),
+    ("gaps", np.int32)
+])
+
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate("ACGT"):
+    _BASE_CODES[ord(_base)] = _i
+    _BASE_CODES[ord(_base.lower())] = _i
+
+def encode(seq):
+    '''
+    Sequence string to an array of base codes (A, C, G, T = 0-3, other 4)
+    '''
+    return _BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+def get_kmers(codes, k):
+    '''
+    The k-mers starting at each position of an encoded sequence as integers,
+    and whether each is free of non-ACGT bases
+    '''
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    kmers = np.zeros(n, dtype=np.int64)
+    valid = np.ones(n, dtype=bool)
+    for x in range(k):
+        window = codes[x:x+n]
+        kmers = kmers*4 + (window & 3)
+        valid &= window < 4
+    return kmers, valid
+
+def best_diagonal(a, b, k=SEED_K):
+    '''
+    The diagonal (offset of b position from a position) shared by the most
+    k-mers of a that occur once in b, or 0 if there are none
+    '''
+    a_kmers, a_valid = get_kmers(a, k)
+    b_kmers, b_valid = get_kmers(b, k)
+
+    b_pos = np.flatnonzero(b_valid)
+    kmers, first, counts = np.unique(b_kmers[b_valid], return_index=True, return_counts=True)
+    unique_kmers = kmers[counts == 1]
+    unique_pos = b_pos[first[counts == 1]]
+    if len(unique_kmers) == 0:
+        return 0
+
+    a_pos = np.flatnonzero(a_valid)
+    a_kmers = a_kmers[a_valid]
+    idx = np.minimum(np.searchsorted(unique_kmers, a_kmers), len(unique_kmers) - 1)
+    hits = unique_kmers[idx] == a_kmers
+    if not hits.any():
+        return 0
+
+    diags, counts = np.unique(unique_pos[idx[hits]] - a_pos[hits], return_counts=True)
+    return int(diags[np.argmax(counts)])
+
+def align_batch(a_list, b_list, diags, band=BAND):
+    '''
+    Align each encoded sequence in a_list to the one in b_list within band
+    of the given diagonals. Returns arrays of the best score and the length,
+    number of matches and number of gap columns of its alignment.
+    '''
+    num_pairs = len(a_list)
+    width = 2*band + 1
+    rows = np.arange(num_pairs)[:, None]
+    cols = np.arange(width)
+
+    a_len = np.array([len(a) for a in a_list])
+    b_len = np.array([len(b) for b in b_list])
+    a_pad = np.full((num_pairs, max(a_len.max(), 1)), 4, dtype=np.uint8)
+    b_pad = np.full((num_pairs, max(b_len.max(), 1)), 5, dtype=np.uint8)
+    for p in range(num_pairs):
+        a_pad[p, :a_len[p]] = a_list[p]
+        b_pad[p, :b_len[p]] = b_list[p]
+
+    # Column k of row i of the band is b position i + band_start + k
+    band_start = (np.asarray(diags) - band)[:, None] + cols
+
+    def empty(fill):
+        return np.full((num_pairs, width), fill, dtype=np.int32)
+
+    def shift_left(x, fill):
+        return np.concatenate((x[:, 1:], np.full((num_pairs, 1), fill, dtype=x.dtype)), axis=1)
+
+    # Best local alignment ending at each cell of the previous row (H) and
+    # best ending in a gap in b (F), with their lengths, matches and gaps
+    h, h_len, h_match, h_gap = empty(0), empty(0), empty(0), empty(0)
+    f, f_len, f_match, f_gap = empty(NEG_INF), empty(0), empty(0), empty(0)
+
+    best = np.zeros(num_pairs, dtype=np.int32)
+    best_len = np.zeros(num_pairs, dtype=np.int32)
+    best_match = np.zeros(num_pairs, dtype=np.int32)
+    best_gap = np.zeros(num_pairs, dtype=np.int32)
+
+    for i in range(a_pad.shape[1]):
+        j = i + band_start
+        valid = (j >= 0) & (j < b_len[:, None]) & (i < a_len[:, None])
+        b_base = b_pad[rows, np.clip(j, 0, b_pad.shape[1] - 1)]
+        is_match = (b_base == a_pad[:, i][:, None]) & (b_base < 4)
+
+        # Gap in b, from the cell above (column k+1 of the previous row)
+        up_h = shift_left(h, NEG_INF)
+        up_f = shift_left(f, NEG_INF)
+        f_open = up_h - GAP_OPEN
+        f_extend = up_f - GAP_EXTEND
+        use_open = f_open >= f_extend
+        f = np.maximum(f_open, f_extend)
+        f_len = np.where(use_open, shift_left(h_len, 0), shift_left(f_len, 0)) + 1
+        f_match = np.where(use_open, shift_left(h_match, 0), shift_left(f_match, 0))
+        f_gap = np.where(use_open, shift_left(h_gap, 0), shift_left(f_gap, 0)) + 1
+        f[~valid] = NEG_INF
+
+        # Match/mismatch from the cell diagonally above (column k of the
+        # previous row), else the gap in b, else start a new alignment
+        new_h = h + np.where(is_match, MATCH, MISMATCH)
+        new_len = h_len + 1
+        new_match = h_match + is_match
+        new_gap = h_gap.copy()
+
+        use_f = f > new_h
+        new_h = np.where(use_f, f, new_h)
+        new_len = np.where(use_f, f_len, new_len)
+        new_match = np.where(use_f, f_match, new_match)
+        new_gap = np.where(use_f, f_gap, new_gap)
+
+        restart = (new_h <= 0) | ~valid
+        new_h[restart] = 0
+        new_len[restart] = 0
+        new_match[restart] = 0
+        new_gap[restart] = 0
+
+        # Gap in a, from any cell to the left in this row: the best of
+        # h[k'] - open - extend*(k - k' - 1) over k' < k is a running
+        # maximum of h[k'] + extend*k'
+        left = new_h + GAP_EXTEND*cols
+        running = np.maximum.accumulate(left, axis=1)
+        running_idx = np.maximum.accumulate(np.where(left == running, cols, 0), axis=1)
+        e = np.concatenate((np.full((num_pairs, 1), NEG_INF), running[:, :-1]), axis=1) \
+            - GAP_OPEN - GAP_EXTEND*(cols - 1)
+        e_from = np.concatenate((np.zeros((num_pairs, 1), dtype=int), running_idx[:, :-1]), axis=1)
+
+        use_e = (e > new_h) & valid
+        if use_e.any():
+            gap_size = cols - e_from
+            new_h = np.where(use_e, e, new_h)
+            new_len = np.where(use_e, new_len[rows, e_from] + gap_size, new_len)
+            new_match = np.where(use_e, new_match[rows, e_from], new_match)
+            new_gap = np.where(use_e, new_gap[rows, e_from] + gap_size, new_gap)
+
+        h, h_len, h_match, h_gap = new_h, new_len, new_match, new_gap
+
+        row_best = h.argmax(axis=1)
+        row_score = h[rows[:, 0], row_best]
+        better = row_score > best
+        if better.any():
+            best[better] = row_score[better]
+            best_len[better] = h_len[rows[:, 0], row_best][better]
+            best_match[better] = h_match[rows[:, 0], row_best][better]
+            best_gap[better] = h_gap[rows[:, 0], row_best][better]
+
+    return best, best_len, best_match, best_gap
+
+def align_pairs(pairs, band=BAND, batch_size=BATCH_SIZE, k=SEED_K):
+    '''
+    Locally align each (a, b) pair of sequence strings, returning a record
+    array of RESULT_DTYPE in the same order as pairs
+    '''
+    results = np.zeros(len(pairs), dtype=RESULT_DTYPE)
+    if len(pairs) == 0:
+        return results
+
+    a_list = [encode(a) for a, _ in pairs]
+    b_list = [encode(b) for _, b in pairs]
+    diags = np.array([best_diagonal(a, b, k) for a, b in zip(a_list, b_list)])
+
+    # Batches of similar lengths need less padding
+    order = np.argsort([len(a) for a in a_list], kind="mergesort")
+    for first in range(0, len(order), batch_size):
+        batch = order[first:first + batch_size]
+        score, length, matches, gaps = align_batch(
+            [a_list[p] for p in batch], [b_list[p] for p in batch],
+            diags[batch], band
+        )
+        results["score"][batch] = score
+        results["length"][batch] = length
+        results["gaps"][batch] = gaps
+        fraction = matches / np.maximum(length, 1).astype(float)
+        results["identity"][batch] = fraction
+        # Only identical bases score positively in EDNAFULL for A/C/G/T
+        results["similarity"][batch] = fraction
+
+    return results
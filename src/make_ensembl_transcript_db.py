@@ -4,18 +4,8 @@ Create a DB of Ensembl transcripts from a GTF file
 
 import sys
 import sqlite3
-import re
 
-def scrub(s):
-    return re.sub("[\";]", "", s)
-
-def get_attr_dict(attr_list):
-    N = len(attr_list)
-
-    keys = [attr_list[i] for i in range(0, N, 2)]
-    vals = [scrub(attr_list[i]) for i in range(1, N, 2)]
-
-    return {k:v for k,v in zip(keys, vals)}
+from gtf_tables import load_gtf
 
 def make_transcript_table(input_fname, db_fname):
 
@@ -40,30 +30,15 @@ def make_transcript_table(input_fname, db_fname):
         '''
     )
 
-    data = []
-
-    with open(input_fname, 'r') as f:
-        for line in f:
-            if line[0] == "#":
-                continue
+    gtf = load_gtf(input_fname)
 
-            line_list = line.strip().split()
-
-            if line_list[2] != "transcript":
-                continue
-
-            chromosome = line_list[0]
-            start_coord = int(line_list[3])
-            end_coord = int(line_list[4])
-            strand = line_list[6]
-            attr_dict = get_attr_dict(line_list[8:])
-
-            data.append((
-                chromosome, start_coord, end_coord, strand,
-                attr_dict["gene_id"], attr_dict["transcript_id"],
-                attr_dict["gene_name"],
-                attr_dict["gene_biotype"], attr_dict["transcript_biotype"]
-            ))
+    data = zip(
+        gtf.get_column("chrom"), gtf.start.tolist(), gtf.end.tolist(),
+        gtf.get_column("strand"),
+        gtf.get_column("gene_id"), gtf.get_column("transcript_id"),
+        gtf.get_column("gene_name"),
+        gtf.get_column("gene_biotype"), gtf.get_column("transcript_biotype")
+    )
 
     num_cols = len(data[0])
     print(num_cols)
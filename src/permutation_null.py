@@ -0,0 +1,255 @@
+'''
+Shared engine for random-subset null distributions: draw many random subsets
+of a set of items, compute a statistic on each, and compare an observed value
+with the resulting null distribution.
+
+A statistic is any function statistic(rng, samples) taking a RandomState and
+a (num_samples x sample_size) array of item indices, and returning a
+(num_samples x num_values) array, one row per sample. Items can be drawn from
+several strata at once (e.g. a fixed number from each classification), given
+as a list of (offset, num_items, count) tuples: count distinct indices are
+drawn from [offset, offset + num_items) for each stratum, and the columns of
+each sample are the strata in order.
+
+Samples are generated in fixed-size batches by a pool of worker processes.
+Batch i is always drawn with seed (seed + i), so a null distribution depends
+only on its seed and batch size, not on how batches are shared among workers
+or how many of them are run. This means that:
+    - runs can stop early once every p-value is known to within a requested
+      precision, and the samples used are the same as the first samples of a
+      longer run
+    - null distributions can be cached on disk and extended later, by running
+      only the batches that are missing
+'''
+
+import os
+import json
+import hashlib
+import multiprocessing as mp
+import Queue
+import traceback
+import logging
+
+import numpy as np
+import numpy.random as nprand
+
+def sample_without_replacement(rng, n, k, num_samples):
+    '''
+    Draw num_samples independent samples of k distinct integers from [0, n),
+    returned as a (num_samples x k) array. Samples are drawn with replacement
+    first and only those rows containing a repeat are redrawn, by taking the
+    k smallest of n random keys, so the common case of k << n stays cheap.
+    '''
+    sample = rng.randint(0, n, size=(num_samples, k))
+    if k < 2:
+        return sample
+
+    sorted_sample = np.sort(sample, axis=1)
+    redraw = np.flatnonzero((sorted_sample[:,1:] == sorted_sample[:,:-1]).any(axis=1))
+
+    # Limit the random key matrix to ~32MB at a time
+    chunk_size = max(1, 2**22/n)
+    for i in range(0, len(redraw), chunk_size):
+        rows = redraw[i:i+chunk_size]
+        keys = rng.random_sample((len(rows), n))
+        sample[rows] = np.argpartition(keys, k-1, axis=1)[:,:k]
+
+    return sample
+
+def draw_samples(rng, strata, num_samples):
+    '''
+    Draw num_samples samples of item indices, taking count distinct items
+    from each (offset, num_items, count) stratum in turn.
+    '''
+    samples = [
+        offset + sample_without_replacement(rng, num_items, count, num_samples) \
+            for offset, num_items, count in strata
+    ]
+    if samples == []:
+        return np.zeros((num_samples, 0), dtype=np.int64)
+
+    return np.hstack(samples)
+
+def get_p_values(null, observed):
+    '''
+    Two-sided p-value of each observed value against the corresponding column
+    of the null matrix, with the usual +1 correction so that p is never 0.
+    '''
+    null = np.asarray(null, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    num_samples = null.shape[0]
+
+    upper = (1.0 + (null >= observed).sum(axis=0))/(1.0 + num_samples)
+    lower = (1.0 + (null <= observed).sum(axis=0))/(1.0 + num_samples)
+
+    return np.minimum(1.0, 2*np.minimum(upper, lower))
+
+def get_p_value_errors(null, observed):
+    '''
+    Monte Carlo standard error of each p-value from get_p_values.
+    '''
+    p = get_p_values(null, observed)
+    return np.sqrt(p*(1 - p)/null.shape[0])
+
+def get_file_info(fname):
+    '''
+    Identify an input file by path, size and modification time, for use in
+    null distribution cache keys.
+    '''
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, int(st.st_mtime)]
+
+def get_cache_fname(cache_dir, cache_key, strata, seed, batch_size):
+    key = json.dumps(
+        {
+            "key":cache_key,
+            "strata":[[int(x) for x in s] for s in strata],
+            "seed":seed,
+            "batch_size":batch_size
+        },
+        sort_keys=True
+    )
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + ".npy")
+
+class PermutationProcess(mp.Process):
+    '''
+    Worker that takes (batch number, seed, number of samples) jobs, draws that
+    many samples and puts the statistic's (num_samples x num_values) result
+    on the results queue, or (batch number, None) if it failed.
+    '''
+
+    def __init__(self, job_queue, results_queue, statistic, strata):
+        mp.Process.__init__(self)
+        self.daemon = True
+        self.job_queue = job_queue
+        self.results_queue = results_queue
+        self.statistic = statistic
+        self.strata = strata
+
+    def run(self):
+        while True:
+            job = self.job_queue.get()
+            if job == "STOP":
+                return None
+            else:
+                batch_num, seed, num_samples = job
+                try:
+                    rng = nprand.RandomState(seed)
+                    samples = draw_samples(rng, self.strata, num_samples)
+                    result = np.asarray(self.statistic(rng, samples))
+                except Exception:
+                    logging.error("Null batch {} failed:\n{}".format(
+                        batch_num, traceback.format_exc()
+                    ))
+                    result = None
+                self.results_queue.put((batch_num, result))
+
+def get_null_distn(
+        statistic, strata, num_samples, num_procs=1, batch_size=100,
+        seed=None, observed=None, precision=None, cache_dir=None,
+        cache_key=None):
+    '''
+    Build the null distribution of a statistic, returning a
+    (samples x num_values) array.
+
+    If observed values and a precision are given, batches are run in rounds
+    of one per process, and sampling stops as soon as the standard error of
+    every p-value is at most precision, so fewer than num_samples rows may be
+    returned.
+
+    If cache_dir is given along with a seed, batches are saved there under a
+    key made from cache_key (any JSON-serialisable description of the inputs
+    to the statistic), the strata, seed and batch size, and reused by later
+    runs with the same key.
+    '''
+    if seed is None:
+        seed = nprand.randint(2**31 - 1)
+        if cache_dir is not None:
+            logging.warning("No seed given, null distribution will not be cached")
+            cache_dir = None
+
+    num_batches = int(np.ceil(float(num_samples)/batch_size))
+
+    batches = []
+    cache_fname = None
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cache_fname = get_cache_fname(cache_dir, cache_key, strata, seed, batch_size)
+        if os.path.exists(cache_fname):
+            cached = np.load(cache_fname)[:num_batches*batch_size]
+            batches = [
+                cached[i:i+batch_size] for i in range(0, len(cached), batch_size)
+            ]
+            logging.info(
+                "Loaded {} cached null samples from {}".format(len(cached), cache_fname)
+            )
+
+    def is_precise(batches):
+        if observed is None or precision is None or batches == []:
+            return False
+        errors = get_p_value_errors(np.vstack(batches), observed)
+        return (errors <= precision).all()
+
+    num_cached = len(batches)
+
+    if len(batches) < num_batches and not is_precise(batches):
+        job_queue = mp.Queue()
+        results_queue = mp.Queue()
+
+        procs = [
+            PermutationProcess(job_queue, results_queue, statistic, strata) \
+                for _ in range(num_procs)
+        ]
+        for p in procs:
+            p.start()
+
+        if observed is None or precision is None:
+            round_size = num_batches
+        else:
+            round_size = num_procs
+
+        try:
+            while len(batches) < num_batches:
+                first = len(batches)
+                last = min(first + round_size, num_batches)
+                for i in range(first, last):
+                    job_queue.put((i, (seed + i) % 2**32, batch_size))
+
+                results = {}
+                while len(results) < last - first:
+                    try:
+                        batch_num, result = results_queue.get(timeout=1)
+                    except Queue.Empty:
+                        if not any(p.is_alive() for p in procs):
+                            raise RuntimeError("Workers exited before all null batches were generated")
+                        continue
+
+                    if result is None:
+                        raise RuntimeError("Generating null batch {} failed".format(batch_num))
+                    results[batch_num] = result
+                batches.extend(results[i] for i in range(first, last))
+
+                logging.info("{}/{} null samples generated".format(
+                    min(len(batches)*batch_size, num_samples), num_samples
+                ))
+
+                if is_precise(batches):
+                    logging.info("p-values within {} after {} samples".format(
+                        precision, len(batches)*batch_size
+                    ))
+                    break
+
+            for _ in procs:
+                job_queue.put("STOP")
+            for p in procs:
+                p.join()
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+
+    if cache_fname is not None and len(batches) > num_cached:
+        np.save(cache_fname, np.vstack(batches))
+
+    return np.vstack(batches)[:num_samples]
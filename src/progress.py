@@ -0,0 +1,154 @@
+'''
+Progress reporting and timing for long-running loops over input files.
+
+A Progress tracks one phase of a script (e.g. "Processing rmsk file"). Input
+files are measured by the bytes read so far against the file size, so no
+line count is needed up front. The bar is redrawn at most every interval
+seconds, and only when the output stream is a terminal, so runs in pipelines
+or under a scheduler print nothing and the per-line cost is a few additions.
+
+When a phase finishes, its elapsed time, item count and rate are logged, and
+appended as a JSON line to the file named by the PROGRESS_METRICS_LOG
+environment variable, if it is set:
+
+    with open(fname, 'r') as f:
+        progress = Progress.for_file("Processing rmsk file", fname)
+        for line in f:
+            ...
+            progress.update(len(line))
+        progress.finish()
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+
+BAR_WIDTH = 50
+METRICS_LOG_VAR = "PROGRESS_METRICS_LOG"
+
+def write_metrics(metrics, metrics_fname=None):
+    '''
+    Append a dict of metrics as a JSON line to metrics_fname, or to the file
+    named by PROGRESS_METRICS_LOG. Does nothing if neither is set.
+    '''
+    if metrics_fname is None:
+        metrics_fname = os.environ.get(METRICS_LOG_VAR)
+    if not metrics_fname:
+        return
+
+    try:
+        with open(metrics_fname, 'a') as out:
+            out.write(json.dumps(metrics, sort_keys=True) + "\n")
+    except IOError:
+        logging.warning("Could not write metrics to {}".format(metrics_fname))
+
+class Progress(object):
+
+    def __init__(
+            self, label, total=None, unit="lines", interval=0.5, stream=None,
+            metrics_fname=None):
+        '''
+        label names the phase, total is the amount of work to be done (e.g.
+        the size of the input in bytes; None if not known) and unit names the
+        items counted. The bar is drawn on stream (stdout by default) if it
+        is a terminal; the label is only used in the metrics.
+        '''
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.metrics_fname = metrics_fname
+
+        try:
+            self.enabled = self.stream.isatty()
+        except AttributeError:
+            self.enabled = False
+
+        self.done = 0
+        self.items = 0
+        self.start_time = time.time()
+        self.next_draw = self.start_time
+        self.finished = False
+
+        if self.enabled:
+            self.draw(self.start_time)
+
+    @classmethod
+    def for_file(cls, label, fname, **kwargs):
+        '''
+        Progress through a file, to be updated with the length of each line.
+        '''
+        return cls(label, total=os.path.getsize(fname), **kwargs)
+
+    def update(self, amount=1, items=1):
+        '''
+        Record amount more work done (e.g. bytes read) over items more items.
+        '''
+        self.done += amount
+        self.items += items
+        if self.enabled:
+            now = time.time()
+            if now >= self.next_draw:
+                self.draw(now)
+
+    def draw(self, now):
+        elapsed = now - self.start_time
+        rate = self.items/elapsed if elapsed > 0 else 0.0
+
+        if self.total:
+            fraction = min(float(self.done)/self.total, 1.0)
+            num_bars = int(fraction*BAR_WIDTH)
+            bar = "[{}{}] {:3.0f}% ".format(
+                "|"*num_bars, " "*(BAR_WIDTH - num_bars), 100*fraction
+            )
+        else:
+            bar = ""
+
+        self.stream.write("\r{}{:,} {} ({:,.0f}/s)".format(bar, self.items, self.unit, rate))
+        self.stream.flush()
+        self.next_draw = now + self.interval
+
+    def finish(self):
+        '''
+        Draw the final state, and log and record the phase's metrics. Returns
+        the metrics dict.
+        '''
+        if self.finished:
+            return None
+        self.finished = True
+
+        now = time.time()
+        if self.enabled:
+            if self.total:
+                self.done = max(self.done, self.total)
+            self.draw(now)
+            self.stream.write("\n")
+            self.stream.flush()
+
+        elapsed = now - self.start_time
+        metrics = {
+            "script":os.path.basename(sys.argv[0]),
+            "phase":self.label,
+            "elapsed":round(elapsed, 3),
+            "items":self.items,
+            "unit":self.unit,
+            "items_per_sec":round(self.items/elapsed, 1) if elapsed > 0 else None,
+            "time":time.strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        logging.info("{}: {} {} in {:.1f}s".format(
+            self.label, self.items, self.unit, elapsed
+        ))
+        write_metrics(metrics, self.metrics_fname)
+
+        return metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.finish()
+        return False
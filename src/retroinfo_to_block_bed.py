@@ -1,12 +1,12 @@
 # Script to take a ucscRetroInfo6.txt formatted file and output a BED file
 # containing the blocks ("exons") of each retrogene
 
-import sys
 import re
-import subprocess
 from math import *
 import argparse
 
+from progress import Progress
+
 def get_blocks(line, line_num):
 	'''
 	Extract a list of blocks from a retrogene line, then return the lines to
@@ -47,27 +47,17 @@ def get_blocks(line, line_num):
 def retroinfo_to_bed(retroinfo_fname, out_fname):
 	print("Beginning block extraction ... ")
 	with open(retroinfo_fname, 'r') as f, open(out_fname, 'wa') as out:
-		print('['+' '*50+']'),
-		print('\r'),
-		num_lines = int(
-			subprocess.check_output(
-				"wc -l %s | awk '{print $1}'" % retroinfo_fname,
-				shell =True
-			)
-		)
-		percent = 0.0
+		progress = Progress.for_file("Block extraction", retroinfo_fname)
 		i = 1
 
 		for line in f:
 			out.write(get_blocks(line, i))
 			i += 1
-			percent = 100.0*(float(i-1)/num_lines)
-			num_bars = int(floor(percent/2))
-			print('\r'),
-			print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-			sys.stdout.flush()
+			progress.update(len(line))
+
+		progress.finish()
 
-	print("\nDone")
+	print("Done")
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -1,11 +1,12 @@
 # Script to go from a rmskJoinedBaseline.txt file to a BED file of aligned blocks
 
-import sys
 import re
-import subprocess
 from math import *
 import argparse
 
+from chrom_parallel import run_by_chrom
+from progress import Progress
+
 def format_name(name_str):
 	if "/" in name_str:
 		name_list = re.split("[#/:]", name_str)
@@ -58,6 +59,15 @@ def process_line(line):
 
 	return out_lines
 
+def blocks_chrom(lines):
+	'''
+	BED lines for the blocks on the table lines of one chromosome
+	'''
+	out_lines = []
+	for line in lines:
+		out_lines += process_line(line)
+	return out_lines
+
 def rmsk_to_bed(rmsk_fname, out_fname):
 	'''
 	Function to take the name of a rmskJoinedBaseline table file from the UCSC
@@ -67,30 +77,16 @@ def rmsk_to_bed(rmsk_fname, out_fname):
 	with open(rmsk_fname, 'r') as f:
 
 		print("Processing table file ... ")
-		print('['+' '*50+']'),
-		print('\r'),
-		num_lines = int(
-			subprocess.check_output(
-				"wc -l %s | awk '{print $1}'" % rmsk_fname,
-				shell=True
-			)
-		)
-		percent = 0.0
-		i = 0
+		progress = Progress.for_file("Processing table file", rmsk_fname)
 
 		out_lines = []
 
 		for line in f:
 			out_lines += process_line(line)
+			progress.update(len(line))
 
-			i += 1
-			percent = 100.0*(float(i)/num_lines)
-			num_bars = int(floor(percent/2))
-			print('\r'),
-			print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-			sys.stdout.flush()
-
-		print("\nDone")
+		progress.finish()
+		print("Done")
 
 	out_str = "\n".join(out_lines) + "\n"
 	with open(out_fname, 'w') as f:
@@ -102,6 +98,15 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("rmsk_fname")
 	parser.add_argument("out_fname")
+	parser.add_argument("--threads", type=int, default=1,
+		help="Process chromosomes in parallel with this many processes " +
+			"(the table must be sorted by chromosome)")
 	args = parser.parse_args()
 
-	rmsk_to_bed(args.rmsk_fname, args.out_fname)
+	if args.threads > 1:
+		run_by_chrom(
+			args.rmsk_fname, args.out_fname, blocks_chrom,
+			threads=args.threads, chrom_field=1
+		)
+	else:
+		rmsk_to_bed(args.rmsk_fname, args.out_fname)
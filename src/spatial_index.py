@@ -0,0 +1,281 @@
+'''
+R*Tree spatial indexes over the (chromosome, start, end) columns of tables in
+the SQLite transcript/retrocopy databases, with overlap, window and
+nearest-neighbour queries and an overlap join, so positional lookups can be
+done inside the database instead of by writing BEDs for bedtools.
+
+For a table <table>, create_rtree adds
+
+    <table>_rtree        an rtree_i32 virtual table (id, chrom_min, chrom_max,
+                         start_min, end_max) keyed by the table's rowid
+    <table>_rtree_chrom  chromosome names and the integer codes used for them
+                         in the R*Tree
+
+and records the table in spatial_index. The R*Tree holds intervals in BED
+coordinates (0-based, half-open): tables built from GTFs (1-based, inclusive)
+are converted as they are indexed, and all queries take BED coordinates.
+Rows are returned from the table itself, unconverted.
+'''
+
+import sqlite3
+import logging
+
+def get_rtree_name(table):
+    return table + "_rtree"
+
+def get_chrom_table_name(table):
+    return table + "_rtree_chrom"
+
+def create_rtree(conn, table, zero_based=True):
+    '''
+    Build (or rebuild) the R*Tree index of a table with chromosome,
+    start_coord and end_coord columns. zero_based says whether the table's
+    coordinates are BED-like (True) or GTF-like (False).
+    '''
+    rtree = get_rtree_name(table)
+    chrom_table = get_chrom_table_name(table)
+
+    logging.info("Creating R*Tree index {} on {}".format(rtree, table))
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS spatial_index (
+            table_name text PRIMARY KEY,
+            zero_based integer
+        )
+    ''')
+    conn.execute("DROP TABLE IF EXISTS {}".format(rtree))
+    conn.execute("DROP TABLE IF EXISTS {}".format(chrom_table))
+
+    # rtree_i32 keeps coordinates exact; plain rtree stores 32-bit floats,
+    # which is still correct as queries are checked against the table
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE {} USING rtree_i32"
+            "(id, chrom_min, chrom_max, start_min, end_max)".format(rtree)
+        )
+    except sqlite3.OperationalError:
+        conn.execute(
+            "CREATE VIRTUAL TABLE {} USING rtree"
+            "(id, chrom_min, chrom_max, start_min, end_max)".format(rtree)
+        )
+
+    conn.execute('''
+        CREATE TABLE {} (
+            chrom_id integer PRIMARY KEY,
+            chromosome text UNIQUE,
+            max_end integer
+        )
+    '''.format(chrom_table))
+    conn.execute('''
+        INSERT INTO {} (chromosome, max_end)
+        SELECT chromosome, MAX(end_coord) FROM {}
+        GROUP BY chromosome ORDER BY chromosome
+    '''.format(chrom_table, table))
+
+    offset = 0 if zero_based else 1
+    conn.execute('''
+        INSERT INTO {0}
+        SELECT t.rowid, c.chrom_id, c.chrom_id, t.start_coord - {3}, t.end_coord
+        FROM {1} AS t JOIN {2} AS c ON c.chromosome = t.chromosome
+    '''.format(rtree, table, chrom_table, offset))
+
+    conn.execute(
+        "INSERT OR REPLACE INTO spatial_index VALUES (?, ?)",
+        (table, int(zero_based))
+    )
+    conn.commit()
+
+def create_rtrees(db_fname, tables):
+    '''
+    Build R*Tree indexes in an existing database, for a list of
+    (table, zero_based) tuples.
+    '''
+    conn = sqlite3.connect(db_fname)
+    for table, zero_based in tables:
+        create_rtree(conn, table, zero_based)
+    conn.close()
+
+class SpatialIndex(object):
+
+    def __init__(self, conn, table, columns=None):
+        '''
+        Queries on the R*Tree of table, returning the given columns (all by
+        default) of matching rows.
+        '''
+        row = conn.execute(
+            "SELECT zero_based FROM spatial_index WHERE table_name=?", (table, )
+        ).fetchone()
+        if row is None:
+            raise ValueError("Table {} has no spatial index".format(table))
+
+        self.conn = conn
+        self.table = table
+        self.rtree = get_rtree_name(table)
+        self.offset = 0 if row[0] else 1
+        self.columns = columns if columns is not None else self.get_table_columns()
+
+        self.chrom_info = {
+            c:(chrom_id, max_end) for chrom_id, c, max_end in conn.execute(
+                "SELECT chrom_id, chromosome, max_end FROM {}"
+                .format(get_chrom_table_name(table))
+            )
+        }
+
+        # The R*Tree narrows down the candidates, which are then checked
+        # against the table's own coordinates
+        self.overlap_query = '''
+            SELECT t.start_coord - {offset}, t.end_coord, {columns}
+            FROM {rtree} AS r JOIN {table} AS t ON t.rowid = r.id
+            WHERE r.chrom_min <= ? AND r.chrom_max >= ?
+            AND r.start_min < ? AND r.end_max > ?
+            AND t.start_coord - {offset} < ? AND t.end_coord > ?
+            ORDER BY t.start_coord
+        '''.format(
+            offset=self.offset, rtree=self.rtree, table=table,
+            columns=", ".join("t." + c for c in self.columns)
+        )
+
+    def get_table_columns(self):
+        return [
+            r[1] for r in self.conn.execute("PRAGMA table_info({})".format(self.table))
+        ]
+
+    def query(self, chrom, start, end):
+        '''
+        (start, end, row) tuples, in BED coordinates, for rows overlapping
+        [start, end) on chrom.
+        '''
+        try:
+            chrom_id = self.chrom_info[chrom][0]
+        except KeyError:
+            return []
+
+        return [
+            (r[0], r[1], r[2:]) for r in self.conn.execute(
+                self.overlap_query, (chrom_id, chrom_id, end, start, end, start)
+            )
+        ]
+
+    def overlap(self, chrom, start, end):
+        '''
+        Rows overlapping [start, end) on chrom (BED coordinates).
+        '''
+        return [row for _, _, row in self.query(chrom, start, end)]
+
+    def window(self, chrom, start, end, window):
+        '''
+        Rows within window bp of [start, end) on chrom, as bedtools window -w.
+        '''
+        return self.overlap(chrom, max(start - window, 0), end + window)
+
+    def nearest(self, chrom, start, end, k=1, max_distance=None):
+        '''
+        The k rows nearest to [start, end) on chrom, as (distance, row)
+        tuples sorted by distance, where overlapping rows are at distance 0
+        and bookended rows at distance 1 (as bedtools closest -d). Ties at the
+        kth distance are all returned. The window searched starts small and
+        doubles until it holds k rows, so only rows near the query are read.
+        '''
+        try:
+            max_end = self.chrom_info[chrom][1]
+        except KeyError:
+            return []
+
+        # Everything is within this window of the query
+        max_window = max(max_end, end)
+        if max_distance is not None:
+            max_window = min(max_window, max_distance)
+
+        window = min(1000, max_window)
+        while True:
+            hits = []
+            for s, e, row in self.query(chrom, max(start - window, 0), end + window):
+                if e <= start:
+                    distance = start - e + 1
+                elif s >= end:
+                    distance = s - end + 1
+                else:
+                    distance = 0
+                if distance <= window:
+                    hits.append((distance, row))
+
+            hits.sort(key=lambda h: h[0])
+            # Rows outside the window are further than window away, so the
+            # k nearest are known once there are k hits in it
+            if len(hits) >= k or window >= max_window:
+                if len(hits) > k:
+                    hits = [h for h in hits if h[0] <= hits[k-1][0]]
+                return hits
+
+            window = min(window*2, max_window)
+
+def overlap_join(conn, left, right, left_columns, right_columns, right_db=None):
+    '''
+    Join the rows of table left to the overlapping rows of table right,
+    which must have a spatial index, returning a list of
+    (left columns + right columns + (overlap, )) tuples, where overlap is the
+    overlap in bp. right may be in another database file, right_db, which is
+    attached for the join and detached once all the rows are fetched. Runs as
+    a single query inside SQLite.
+    '''
+    if right_db is not None:
+        conn.execute("ATTACH DATABASE ? AS right_db", (right_db, ))
+        schema = "right_db."
+    else:
+        schema = ""
+
+    try:
+        right_zero_based = conn.execute(
+            "SELECT zero_based FROM {}spatial_index WHERE table_name=?"
+            .format(schema), (right, )
+        ).fetchone()
+        if right_zero_based is None:
+            raise ValueError("Table {} has no spatial index".format(right))
+        left_zero_based = conn.execute(
+            "SELECT zero_based FROM spatial_index WHERE table_name=?", (left, )
+        ).fetchone()
+
+        # Without a record for left, take it to use the same coordinates
+        if left_zero_based is None:
+            left_zero_based = right_zero_based
+        l_off = 0 if left_zero_based[0] else 1
+        r_off = 0 if right_zero_based[0] else 1
+
+        query = '''
+            SELECT {l_cols}, {r_cols},
+                MIN(l.end_coord, b.end_coord)
+                    - MAX(l.start_coord - {l_off}, b.start_coord - {r_off})
+            FROM {left} AS l
+            JOIN {schema}{chrom_table} AS c ON c.chromosome = l.chromosome
+            JOIN {schema}{rtree} AS r
+                ON r.chrom_min <= c.chrom_id AND r.chrom_max >= c.chrom_id
+                AND r.start_min < l.end_coord AND r.end_max > l.start_coord - {l_off}
+            JOIN {schema}{right} AS b ON b.rowid = r.id
+            WHERE b.start_coord - {r_off} < l.end_coord
+            AND b.end_coord > l.start_coord - {l_off}
+        '''.format(
+            l_cols=", ".join("l." + c for c in left_columns),
+            r_cols=", ".join("b." + c for c in right_columns),
+            l_off=l_off, r_off=r_off, left=left, right=right, schema=schema,
+            chrom_table=get_chrom_table_name(right), rtree=get_rtree_name(right)
+        )
+
+        return conn.execute(query).fetchall()
+    finally:
+        if right_db is not None:
+            conn.execute("DETACH DATABASE right_db")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Add R*Tree indexes to tables of an existing database"
+    )
+    parser.add_argument("db_fname")
+    parser.add_argument("table", nargs="+")
+    parser.add_argument("--oneBased", action="store_true",
+        help="Table coordinates are 1-based and inclusive, as in a GTF")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    create_rtrees(args.db_fname, [(t, not args.oneBased) for t in args.table])
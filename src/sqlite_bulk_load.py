@@ -0,0 +1,258 @@
+'''
+Bulk loading of build-once SQLite databases.
+
+A BulkLoader takes rows one at a time (or as iterables) for any number of
+tables and inserts them in chunks of chunk_size, so parsers can stream rows
+straight into the database without holding them all in memory. Loads into a
+new database run with journalling and syncing switched off, which is safe for
+databases that are built once and rebuilt from scratch on failure; appends to
+an existing database keep SQLite's journalling, so a failed load can't
+corrupt the rows already there. All indexes (including what would otherwise
+be the PRIMARY KEY) are created after the data is in, rather than maintained
+row by row.
+
+With parallel=True, each table is written by its own worker process into a
+temporary database, fed chunks through a bounded queue; the finished tables
+are then copied into the target database with INSERT ... SELECT, which runs
+entirely inside SQLite. This lets one parse fill several tables at once. Use
+the loader in a with block, so that if loading fails the writers are stopped
+and their temporary databases removed:
+
+    with BulkLoader(db_fname, TABLES, parallel=True) as loader:
+        for row in rows:
+            loader.add("exon", row)
+        loader.finish()
+
+Tables are given as (name, columns, indexes) tuples, where columns is the
+column definition list for CREATE TABLE and indexes a list of
+(index name, columns, unique) tuples, e.g.
+
+    ("exon",
+     "chromosome text, start_coord integer, ..., exon_number integer",
+     [("exon_pk", "transcript_id, exon_number", True)])
+'''
+
+import os
+import shutil
+import sqlite3
+import tempfile as tf
+import multiprocessing as mp
+import Queue
+import logging
+
+BULK_PRAGMAS = [
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144"
+]
+
+# Only for databases that are thrown away if loading fails
+UNSAFE_PRAGMAS = [
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF"
+]
+
+def connect_bulk(db_fname, unsafe=True):
+    '''
+    Connect to a database for bulk loading, with journalling and syncing off
+    unless unsafe is False.
+    '''
+    conn = sqlite3.connect(db_fname)
+    for pragma in BULK_PRAGMAS + (UNSAFE_PRAGMAS if unsafe else []):
+        conn.execute(pragma)
+    return conn
+
+def create_table(conn, name, columns, append=False):
+    conn.execute("CREATE TABLE {}{} ({})".format(
+        "IF NOT EXISTS " if append else "", name, columns
+    ))
+
+def get_insert_sql(name, num_cols):
+    return "INSERT INTO {} VALUES ({})".format(name, ",".join(["?"]*num_cols))
+
+def create_indexes(conn, name, indexes, append=False):
+    for index_name, columns, unique in indexes:
+        logging.info("Creating index {} on {}".format(index_name, name))
+        conn.execute("CREATE {}INDEX {}{} ON {} ({})".format(
+            "UNIQUE " if unique else "", "IF NOT EXISTS " if append else "",
+            index_name, name, columns
+        ))
+
+class TableWriterProcess(mp.Process):
+    '''
+    Worker that creates one table in its own database and inserts chunks of
+    rows taken from job_queue until it receives "STOP".
+    '''
+
+    def __init__(self, job_queue, db_fname, name, columns):
+        mp.Process.__init__(self)
+        self.daemon = True
+        self.job_queue = job_queue
+        self.db_fname = db_fname
+        self.name = "TableWriter-" + name
+        self.table_name = name
+        self.columns = columns
+
+    def run(self):
+        conn = connect_bulk(self.db_fname)
+        create_table(conn, self.table_name, self.columns)
+
+        while True:
+            chunk = self.job_queue.get()
+            if chunk == "STOP":
+                break
+            conn.executemany(get_insert_sql(self.table_name, len(chunk[0])), chunk)
+
+        conn.commit()
+        conn.close()
+
+class BulkLoader(object):
+
+    def __init__(
+            self, db_fname, tables, chunk_size=100000, parallel=False,
+            replace=False, append=False):
+        '''
+        Create the tables in db_fname and prepare to load them. With replace
+        an existing database is removed first; with append, rows are added
+        to any existing tables of the same names (otherwise it is an error
+        for them to exist). Journalling and syncing are only switched off
+        when the database is new.
+        '''
+        if replace and os.path.exists(db_fname):
+            os.remove(db_fname)
+        fresh = not os.path.exists(db_fname)
+
+        self.db_fname = db_fname
+        self.tables = list(tables)
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.append = append
+        self.buffers = {name:[] for name, _, _ in self.tables}
+        self.counts = {name:0 for name, _, _ in self.tables}
+
+        self.part_dir = None
+        self.writers = {}
+        self.conn = None
+        try:
+            if parallel:
+                self.part_dir = tf.mkdtemp(dir=os.path.dirname(os.path.abspath(db_fname)))
+                for name, columns, _ in self.tables:
+                    # A short queue bounds the number of chunks held in memory
+                    job_queue = mp.Queue(maxsize=4)
+                    writer = TableWriterProcess(
+                        job_queue, os.path.join(self.part_dir, name + ".db"),
+                        name, columns
+                    )
+                    writer.start()
+                    self.writers[name] = (writer, job_queue)
+
+            # Connect after starting any writers, so they don't inherit the
+            # connection
+            self.conn = connect_bulk(db_fname, unsafe=fresh)
+            for name, columns, _ in self.tables:
+                create_table(self.conn, name, columns, append=append)
+            self.conn.commit()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def put_chunk(self, name, chunk):
+        '''
+        Send a chunk (or "STOP") to the writer of table name, raising if the
+        writer has exited
+        '''
+        writer, job_queue = self.writers[name]
+        while True:
+            try:
+                job_queue.put(chunk, timeout=1)
+                return
+            except Queue.Full:
+                if not writer.is_alive():
+                    raise RuntimeError("{} exited before all rows were written".format(writer.name))
+
+    def add(self, name, row):
+        buf = self.buffers[name]
+        buf.append(row)
+        if len(buf) >= self.chunk_size:
+            self.flush(name)
+
+    def add_rows(self, name, rows):
+        for row in rows:
+            self.add(name, row)
+
+    def flush(self, name):
+        buf = self.buffers[name]
+        if buf == []:
+            return
+
+        if self.parallel:
+            self.put_chunk(name, buf)
+        else:
+            self.conn.executemany(get_insert_sql(name, len(buf[0])), buf)
+
+        self.counts[name] += len(buf)
+        self.buffers[name] = []
+
+    def finish(self):
+        '''
+        Flush all remaining rows, gather the tables written in parallel, then
+        create the indexes. Returns the number of rows loaded into each table.
+        '''
+        try:
+            for name, _, _ in self.tables:
+                self.flush(name)
+
+            if self.parallel:
+                for name in self.writers:
+                    self.put_chunk(name, "STOP")
+                for writer, _ in self.writers.values():
+                    writer.join()
+                    if writer.exitcode != 0:
+                        raise RuntimeError("{} failed".format(writer.name))
+
+                self.conn.commit()
+                for name, _, _ in self.tables:
+                    logging.info("Copying table {} into {}".format(name, self.db_fname))
+                    self.conn.execute(
+                        "ATTACH DATABASE ? AS part",
+                        (os.path.join(self.part_dir, name + ".db"),)
+                    )
+                    self.conn.execute(
+                        "INSERT INTO main.{0} SELECT * FROM part.{0}".format(name)
+                    )
+                    self.conn.commit()
+                    self.conn.execute("DETACH DATABASE part")
+
+            for name, _, indexes in self.tables:
+                create_indexes(self.conn, name, indexes, append=self.append)
+
+            self.conn.commit()
+        finally:
+            self.close()
+
+        return self.counts
+
+    def close(self):
+        '''
+        Stop any writers still running, remove their temporary databases and
+        close the connection. Rows not yet loaded by finish are discarded.
+        '''
+        for writer, _ in self.writers.values():
+            if writer.is_alive():
+                writer.terminate()
+                writer.join()
+        self.writers = {}
+
+        if self.part_dir is not None:
+            shutil.rmtree(self.part_dir, ignore_errors=True)
+            self.part_dir = None
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
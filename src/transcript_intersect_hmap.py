@@ -15,6 +15,8 @@ import matplotlib.image as mpimg
 from matplotlib import colors
 from scipy.cluster.hierarchy import dendrogram, linkage, leaves_list
 
+from progress import Progress
+
 def get_headers(mbed_fname):
 	'''
 	Get the different categories of features the transcripts were intersected
@@ -45,26 +47,13 @@ def mbed_to_dict(mbed_fname, headers):
 	print("Parsing intersection file")
 	sys.stdout.flush()
 
-	num_lines = int(
-		subprocess.check_output(
-			"wc -l %s | awk '{print $1}'" % mbed_fname,
-			shell = True
-		)
-	)
-	percent = 0.0
-	print('['+' '*50+']'),
-	print('\r'),
-	sys.stdout.flush()
+	progress = Progress.for_file("Parsing intersection file", mbed_fname)
 
 	with open(mbed_fname, 'r') as mbed:
 		raw_dict = {}
-		for i,line in enumerate(mbed):
+		for line in mbed:
 
-			percent = 100.0*(float(i)/num_lines)
-			num_bars = int(floor(percent/2))
-			print('\r'),
-			print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-			sys.stdout.flush()
+			progress.update(len(line))
 
 			line_list = re.split("\s+", line.strip())
 
@@ -92,8 +81,7 @@ def mbed_to_dict(mbed_fname, headers):
 				except KeyError:
 					continue
 
-	print('\r'),
-	print('[' + '|'*50 + ']')
+	progress.finish()
 	print("Done")
 	sys.stdout.flush()
 
@@ -359,20 +347,15 @@ def make_heatmap(feat_array, tpm_array, length_array, coords_list, headers, sort
 	print("Creating heatmap matrix")
 	sys.stdout.flush()
 
-	print('['+' '*50+']'),
-	print('\r'),
-	percent = 0.0
+	progress = Progress(
+		"Creating heatmap matrix", total=num_transcripts, unit="transcripts"
+	)
 
 	num_classes = len(headers) + 1
 	is_first_row = True
 	for i,row in enumerate(feat_array):
 
-		percent = 100.0*(float(i)/num_transcripts)
-		num_bars = int(floor(percent/2))
-		print('\r'),
-		print('['+'|'*num_bars+' '*(50-num_bars)+']'),
-		sys.stdout.flush()
-
+		progress.update()
 
 		if -1 in np.sign(row):
 			print("removing neg row {}".format(i))
@@ -404,8 +387,7 @@ def make_heatmap(feat_array, tpm_array, length_array, coords_list, headers, sort
 		else:
 			plot_data = np.vstack((plot_data, new_row))
 
-	print('\r'),
-	print('['+'|'*50+']')
+	progress.finish()
 	print("Done")
 	print("Drawing heatmap")
 	sys.stdout.flush()